@@ -0,0 +1,386 @@
+import asyncio
+import time
+
+import httpx
+
+from openrouter_client import (
+    EXTRACT_TIMEOUT,
+    OFFLINE_REPLY,
+    REPLY_TIMEOUT,
+    RETRYABLE_STATUS,
+    OpenRouterBase,
+    StreamInterrupted,
+    _counts_as_outage,
+    _empty_order,
+    _retry_delay,
+)
+from tracing import tracer
+
+
+class AsyncChatStream:
+    """Async counterpart of ChatStream: iterate with `async for`, then read .text and timings"""
+
+    def __init__(self, chunks, fallback_text="", on_complete=None):
+        self._chunks = chunks
+        self.fallback_text = fallback_text
+        self.on_complete = on_complete
+        self.text = ""
+        self.ttft = None
+        self.total_time = None
+        self.truncated = False
+
+    async def __aiter__(self):
+        started = time.perf_counter()
+        parts = []
+        try:
+            async for chunk in self._chunks:
+                if self.ttft is None:
+                    self.ttft = time.perf_counter() - started
+                parts.append(chunk)
+                yield chunk
+        except StreamInterrupted:
+            self.truncated = True
+
+        received = bool(parts)
+        fallback = self.fallback_text() if callable(self.fallback_text) else self.fallback_text
+        if not parts and fallback:
+            parts.append(fallback)
+            yield fallback
+
+        self.text = "".join(parts)
+        self.total_time = time.perf_counter() - started
+        if received:
+            tracer.observe("llm_ttft", self.ttft)
+            tracer.observe("llm_total", self.total_time)
+        if received and not self.truncated and self.on_complete is not None:
+            self.on_complete(self.text)
+
+
+async def _single(text):
+    yield text
+
+
+class AsyncOpenRouterClient(OpenRouterBase):
+    """asyncio OpenRouter client for serving many concurrent chats from one event loop
+
+    Connections are pooled and kept alive by a single httpx.AsyncClient, at most
+    max_in_flight requests run at once, and 429/5xx responses are retried with the
+    same backoff as the sync client. Use it as `async with AsyncOpenRouterClient() as ai:`
+    or call aclose() when done.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.http = httpx.AsyncClient(
+            base_url=self.base_url,
+            limits=httpx.Limits(
+                max_connections=self.max_in_flight,
+                max_keepalive_connections=self.max_in_flight,
+            ),
+        )
+        self._limiter = asyncio.Semaphore(self.max_in_flight)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def _send(self, payload, timeout, stream=False):
+        """POST to chat/completions, retrying 429/5xx with backoff
+
+        The caller must hold the limiter. With stream=True the returned response is
+        still open and the caller must aclose() it.
+        """
+        for attempt in range(self.max_retries + 1):
+            request = self.http.build_request(
+                "POST", "/chat/completions", headers=self._headers(), content=payload, timeout=timeout
+            )
+            response = await self.http.send(request, stream=stream)
+            if response.status_code not in RETRYABLE_STATUS or attempt == self.max_retries:
+                return response
+            await response.aclose()
+            delay = _retry_delay(attempt, response.headers.get("Retry-After"))
+            print(f"OpenRouter returned {response.status_code}; retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def chat_completion(self, messages, temperature=0.7, timeout=REPLY_TIMEOUT, model=None, **extra):
+        """Send chat completion request to OpenRouter"""
+        if not self.api_key:
+            print("OPENROUTER_API_KEY is not set. Please add it to your .env file.")
+            return None
+        if not self.breaker.allow():
+            return None
+
+        try:
+            async with self._limiter:
+                response = await self._send(self._payload(messages, temperature, model, **extra), timeout)
+        except httpx.HTTPError as e:
+            print(f"Error calling OpenRouter API: {e}")
+            self.breaker.record_failure()
+            return None
+
+        try:
+            response.raise_for_status()
+            data = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"Error calling OpenRouter API: {e} | Response: {response.text}")
+            if _counts_as_outage(response.status_code):
+                self.breaker.record_failure()
+            return None
+        self.breaker.record_success()
+        return data
+
+    async def chat_completion_stream(self, messages, temperature=0.7, timeout=REPLY_TIMEOUT, model=None,
+                                     on_usage=None):
+        """Stream a chat completion from OpenRouter, yielding content chunks as they arrive
+
+        on_usage, if given, is called with the usage block from the end of the stream.
+        """
+        if not self.api_key:
+            print("OPENROUTER_API_KEY is not set. Please add it to your .env file.")
+            return
+        if not self.breaker.allow():
+            return
+
+        async with self._limiter:
+            try:
+                response = await self._send(
+                    self._payload(messages, temperature, model, stream=True), timeout, stream=True
+                )
+            except httpx.HTTPError as e:
+                print(f"Error streaming from OpenRouter API: {e}")
+                self.breaker.record_failure()
+                return
+
+            received = False
+            try:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    content, usage = self._parse_sse_line(line)
+                    if usage and on_usage is not None:
+                        on_usage(usage)
+                    if content is None:
+                        break
+                    if content:
+                        received = True
+                        yield content
+                if received:
+                    self.breaker.record_success()
+                else:
+                    self.breaker.record_failure()
+            except (httpx.HTTPError, StreamInterrupted) as e:
+                print(f"Error streaming from OpenRouter API: {e}")
+                if received or isinstance(e, StreamInterrupted) or _counts_as_outage(response.status_code):
+                    self.breaker.record_failure()
+                if received:
+                    raise StreamInterrupted(str(e)) from e
+            finally:
+                await response.aclose()
+
+    async def _timed_completion(self, task, model, messages, temperature, timeout, **extra):
+        started = time.perf_counter()
+        response = await self.chat_completion(messages, temperature, timeout, model=model, **extra)
+        self.router.record(task, model, time.perf_counter() - started, self._content(response) is not None)
+        self._record_usage(task, model, (response or {}).get("usage"))
+        return response
+
+    async def _routed_completion(self, task, messages, temperature=0.7, timeout=REPLY_TIMEOUT, **extra):
+        """Call the task's primary model, hedging to the next candidate once it runs past its p95
+
+        The first usable answer wins and every other call is cancelled.
+        """
+        candidates = self.router.candidates(task)
+        started = time.perf_counter()
+        pending, attempted = {}, []
+        winner = response = None
+
+        def launch():
+            model = candidates.pop(0)
+            attempted.append(model)
+            call = self._timed_completion(task, model, messages, temperature, timeout, **extra)
+            pending[asyncio.ensure_future(call)] = model
+
+        launch()
+        try:
+            while pending:
+                wait_for = started + timeout - time.perf_counter()
+                if candidates:
+                    wait_for = min(wait_for, self.router.hedge_delay(task, attempted[-1]))
+                done, _ = await asyncio.wait(pending, timeout=max(wait_for, 0), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    model = pending.pop(future)
+                    result = future.result()
+                    if winner is None and self._content(result) is not None:
+                        winner, response = model, result
+                if winner is not None:
+                    break
+                if not done:
+                    if not candidates:
+                        break
+                    launch()
+                elif not pending and candidates:
+                    launch()
+        finally:
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            self.router.record_decision(task, attempted, winner, time.perf_counter() - started)
+        return response
+
+    async def _routed_stream(self, task, messages, temperature=0.7, timeout=REPLY_TIMEOUT):
+        """Stream from the task's primary model, hedging when its first chunk is later than its p95
+
+        Whichever model produces the first chunk wins; the other streams are cancelled.
+        """
+        candidates = self.router.candidates(task)
+        started = time.perf_counter()
+        pending, attempted = {}, []
+        winner = None
+
+        def launch():
+            model = candidates.pop(0)
+            attempted.append(model)
+            stream = self.chat_completion_stream(
+                messages, temperature, timeout, model=model,
+                on_usage=lambda usage: self._record_usage(task, model, usage),
+            )
+            pending[asyncio.ensure_future(stream.__anext__())] = (model, stream, time.perf_counter())
+
+        launch()
+        try:
+            while pending and winner is None:
+                wait_for = started + timeout - time.perf_counter()
+                if candidates:
+                    wait_for = min(wait_for, self.router.hedge_delay(task, attempted[-1]))
+                done, _ = await asyncio.wait(pending, timeout=max(wait_for, 0), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if not candidates:
+                        break
+                    launch()
+                    continue
+                for future in done:
+                    model, stream, launched = pending.pop(future)
+                    try:
+                        chunk = future.result()
+                    except StopAsyncIteration:
+                        self.router.record(task, model, time.perf_counter() - launched, False)
+                        continue
+                    self.router.record(task, model, time.perf_counter() - launched, True)
+                    if winner is None:
+                        winner = (model, stream, chunk)
+                    else:
+                        await stream.aclose()
+                if winner is None and not pending and candidates:
+                    launch()
+        finally:
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for _, stream, _ in pending.values():
+                await stream.aclose()
+            self.router.record_decision(task, attempted, winner and winner[0], time.perf_counter() - started)
+
+        if winner is None:
+            return
+        _, stream, chunk = winner
+        try:
+            yield chunk
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    async def get_waiter_response(self, user_message, menu_context="", chat_history=None, stream=False,
+                                  timeout=REPLY_TIMEOUT, summary=""):
+        """Get response from AI waiter with restaurant context
+
+        With stream=True an AsyncChatStream is returned instead of a string.
+        """
+        cached = self._cached_reply(user_message, chat_history)
+        if cached is not None:
+            return AsyncChatStream(_single(cached)) if stream else cached
+        if self.breaker.is_open:
+            reply = self._fallback_reply(user_message, OFFLINE_REPLY)
+            return AsyncChatStream(_single(reply)) if stream else reply
+
+        messages = self._build_waiter_messages(user_message, menu_context, chat_history, summary)
+
+        if stream:
+            return AsyncChatStream(
+                self._routed_stream("stream", messages, timeout=timeout),
+                fallback_text=lambda: self._fallback_reply(user_message),
+                on_complete=lambda text: self._cache_reply(user_message, chat_history, text),
+            )
+
+        with tracer.span("llm_total"):
+            reply = self._content(await self._routed_completion("reply", messages, timeout=timeout))
+        if reply is not None:
+            self._cache_reply(user_message, chat_history, reply)
+            return reply
+        return self._fallback_reply(user_message)
+
+    async def extract_order_info(self, user_message, timeout=EXTRACT_TIMEOUT):
+        """Extract order information from user message"""
+        with tracer.span("order_extraction"):
+            local = self._extract_locally(user_message)
+            if local is not None:
+                return local
+
+            messages = self._build_extraction_messages(user_message)
+            response = await self._routed_completion("extract", messages, temperature=0.1, timeout=timeout)
+            return self._order_from_response(response)
+
+    async def get_waiter_response_with_order(self, user_message, menu_context="", chat_history=None,
+                                             timeout=REPLY_TIMEOUT, summary=""):
+        """Get (reply, order_info) from a single JSON-mode completion"""
+        cached = self._cached_reply(user_message, chat_history)
+        if cached is not None:
+            return cached, _empty_order()
+        if self.breaker.is_open:
+            return self._fallback_reply(user_message, OFFLINE_REPLY), await self.extract_order_info(user_message)
+
+        messages = self._build_combined_messages(user_message, menu_context, chat_history, summary)
+        with tracer.span("llm_total"):
+            response = await self._routed_completion(
+                "combined", messages, timeout=timeout, response_format={"type": "json_object"}
+            )
+        return self._combined_from_response(response, user_message, chat_history)
+
+    async def respond_and_extract(self, user_message, menu_context="", chat_history=None,
+                                  reply_timeout=REPLY_TIMEOUT, extract_timeout=EXTRACT_TIMEOUT, summary=""):
+        """Run the waiter reply and order extraction concurrently and return (reply, order_info)
+
+        Unlike the thread-based client, a call that overruns its timeout is actually
+        cancelled and its connection handed back to the pool.
+        """
+        async def reply():
+            try:
+                return await asyncio.wait_for(
+                    self.get_waiter_response(
+                        user_message, menu_context, chat_history, timeout=reply_timeout, summary=summary
+                    ),
+                    reply_timeout,
+                )
+            except asyncio.TimeoutError:
+                return self._fallback_reply(user_message)
+
+        async def extract():
+            try:
+                return await asyncio.wait_for(self.extract_order_info(user_message, extract_timeout), extract_timeout)
+            except asyncio.TimeoutError:
+                print(f"Order extraction did not finish within {extract_timeout}s; skipping it for this turn")
+            except Exception as e:
+                print(f"Order extraction failed: {e}")
+            return _empty_order()
+
+        return tuple(await asyncio.gather(reply(), extract()))
+
+    async def run_turn(self, user_message, menu_context="", chat_history=None, mode=None, summary=""):
+        """Produce (reply, order_info) for one chat turn using the combined or split path"""
+        if (mode or self.turn_mode) == "combined":
+            return await self.get_waiter_response_with_order(user_message, menu_context, chat_history, summary=summary)
+        return await self.respond_and_extract(user_message, menu_context, chat_history, summary=summary)
@@ -0,0 +1,107 @@
+import threading
+import time
+from settings import get_setting
+
+
+class CircuitBreaker:
+    """Fails fast after consecutive upstream failures and probes in the background to recover
+
+    While open, allow() returns False without touching the network. If a probe callable
+    is given, a daemon thread calls it every reset_timeout seconds and closes the circuit
+    on the first success; without one, the circuit half-opens after reset_timeout and the
+    next real request decides.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0, probe=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe = probe
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._prober = None
+
+    @classmethod
+    def from_settings(cls, probe=None):
+        return cls(
+            failure_threshold=int(get_setting("OPENROUTER_BREAKER_FAILURES") or 3),
+            reset_timeout=float(get_setting("OPENROUTER_BREAKER_RESET") or 30),
+            probe=probe,
+        )
+
+    @property
+    def is_open(self):
+        with self._lock:
+            self._maybe_half_open()
+            return self.state == self.OPEN
+
+    def _maybe_half_open(self):
+        if (self.state == self.OPEN and self.probe is None
+                and time.monotonic() - self.opened_at >= self.reset_timeout):
+            # One more failure trips it again straight away
+            self.state = self.CLOSED
+            self.failures = self.failure_threshold - 1
+
+    def allow(self):
+        """True if a request may go upstream now"""
+        with self._lock:
+            self._maybe_half_open()
+            if self.state == self.OPEN:
+                self.rejected += 1
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                print("OpenRouter answered again; closing the circuit")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.CLOSED and self.failures >= self.failure_threshold:
+                self._trip()
+
+    def _trip(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        print(f"OpenRouter failed {self.failures} times in a row; opening the circuit")
+        if self.probe is not None and (self._prober is None or not self._prober.is_alive()):
+            self._prober = threading.Thread(target=self._probe_until_recovered, name="openrouter-probe", daemon=True)
+            self._prober.start()
+
+    def _probe_until_recovered(self):
+        while True:
+            time.sleep(self.reset_timeout)
+            with self._lock:
+                if self.state != self.OPEN:
+                    return
+            try:
+                ok = self.probe()
+            except Exception as e:
+                print(f"OpenRouter probe failed: {e}")
+                ok = False
+            if ok:
+                self.record_success()
+                return
+
+    def stats(self):
+        with self._lock:
+            self._maybe_half_open()
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "open_for": round(time.monotonic() - self.opened_at, 1) if self.opened_at else 0.0,
+                "trips": self.trips,
+                "rejected": self.rejected,
+            }
@@ -1,30 +1,472 @@
 import json
-from pymongo import MongoClient
-from datetime import datetime
-import os
-from dotenv import load_dotenv
+import base64
+import hashlib
+import re
+import sys
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from datetime import datetime, timedelta
 from bson import ObjectId
+from menu_index import MenuIndex
+from settings import get_setting
 
-load_dotenv()
+# How often (seconds) a cached menu re-checks the stored menu version
+MENU_VERSION_CHECK_INTERVAL = 30
 
-try:
-    import streamlit as st
-except Exception:
-    st = None
+# "ranked" sends only the items relevant to the turn, within MENU_CONTEXT_TOKENS; "full"
+# sends the whole menu with every waiter prompt, as part of the cached prompt prefix, which
+# only pays off with a model that caches prompt prefixes (see PROMPT_CACHE_CONTROL)
+MENU_CONTEXT = (get_setting('MENU_CONTEXT') or 'ranked').lower()
 
+# Approximate token budget for the menu section of the waiter prompt when ranked
+MENU_CONTEXT_TOKENS = int(get_setting('MENU_CONTEXT_TOKENS') or 400)
 
-def _get_setting(key: str):
-    if st is not None:
-        try:
-            if key in st.secrets:
-                return st.secrets[key]
-        except Exception:
-            pass
-    return os.getenv(key)
+# Earlier user messages considered when ranking menu items for the prompt
+MENU_CONTEXT_HISTORY = 4
+
+# Messages kept inline on a conversation document. Beyond that, older messages are
+# moved to conversation_buckets ("bucket") or dropped ("truncate").
+CONVERSATION_MAX_MESSAGES = int(get_setting('CONVERSATION_MAX_MESSAGES') or 200)
+CONVERSATION_OVERFLOW = (get_setting('CONVERSATION_OVERFLOW') or 'bucket').lower()
+
+# Seconds the dashboard statistics are served from memory before re-reading the rollups
+STATS_CACHE_TTL = float(get_setting('STATS_CACHE_TTL') or 10)
+
+# Fields the Orders page displays; list queries fetch nothing else
+ORDER_LIST_PROJECTION = {
+    'customer_name': 1, 'customer_phone': 1, 'items': 1, 'total_amount': 1, 'status': 1, 'created_at': 1,
+}
+# Fields of an order change feed entry: the listed fields plus its feed position
+ORDER_FEED_PROJECTION = {**ORDER_LIST_PROJECTION, 'updated_at': 1}
+# Most changed orders one get_order_changes call returns
+ORDER_FEED_LIMIT = 200
+# Error code of a $changeStream on a standalone server (change streams need a replica set)
+CHANGE_STREAMS_UNSUPPORTED = 40573
+DUPLICATE_KEY = 11000
+# Recent write batch IDs kept on a document to recognise a retried batch
+APPLIED_BATCHES_KEPT = 20
+
+
+def _encode_page_token(direction, order):
+    raw = json.dumps({'d': direction, 'c': order['created_at'].isoformat(), 'i': str(order['_id'])})
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def _decode_page_token(token):
+    data = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    return data['d'], datetime.fromisoformat(data['c']), ObjectId(data['i'])
+
+
+def _encode_feed_token(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+
+def _decode_feed_token(token):
+    return json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+
+
+def _poll_token(order, seen=()):
+    """Feed token for the position just after order: its updated_at and the IDs already seen at it
+
+    Timestamps can tie (Mongo keeps milliseconds), and an order updated in the same
+    instant as one already returned may sort before it by _id, so the token resumes at
+    that updated_at and skips the listed IDs rather than comparing _id. None is the start.
+    """
+    if order is None:
+        return _encode_feed_token({'u': None, 'i': []})
+    return _encode_feed_token({'u': order['updated_at'].isoformat(), 'i': [*seen, str(order['_id'])]})
+
+
+def _once(query, update, batch_id):
+    """(query, update) for an upsert that does nothing if batch_id was already applied to the document"""
+    if batch_id is None:
+        return query, update
+    update = dict(update, **{'$push': dict(update.get('$push', {}), applied_batches={
+        '$each': [batch_id], '$slice': -APPLIED_BATCHES_KEPT,
+    })})
+    return dict(query, applied_batches={'$ne': batch_id}), update
+
+
+def _bulk_write_once(collection, operations, key_field, keys, batch_id):
+    """bulk_write the _once upserts for keys, ignoring those whose batch was already applied
+
+    An upsert whose document already holds batch_id fails its filter, and its insert then
+    hits the unique key. Those errors are swallowed once the batch is confirmed stored.
+    """
+    try:
+        collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if batch_id is None or e.details.get('writeConcernErrors') or any(
+            error['code'] != DUPLICATE_KEY for error in errors
+        ):
+            raise
+        duplicated = [keys[error['index']] for error in errors]
+        applied = collection.count_documents({key_field: {'$in': duplicated}, 'applied_batches': batch_id})
+        if applied < len(duplicated):
+            raise
+
+
+def _orders_page(orders, page_size, direction, page_token):
+    """Turn up to page_size + 1 orders fetched in keyset order into a get_orders_page result"""
+    has_more = len(orders) > page_size
+    orders = orders[:page_size]
+    if direction == 'prev':
+        orders.reverse()
+
+    next_token = prev_token = None
+    if orders:
+        if has_more or direction == 'prev':
+            next_token = _encode_page_token('next', orders[-1])
+        if page_token and (has_more or direction == 'next'):
+            prev_token = _encode_page_token('prev', orders[0])
+    for order in orders:
+        order['_id'] = str(order['_id'])
+    return {'orders': orders, 'next_token': next_token, 'prev_token': prev_token}
+
+
+def _plan_summary(explain):
+    """Reduce an explain() document to the stages and indexes of its winning plan"""
+    planner = explain.get('queryPlanner')
+    if planner is None:
+        # Aggregations report the planner of their initial $cursor stage
+        for stage in explain.get('stages', []):
+            if '$cursor' in stage:
+                planner = stage['$cursor'].get('queryPlanner')
+                break
+    plan = (planner or {}).get('winningPlan', {})
+    plan = plan.get('queryPlan', plan)
+
+    stages, indexes = [], []
+    pending = [plan]
+    while pending:
+        node = pending.pop()
+        if node.get('stage'):
+            stages.append(node['stage'])
+        if node.get('indexName'):
+            indexes.append(node['indexName'])
+        if 'inputStage' in node:
+            pending.append(node['inputStage'])
+        pending.extend(node.get('inputStages', []))
+    return {'stages': stages, 'indexes': indexes, 'collection_scan': 'COLLSCAN' in stages}
+
+
+def build_menu_documents(menu_data):
+    """Flatten parsed data.json into menu collection documents (the input is left untouched)"""
+    documents = [{
+        'type': 'restaurant_info',
+        'data': menu_data['restaurant']
+    }]
+
+    for category, items in menu_data['menu'].items():
+        if isinstance(items, dict):
+            # For nested categories like Pizza
+            for subcategory, subitems in items.items():
+                for item in subitems:
+                    documents.append(dict(item, category=category, subcategory=subcategory))
+        else:
+            # For flat categories
+            for item in items:
+                if isinstance(item, dict):
+                    documents.append(dict(item, category=category))
+                else:
+                    # For simple string items
+                    documents.append({
+                        'name': item,
+                        'category': category,
+                        'description': item
+                    })
+
+    for deal_type, deals in menu_data['deals'].items():
+        for deal in deals:
+            documents.append(dict(deal, category='deals', subcategory=deal_type))
+    return documents
+
+
+class MenuSnapshot:
+    """Immutable view of one menu version: items, category index and retrieval index"""
+
+    def __init__(self, version, documents):
+        self.version = version
+        self.restaurant_info = {}
+        self.items = []
+        self.by_category = {}
+        for doc in documents:
+            if doc.get('type') == 'restaurant_info':
+                self.restaurant_info = doc.get('data', {})
+                continue
+            self.items.append(doc)
+            self.by_category.setdefault(doc.get('category'), []).append(doc)
+        self.index = MenuIndex(self.items)
+        self.context = self.index.build_context("", token_budget=MENU_CONTEXT_TOKENS)
+        self.full_context = self.index.build_full_context()
+        self.checked_at = time.monotonic()
+
+
+class RestaurantStore(ABC):
+    """Storage interface shared by the Mongo, SQLite and in-memory backends
+
+    Menu: load_menu_data, get_menu_version, get_menu_items, get_restaurant_info,
+    get_menu_context, search_menu. Orders: create_order, insert_orders, get_orders,
+    get_orders_page, update_order_status. Stats: get_order_stats, bump_token_usage,
+    get_token_usage_summary. Conversations: save_conversation, append_conversation(s),
+    get_conversation, get_conversation_window, get_conversation_page,
+    save_conversation_summary/summaries, get_all_customers, delete_conversation.
+
+    The menu cache, order documents and single-item convenience methods live here;
+    a backend implements the rest, the abstract methods, including _stored_menu_version,
+    _has_menu, _menu_documents and _replace_menu.
+    """
+
+    # Collection for the shared reply cache (RESPONSE_CACHE=mongo); only the Mongo backend has one
+    response_cache_collection = None
+    # Collection for shared session state (SESSION_STORE=mongo); likewise Mongo only
+    sessions_collection = None
 
-class RestaurantDatabase:
     def __init__(self):
-        mongo_uri = _get_setting('MONGODB_URI')
+        self._menu = None
+        self._menu_lock = threading.Lock()
+
+    def load_menu_data(self, force=False):
+        """Load the menu from data.json, skipping the write when the stored version matches
+
+        The whole menu is replaced atomically, so readers never see a partial menu.
+        Returns True if the menu was (re)loaded.
+        """
+        with open('data.json', 'rb') as f:
+            raw = f.read()
+        version = hashlib.sha256(raw).hexdigest()[:16]
+        if not force and self._stored_menu_version() == version and self._has_menu():
+            return False
+
+        self._replace_menu(version, build_menu_documents(json.loads(raw)))
+        self.invalidate_menu_cache()
+        return True
+
+    def invalidate_menu_cache(self):
+        """Drop the in-process menu snapshot so the next read reloads it"""
+        with self._menu_lock:
+            self._menu = None
+
+    @abstractmethod
+    def _stored_menu_version(self):
+        ...
+
+    @abstractmethod
+    def _has_menu(self):
+        ...
+
+    @abstractmethod
+    def _menu_documents(self):
+        """Every stored menu document (restaurant info included), without storage IDs"""
+
+    @abstractmethod
+    def _replace_menu(self, version, documents):
+        ...
+
+    def _menu_snapshot(self):
+        """Return the cached menu, reloading it only when the stored version has changed"""
+        menu = self._menu
+        if menu is not None and time.monotonic() - menu.checked_at < MENU_VERSION_CHECK_INTERVAL:
+            return menu
+
+        with self._menu_lock:
+            menu = self._menu
+            if menu is not None and time.monotonic() - menu.checked_at < MENU_VERSION_CHECK_INTERVAL:
+                return menu
+            version = self._stored_menu_version()
+            if menu is not None and menu.version == version:
+                menu.checked_at = time.monotonic()
+                return menu
+            self._menu = MenuSnapshot(version, self._menu_documents())
+            return self._menu
+
+    def get_menu_version(self):
+        """Get the version of the menu currently being served"""
+        return self._menu_snapshot().version
+
+    def get_menu_items(self, category=None):
+        """Get menu items, optionally filtered by category (served from the menu cache; treat as read-only)"""
+        menu = self._menu_snapshot()
+        if category:
+            return list(menu.by_category.get(category, []))
+        return list(menu.items)
+    
+    def get_restaurant_info(self):
+        """Get restaurant information"""
+        return self._menu_snapshot().restaurant_info
+
+    def get_menu_context(self, query=None, chat_history=None, token_budget=MENU_CONTEXT_TOKENS, mode=None):
+        """Get menu context for the AI waiter
+
+        The items most relevant to the query and recent turns, within token_budget. With
+        mode (default MENU_CONTEXT) "full" it is the whole menu instead, the same text for
+        every turn until the menu changes, so it can sit in the cached prompt prefix.
+        """
+        menu = self._menu_snapshot()
+        if (mode or MENU_CONTEXT) == 'full':
+            return menu.full_context
+        if not query:
+            return menu.context
+        history = [
+            msg.get('content', '') for msg in (chat_history or [])
+            if msg.get('role') == 'user' and msg.get('content') != query
+        ][-MENU_CONTEXT_HISTORY:]
+        return menu.index.build_context(query, history, token_budget=token_budget)
+
+    def search_menu(self, query):
+        """Search menu items by name or description (query is a case-insensitive regex)"""
+        pattern = re.compile(query, re.IGNORECASE)
+        return [
+            doc for doc in self._menu_documents()
+            if doc.get('type') != 'restaurant_info' and any(
+                isinstance(doc.get(field), str) and pattern.search(doc[field]) for field in ('name', 'description')
+            )
+        ]
+
+    @staticmethod
+    def new_order_document(customer_name, customer_phone, items, total_amount):
+        """Build a pending order with its _id assigned up front, so the ID is known before the write"""
+        now = datetime.now()
+        return {
+            '_id': ObjectId(),
+            'customer_name': customer_name,
+            'customer_phone': customer_phone,
+            'items': items,
+            'total_amount': total_amount,
+            'status': 'pending',
+            'created_at': now,
+            'updated_at': now
+        }
+
+    def create_order(self, customer_name, customer_phone, items, total_amount):
+        """Create a new order"""
+        order = self.new_order_document(customer_name, customer_phone, items, total_amount)
+        self.insert_orders([order])
+        return str(order['_id'])
+
+    @abstractmethod
+    def insert_orders(self, orders):
+        """Insert prepared order documents, skipping any already stored (so a retry is safe)"""
+
+    @abstractmethod
+    def get_orders(self, status=None):
+        ...
+
+    @abstractmethod
+    def get_orders_page(self, status=None, page_size=20, page_token=None):
+        ...
+
+    @abstractmethod
+    def update_order_status(self, order_id, status):
+        ...
+
+    def get_order_changes(self, since=None, limit=ORDER_FEED_LIMIT):
+        """Orders created or updated after the since token, in the order they changed
+
+        Returns {'orders', 'token', 'more', 'reset'}. Pass token to the next call, and
+        call again straight away while more is True. since=None returns just the token
+        of the current position. reset means since cannot be resumed, so reload in full.
+        This polls the (updated_at, _id) index. A write committed late with an earlier
+        updated_at can be skipped, so callers should still reload in full now and then.
+        """
+        if since is None:
+            return {'orders': [], 'token': _poll_token(self._last_order_change()), 'more': False, 'reset': False}
+        position = _decode_feed_token(since)
+        if 'u' not in position:
+            # A change stream token, which polling cannot resume from
+            return {'orders': [], 'token': _poll_token(self._last_order_change()), 'more': False, 'reset': True}
+
+        after = None
+        if position['u']:
+            seen = position['i'] if isinstance(position['i'], list) else [position['i']]
+            after = (datetime.fromisoformat(position['u']), seen)
+        orders = self._orders_changed_after(after, limit + 1)
+        more = len(orders) > limit
+        orders = orders[:limit]
+        for order in orders:
+            order['_id'] = str(order['_id'])
+        token = since
+        if orders:
+            last = orders[-1]['updated_at']
+            seen = after[1] if after and after[0] == last else []
+            token = _poll_token(orders[-1], seen + [order['_id'] for order in orders[:-1] if order['updated_at'] == last])
+        return {'orders': orders, 'token': token, 'more': more, 'reset': False}
+
+    @abstractmethod
+    def _last_order_change(self):
+        """The most recently changed order by (updated_at, _id), or None"""
+
+    @abstractmethod
+    def _orders_changed_after(self, after, limit):
+        """Up to limit orders by (updated_at, id) from the start, or after the (updated_at, seen IDs) pair
+
+        That is, orders updated later, or at that updated_at but not among the seen IDs.
+        """
+
+    @abstractmethod
+    def get_order_stats(self):
+        ...
+
+    @abstractmethod
+    def bump_token_usage(self, rows, batch_id=None):
+        """Add usage increments to the rollups; retrying a call with the same batch_id adds nothing twice"""
+
+    @abstractmethod
+    def get_token_usage_summary(self, days=30):
+        ...
+
+    @abstractmethod
+    def save_conversation(self, customer_name, messages):
+        ...
+
+    def append_conversation(self, customer_name, new_messages):
+        """Append new messages to a customer's conversation"""
+        self.append_conversations({customer_name: list(new_messages)})
+
+    @abstractmethod
+    def append_conversations(self, appends, batch_id=None):
+        """Append {customer_name: [messages]}; retrying a call with the same batch_id appends nothing twice"""
+
+    @abstractmethod
+    def get_conversation(self, customer_name, limit=None):
+        ...
+
+    @abstractmethod
+    def get_conversation_window(self, customer_name, limit=None):
+        ...
+
+    @abstractmethod
+    def get_conversation_page(self, customer_name, before, limit=30):
+        ...
+
+    def save_conversation_summary(self, customer_name, summary, summary_upto):
+        """Store the rolling summary covering the first summary_upto messages (never moves backwards)"""
+        self.save_conversation_summaries({customer_name: (summary, summary_upto)})
+
+    @abstractmethod
+    def save_conversation_summaries(self, summaries):
+        ...
+
+    @abstractmethod
+    def get_all_customers(self):
+        ...
+
+    @abstractmethod
+    def delete_conversation(self, customer_name):
+        ...
+
+
+class RestaurantDatabase(RestaurantStore):
+    """MongoDB backend (the default, and the only one shared between app replicas)"""
+
+    def __init__(self, mongo_uri=None, database_name=None):
+        super().__init__()
+        mongo_uri = mongo_uri or get_setting('MONGODB_URI')
         if not mongo_uri:
             raise RuntimeError(
                 "MONGODB_URI is not set. Add it to .env for local runs or Streamlit Secrets for deployment."
@@ -37,68 +479,103 @@ class RestaurantDatabase:
             socketTimeoutMS=8000,
         )
         self.client.admin.command('ping')
-        self.db = self.client['restaurant_chatbot']
+        self.db = self.client[database_name or get_setting('MONGODB_DATABASE') or 'restaurant_chatbot']
         self.menu_collection = self.db['menu']
         self.orders_collection = self.db['orders']
         self.conversations_collection = self.db['conversations']
-        if self.menu_collection.count_documents({}) == 0:
-            self.load_menu_data()
-    
-    def load_menu_data(self):
-        """Load menu data from JSON file into MongoDB"""
-        with open('data.json', 'r', encoding='utf-8') as f:
-            menu_data = json.load(f)
-        
-        # Clear existing menu data
-        self.menu_collection.delete_many({})
-        
-        # Insert restaurant info
-        self.menu_collection.insert_one({
-            'type': 'restaurant_info',
-            'data': menu_data['restaurant']
-        })
-        
-        # Insert menu items by category
-        for category, items in menu_data['menu'].items():
-            if isinstance(items, dict):
-                # For nested categories like Pizza
-                for subcategory, subitems in items.items():
-                    for item in subitems:
-                        item['category'] = category
-                        item['subcategory'] = subcategory
-                        self.menu_collection.insert_one(item)
-            else:
-                # For flat categories
-                for item in items:
-                    if isinstance(item, dict):
-                        item['category'] = category
-                        self.menu_collection.insert_one(item)
-                    else:
-                        # For simple string items
-                        self.menu_collection.insert_one({
-                            'name': item,
-                            'category': category,
-                            'description': item
-                        })
-        
-        # Insert deals
-        for deal_type, deals in menu_data['deals'].items():
-            for deal in deals:
-                deal['category'] = 'deals'
-                deal['subcategory'] = deal_type
-                self.menu_collection.insert_one(deal)
-    
-    def get_menu_items(self, category=None):
-        """Get menu items, optionally filtered by category"""
-        if category:
-            return list(self.menu_collection.find({'category': category}, {'_id': 0}))
-        return list(self.menu_collection.find({'type': {'$ne': 'restaurant_info'}}, {'_id': 0}))
-    
-    def get_restaurant_info(self):
-        """Get restaurant information"""
-        info = self.menu_collection.find_one({'type': 'restaurant_info'}, {'_id': 0})
-        return info['data'] if info else {}
+        self.conversation_buckets_collection = self.db['conversation_buckets']
+        self.meta_collection = self.db['meta']
+        self.response_cache_collection = self.db['response_cache']
+        self.sessions_collection = self.db['sessions']
+        self.order_rollups_collection = self.db['order_rollups']
+        self.token_usage_collection = self.db['token_usage']
+        self._stats_cache = None
+        # Cleared on the first change stream refused by a standalone server
+        self._change_streams = (get_setting('ORDER_FEED') or 'auto').lower() != 'poll'
+        self.ensure_indexes()
+        self.load_menu_data()
+        if (self.order_rollups_collection.find_one({}, {'_id': 1}) is None
+                and self.orders_collection.find_one({}, {'_id': 1}) is not None):
+            # First start after upgrading. The backfill replaces the whole collection, so it is
+            # left to an operator rather than run while other replicas may be writing orders.
+            print("Order rollups are empty; run `python database.py rebuild-rollups` to backfill them")
     
+    def ensure_indexes(self):
+        """Create the indexes the query methods rely on (idempotent, safe on every start)
+
+        Raises RuntimeError when a unique index cannot be built, since writes depend on it.
+        """
+        specs = [
+            (self.conversations_collection, [('customer_name', ASCENDING)], {'unique': True}),
+            (self.conversation_buckets_collection, [('customer_name', ASCENDING), ('start', ASCENDING)], {}),
+            (self.orders_collection, [('status', ASCENDING), ('created_at', ASCENDING), ('_id', ASCENDING)], {}),
+            (self.orders_collection, [('created_at', ASCENDING), ('_id', ASCENDING)], {}),
+            (self.orders_collection, [('updated_at', ASCENDING), ('_id', ASCENDING)], {}),
+            (self.menu_collection, [('category', ASCENDING)], {}),
+            (self.order_rollups_collection, [('status', ASCENDING), ('day', ASCENDING)], {}),
+            (self.token_usage_collection, [('day', ASCENDING)], {}),
+        ]
+        for collection, keys, options in specs:
+            try:
+                collection.create_index(keys, **options)
+            except OperationFailure as e:
+                if options.get('unique'):
+                    # A retried write-behind append relies on it not to upsert a second conversation
+                    raise RuntimeError(
+                        f"Could not create the unique index {keys} on {collection.name}: {e}. "
+                        "Merge or remove the duplicate documents (e.g. left over from older versions), then restart."
+                    ) from e
+                print(f"Could not create index {keys} on {collection.name}: {e}")
+
+    def explain_queries(self, customer_name='explain', status='pending'):
+        """Report the winning plan of every query method, to confirm none scans a whole collection"""
+        def aggregate(collection, pipeline):
+            return self.db.command('aggregate', collection.name, pipeline=pipeline, explain=True)
+
+        plans = {
+            'get_menu_items(category)': self.menu_collection.find({'category': 'Pizza'}).explain(),
+            'get_conversation': self.conversations_collection.find({'customer_name': customer_name}).explain(),
+            'append_conversation': self.conversations_collection.find({'customer_name': customer_name}).explain(),
+            'get_orders(status)': self.orders_collection.find({'status': status}).explain(),
+            'get_orders_page': self.orders_collection.find({}, ORDER_LIST_PROJECTION)
+                .sort([('created_at', DESCENDING), ('_id', DESCENDING)]).limit(21).explain(),
+            'get_orders_page(status)': self.orders_collection.find({'status': status}, ORDER_LIST_PROJECTION)
+                .sort([('created_at', DESCENDING), ('_id', DESCENDING)]).limit(21).explain(),
+            'get_order_stats(status)': aggregate(self.order_rollups_collection, self._status_rollup_pipeline()),
+            'get_order_stats(daily)': self.order_rollups_collection.find({'status': 'completed'}).sort('day', 1).explain(),
+            'update_order_status': self.orders_collection.find({'_id': ObjectId()}).explain(),
+            'get_order_changes': self.orders_collection.find({'updated_at': {'$gt': datetime.now()}}, ORDER_FEED_PROJECTION)
+                .sort([('updated_at', ASCENDING), ('_id', ASCENDING)]).limit(ORDER_FEED_LIMIT + 1).explain(),
+        }
+        return {name: _plan_summary(explain) for name, explain in plans.items()}
+
+    def _stored_menu_version(self):
+        meta = self.meta_collection.find_one({'_id': 'menu'}, {'version': 1})
+        return meta.get('version') if meta else None
+
+    def _has_menu(self):
+        return self.menu_collection.find_one({}, {'_id': 1}) is not None
+
+    def _menu_documents(self):
+        return self.menu_collection.find({}, {'_id': 0})
+
+    def _replace_menu(self, version, documents):
+        """Write the menu with one insert_many into a staging collection renamed over the live one"""
+        staging = self.db[f"{self.menu_collection.name}_staging_{uuid.uuid4().hex[:8]}"]
+        try:
+            staging.insert_many(documents)
+            staging.create_index([('category', ASCENDING)])
+            staging.rename(self.menu_collection.name, dropTarget=True)
+        except Exception:
+            staging.drop()
+            raise
+
+        self.meta_collection.update_one(
+            {'_id': 'menu'},
+            {'$set': {'version': version, 'updated_at': datetime.now()}},
+            upsert=True,
+        )
+
     def search_menu(self, query):
         """Search menu items by name or description"""
         results = self.menu_collection.find({
@@ -112,19 +589,34 @@ class RestaurantDatabase:
         }, {'_id': 0})
         return list(results)
     
-    def create_order(self, customer_name, customer_phone, items, total_amount):
-        """Create a new order"""
-        order = {
-            'customer_name': customer_name,
-            'customer_phone': customer_phone,
-            'items': items,
-            'total_amount': total_amount,
-            'status': 'pending',
-            'created_at': datetime.now(),
-            'updated_at': datetime.now()
-        }
-        result = self.orders_collection.insert_one(order)
-        return str(result.inserted_id)
+    def insert_orders(self, orders):
+        """Insert prepared order documents in one round trip and update the rollups once
+
+        Safe to retry: orders already stored are skipped, and each order carries
+        rollup_pending until its rollup bump has landed, so it is counted exactly once.
+        """
+        if not orders:
+            return
+        try:
+            self.orders_collection.insert_many([dict(order, rollup_pending=True) for order in orders], ordered=False)
+            pending = orders
+        except BulkWriteError as e:
+            if e.details.get('writeConcernErrors') or any(
+                error['code'] != DUPLICATE_KEY for error in e.details.get('writeErrors', [])
+            ):
+                raise
+            pending = list(self.orders_collection.find(
+                {'_id': {'$in': [order['_id'] for order in orders]}, 'rollup_pending': True},
+                {'created_at': 1, 'status': 1, 'total_amount': 1},
+            ))
+        if not pending:
+            return
+        self._bump_rollups([
+            (order['created_at'], order['status'], 1, order.get('total_amount') or 0) for order in pending
+        ])
+        self.orders_collection.update_many(
+            {'_id': {'$in': [order['_id'] for order in pending]}}, {'$unset': {'rollup_pending': ''}}
+        )
     
     def get_orders(self, status=None):
         """Get orders, optionally filtered by status"""
@@ -132,12 +624,36 @@ class RestaurantDatabase:
         if status:
             query['status'] = status
 
-        orders = list(self.orders_collection.find(query))
+        orders = list(self.orders_collection.find(query, {'rollup_pending': 0}))
         for order in orders:
             if '_id' in order:
                 order['_id'] = str(order['_id'])
         return orders
     
+    def get_orders_page(self, status=None, page_size=20, page_token=None):
+        """Get one page of orders, newest first, using keyset pagination on (created_at, _id)
+
+        Returns {'orders', 'next_token', 'prev_token'}; pass either token back to move
+        to the older or newer page. Cost per page does not grow with the order count.
+        """
+        query = {'status': status} if status else {}
+        direction = 'next'
+        if page_token:
+            direction, created_at, oid = _decode_page_token(page_token)
+            op = '$lt' if direction == 'next' else '$gt'
+            query['$or'] = [
+                {'created_at': {op: created_at}},
+                {'created_at': created_at, '_id': {op: oid}},
+            ]
+
+        order = DESCENDING if direction == 'next' else ASCENDING
+        orders = list(
+            self.orders_collection.find(query, ORDER_LIST_PROJECTION)
+            .sort([('created_at', order), ('_id', order)])
+            .limit(page_size + 1)
+        )
+        return _orders_page(orders, page_size, direction, page_token)
+
     def update_order_status(self, order_id, status):
         """Update order status"""
         try:
@@ -145,38 +661,201 @@ class RestaurantDatabase:
         except Exception:
             return
 
-        self.orders_collection.update_one(
+        previous = self.orders_collection.find_one_and_update(
             {'_id': oid},
-            {'$set': {'status': status, 'updated_at': datetime.now()}}
+            {'$set': {'status': status, 'updated_at': datetime.now()}},
+            projection={'status': 1, 'created_at': 1, 'total_amount': 1, 'rollup_pending': 1},
+            return_document=ReturnDocument.BEFORE,
         )
-    
-    def get_order_stats(self):
-        """Get order statistics for dashboard"""
-        pipeline = [
+        # A rollup_pending order is counted under its current status once its insert is retried
+        if (previous and previous.get('status') != status and previous.get('created_at')
+                and not previous.get('rollup_pending')):
+            amount = previous.get('total_amount') or 0
+            self._bump_rollups([
+                (previous['created_at'], previous.get('status'), -1, -amount),
+                (previous['created_at'], status, 1, amount),
+            ])
+
+    def get_order_changes(self, since=None, limit=ORDER_FEED_LIMIT):
+        """Orders created or updated after the since token (see RestaurantStore.get_order_changes)
+
+        Reads a change stream when the deployment supports one, so an idle board costs
+        one empty getMore. On a standalone server this falls back to polling updated_at.
+        """
+        position = _decode_feed_token(since) if since else None
+        if self._change_streams and (position is None or 'r' in position):
+            try:
+                return self._stream_order_changes(position['r'] if position else None, limit)
+            except OperationFailure as e:
+                if e.code != CHANGE_STREAMS_UNSUPPORTED:
+                    if position is None:
+                        raise
+                    # e.g. the resume point has rolled off the oplog
+                    print(f"Could not resume the order change stream: {e}")
+                    return dict(self._stream_order_changes(None, limit), reset=True)
+                self._change_streams = False
+        return super().get_order_changes(since, limit)
+
+    def _stream_order_changes(self, resume_after, limit):
+        orders = {}
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}]
+        with self.orders_collection.watch(
+            pipeline, full_document='updateLookup', resume_after=resume_after, max_await_time_ms=10
+        ) as stream:
+            while len(orders) < limit:
+                change = stream.try_next()
+                if change is None:
+                    break
+                order = change.get('fullDocument')
+                if order:
+                    orders[str(order['_id'])] = {
+                        key: value for key, value in order.items() if key == '_id' or key in ORDER_FEED_PROJECTION
+                    }
+            resume_token = stream.resume_token or resume_after
+        for order in orders.values():
+            order['_id'] = str(order['_id'])
+        return {
+            'orders': list(orders.values()),
+            'token': _encode_feed_token({'r': resume_token}),
+            'more': len(orders) >= limit,
+            'reset': False,
+        }
+
+    def _last_order_change(self):
+        return self.orders_collection.find_one(
+            {}, {'updated_at': 1}, sort=[('updated_at', DESCENDING), ('_id', DESCENDING)]
+        )
+
+    def _orders_changed_after(self, after, limit):
+        query = {}
+        if after:
+            updated_at, seen = after
+            query['$or'] = [
+                {'updated_at': {'$gt': updated_at}},
+                {'updated_at': updated_at, '_id': {'$nin': [ObjectId(oid) for oid in seen]}},
+            ]
+        return list(
+            self.orders_collection.find(query, ORDER_FEED_PROJECTION)
+            .sort([('updated_at', ASCENDING), ('_id', ASCENDING)])
+            .limit(limit)
+        )
+
+    def _bump_rollups(self, changes):
+        """Apply (created_at, status, count, revenue) deltas to the per-day, per-status rollups"""
+        operations = []
+        for created_at, status, count, revenue in changes:
+            day = created_at.strftime('%Y-%m-%d')
+            operations.append(UpdateOne(
+                {'_id': f"{day}|{status}"},
+                {'$inc': {'count': count, 'revenue': revenue}, '$setOnInsert': {'day': day, 'status': status}},
+                upsert=True,
+            ))
+        if operations:
+            self.order_rollups_collection.bulk_write(operations, ordered=False)
+        self._stats_cache = None
+
+    def rebuild_order_rollups(self):
+        """Recompute the order rollups from scratch (one-shot backfill; run while orders are quiet)
+
+        Orders still flagged rollup_pending are left out: the insert that flagged them
+        bumps their rollup itself, on its first attempt or on a retry.
+        """
+        self.orders_collection.aggregate([
+            {'$match': {'rollup_pending': {'$ne': True}}},
+            {'$group': {
+                '_id': {
+                    'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$created_at'}},
+                    'status': '$status',
+                },
+                'count': {'$sum': 1},
+                'revenue': {'$sum': '$total_amount'},
+            }},
+            {'$project': {
+                '_id': {'$concat': ['$_id.day', '|', '$_id.status']},
+                'day': '$_id.day',
+                'status': '$_id.status',
+                'count': 1,
+                'revenue': 1,
+            }},
+            {'$out': self.order_rollups_collection.name},
+        ])
+        self.order_rollups_collection.create_index([('status', ASCENDING), ('day', ASCENDING)])
+        self._stats_cache = None
+
+    @staticmethod
+    def _status_rollup_pipeline():
+        return [
+            {'$sort': {'status': 1}},
             {'$group': {
                 '_id': '$status',
-                'count': {'$sum': 1}
+                'count': {'$sum': '$count'}
             }}
         ]
-        status_stats = list(self.orders_collection.aggregate(pipeline))
+
+    def get_order_stats(self):
+        """Get order statistics for dashboard (read from the rollups, briefly cached in memory)"""
+        cached = self._stats_cache
+        if cached is not None and time.monotonic() < cached[0]:
+            return cached[1]
+
+        status_stats = [
+            stat for stat in self.order_rollups_collection.aggregate(self._status_rollup_pipeline())
+            if stat['count'] > 0
+        ]
         
         # Get daily revenue
-        daily_pipeline = [
-            {'$match': {'status': 'completed'}},
-            {'$group': {
-                '_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$created_at'}},
-                'revenue': {'$sum': '$total_amount'},
-                'count': {'$sum': 1}
-            }},
-            {'$sort': {'_id': 1}}
+        daily_stats = [
+            {'_id': rollup['day'], 'revenue': rollup['revenue'], 'count': rollup['count']}
+            for rollup in self.order_rollups_collection.find({'status': 'completed', 'count': {'$gt': 0}}).sort('day', 1)
         ]
-        daily_stats = list(self.orders_collection.aggregate(daily_pipeline))
         
-        return {
+        stats = {
             'status_stats': status_stats,
             'daily_stats': daily_stats
         }
+        self._stats_cache = (time.monotonic() + STATS_CACHE_TTL, stats)
+        return stats
     
+    def bump_token_usage(self, rows, batch_id=None):
+        """Add per-call usage to the (day, customer, purpose, model) rollups
+
+        rows is a list of ((day, customer, purpose, model), increments) pairs, where
+        increments maps calls / prompt_tokens / completion_tokens / cached_tokens / cost
+        to the amount to add. With a batch_id, retrying the same call adds nothing twice.
+        """
+        keys, operations = [], []
+        for (day, customer, purpose, model), increments in rows:
+            key = f"{day}|{customer}|{purpose}|{model}"
+            keys.append(key)
+            operations.append(UpdateOne(
+                *_once({'_id': key}, {
+                    '$inc': increments,
+                    '$setOnInsert': {'day': day, 'customer': customer, 'purpose': purpose, 'model': model},
+                }, batch_id),
+                upsert=True,
+            ))
+        if operations:
+            _bulk_write_once(self.token_usage_collection, operations, '_id', keys, batch_id)
+
+    def get_token_usage_summary(self, days=30):
+        """Token and cost totals for the last `days` days, grouped per day, per customer and per purpose"""
+        since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        totals = {
+            'calls': {'$sum': '$calls'},
+            'prompt_tokens': {'$sum': '$prompt_tokens'},
+            'completion_tokens': {'$sum': '$completion_tokens'},
+            'cached_tokens': {'$sum': '$cached_tokens'},
+            'cost': {'$sum': '$cost'},
+        }
+        result = list(self.token_usage_collection.aggregate([
+            {'$match': {'day': {'$gte': since}}},
+            {'$facet': {
+                field: [{'$group': {'_id': f'${field}', **totals}}, {'$sort': {'_id': 1}}]
+                for field in ('day', 'customer', 'purpose', 'model')
+            }},
+        ]))
+        return result[0] if result else {'day': [], 'customer': [], 'purpose': [], 'model': []}
+
     def save_conversation(self, customer_name, messages):
         """Save conversation history for a customer"""
         conversation = {
@@ -196,21 +875,226 @@ class RestaurantDatabase:
                 {
                     '$set': {
                         'messages': messages,
+                        'message_count': len(messages),
+                        'head_count': len(messages),
                         'updated_at': datetime.now()
                     }
                 }
             )
         else:
             # Create new conversation
+            conversation['message_count'] = len(messages)
+            conversation['head_count'] = len(messages)
             self.conversations_collection.insert_one(conversation)
+
+    def append_conversation(self, customer_name, new_messages):
+        """Append new messages to a customer's conversation in a single upsert
+
+        Only the new messages travel over the wire. The inline array is capped at
+        CONVERSATION_MAX_MESSAGES; overflow is trimmed or spilled into buckets.
+        """
+        new_messages = list(new_messages)
+        if not new_messages:
+            return
+
+        update = self._append_update(new_messages)
+        if CONVERSATION_OVERFLOW == 'truncate':
+            self.conversations_collection.update_one({'customer_name': customer_name}, update, upsert=True)
+            return
+
+        self._seed_head_counts([customer_name])
+        doc = self.conversations_collection.find_one_and_update(
+            {'customer_name': customer_name},
+            update,
+            projection={'head_count': 1, '_id': 0},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc and doc.get('head_count', 0) > CONVERSATION_MAX_MESSAGES:
+            self._spill_conversation(customer_name)
+
+    def _seed_head_counts(self, names):
+        """Count the inline messages of conversations saved before head_count was tracked
+
+        Otherwise the first append's $inc would start head_count from zero and the
+        overflow check would miss conversations already over the limit.
+        """
+        inline = {'$size': {'$ifNull': ['$messages', []]}}
+        self.conversations_collection.update_many(
+            {'customer_name': {'$in': names}, 'head_count': {'$exists': False}},
+            [{'$set': {'head_count': inline, 'message_count': {'$ifNull': ['$message_count', inline]}}}],
+        )
+
+    @staticmethod
+    def _append_update(new_messages):
+        now = datetime.now()
+        push = {'$each': new_messages}
+        if CONVERSATION_OVERFLOW == 'truncate':
+            push['$slice'] = -CONVERSATION_MAX_MESSAGES
+        return {
+            '$push': {'messages': push},
+            '$inc': {'message_count': len(new_messages), 'head_count': len(new_messages)},
+            '$set': {'updated_at': now},
+            '$setOnInsert': {'created_at': now},
+        }
+
+    def append_conversations(self, appends, batch_id=None):
+        """Append messages for many customers ({customer_name: [messages]}) in one bulk write
+
+        With a batch_id, retrying the same call appends nothing twice.
+        """
+        names = [name for name, messages in appends.items() if messages]
+        operations = [
+            UpdateOne(*_once({'customer_name': name}, self._append_update(list(appends[name])), batch_id), upsert=True)
+            for name in names
+        ]
+        if not operations:
+            return
+        if CONVERSATION_OVERFLOW != 'truncate':
+            self._seed_head_counts(names)
+        _bulk_write_once(self.conversations_collection, operations, 'customer_name', names, batch_id)
+        if CONVERSATION_OVERFLOW == 'truncate':
+            return
+        try:
+            overflowing = self.conversations_collection.find(
+                {'customer_name': {'$in': names}, 'head_count': {'$gt': CONVERSATION_MAX_MESSAGES}},
+                {'customer_name': 1, '_id': 0},
+            )
+            for doc in overflowing:
+                self._spill_conversation(doc['customer_name'])
+        except Exception as e:
+            # The messages are stored; head_count stays over the limit, so the next append retries the spill
+            print(f"Could not spill overflowing conversations: {e}")
+
+    def _spill_conversation(self, customer_name):
+        """Move the older half of the inline messages into an overflow bucket document"""
+        doc = self.conversations_collection.find_one(
+            {'customer_name': customer_name},
+            {'messages': 1, 'message_count': 1, 'head_count': 1},
+        )
+        if not doc:
+            return
+        messages = doc.get('messages', [])
+        keep = CONVERSATION_MAX_MESSAGES // 2
+        spill = messages[:-keep] if keep else messages
+        if not spill:
+            return
+
+        # Absolute position of the first inline message within the whole conversation
+        total = max(doc.get('message_count') or 0, len(messages))
+        start = total - len(messages)
+        bucket = self.conversation_buckets_collection.insert_one({
+            'customer_name': customer_name,
+            'start': start,
+            'messages': spill,
+            'created_at': datetime.now(),
+        })
+
+        # Only trim if nothing was appended since the read; otherwise undo and retry next turn
+        result = self.conversations_collection.update_one(
+            {'_id': doc['_id'], 'head_count': doc.get('head_count')},
+            {
+                '$push': {'messages': {'$each': [], '$slice': -(len(messages) - len(spill))}},
+                '$set': {'head_count': len(messages) - len(spill), 'message_count': total},
+            },
+        )
+        if result.modified_count == 0:
+            self.conversation_buckets_collection.delete_one({'_id': bucket.inserted_id})
     
-    def get_conversation(self, customer_name):
-        """Get conversation history for a customer"""
-        conversation = self.conversations_collection.find_one({'customer_name': customer_name})
+    def get_conversation(self, customer_name, limit=None):
+        """Get conversation history for a customer, optionally only the most recent limit messages"""
+        projection = {'messages': {'$slice': -limit}} if limit else {'messages': 1}
+        conversation = self.conversations_collection.find_one({'customer_name': customer_name}, projection)
         if conversation:
             return conversation.get('messages', [])
         return []
     
+    def get_conversation_window(self, customer_name, limit=None):
+        """Get the latest messages with their absolute start position and the rolling summary
+
+        Returns {'messages', 'start', 'summary', 'summary_upto'}; positions count every
+        message ever stored for the customer, including ones spilled into buckets.
+        """
+        projection = {
+            'messages': {'$slice': -limit} if limit else 1,
+            'message_count': 1,
+            'summary': 1,
+            'summary_upto': 1,
+        }
+        conversation = self.conversations_collection.find_one({'customer_name': customer_name}, projection)
+        if not conversation:
+            return {'messages': [], 'start': 0, 'summary': None, 'summary_upto': 0}
+        messages = conversation.get('messages', [])
+        total = max(conversation.get('message_count') or 0, len(messages))
+        return {
+            'messages': messages,
+            'start': total - len(messages),
+            'summary': conversation.get('summary'),
+            'summary_upto': conversation.get('summary_upto', 0),
+        }
+
+    def get_conversation_page(self, customer_name, before, limit=30):
+        """Get up to limit messages ending just before absolute position before
+
+        Reads the inline array with a positional $slice and falls back to overflow
+        buckets for older positions. Returns {'messages', 'start', 'has_more'}.
+        """
+        sizes = list(self.conversations_collection.aggregate([
+            {'$match': {'customer_name': customer_name}},
+            {'$project': {'message_count': 1, 'inline': {'$size': {'$ifNull': ['$messages', []]}}}},
+        ]))
+        if not sizes or before <= 0:
+            return {'messages': [], 'start': 0, 'has_more': False}
+        inline = sizes[0]['inline']
+        total = max(sizes[0].get('message_count') or 0, inline)
+        inline_start = total - inline
+        before = min(before, total)
+        start = max(0, before - limit)
+
+        messages = []
+        if before > inline_start:
+            skip = max(start, inline_start) - inline_start
+            doc = self.conversations_collection.find_one(
+                {'customer_name': customer_name},
+                {'messages': {'$slice': [skip, before - inline_start - skip]}, '_id': 0},
+            )
+            messages = (doc or {}).get('messages', [])
+        if start < inline_start:
+            # Buckets are contiguous, so walk back from the newest one below the inline array
+            older, upto = [], min(before, inline_start)
+            buckets = self.conversation_buckets_collection.find(
+                {'customer_name': customer_name, 'start': {'$lt': upto}},
+                {'start': 1, 'messages': 1},
+            ).sort('start', DESCENDING)
+            for bucket in buckets:
+                bucket_messages = bucket['messages'][:upto - bucket['start']]
+                older = bucket_messages[max(0, start - bucket['start']):] + older
+                upto = bucket['start']
+                if upto <= start:
+                    break
+            messages = older + messages
+            # Truncated conversations have nothing stored before the inline array
+            start = before - len(messages)
+
+        first_stored = 0 if CONVERSATION_OVERFLOW != 'truncate' else inline_start
+        return {'messages': messages, 'start': start, 'has_more': bool(messages) and start > first_stored}
+
+    def save_conversation_summaries(self, summaries):
+        """Store several rolling summaries ({customer_name: (summary, summary_upto)}) in one bulk write"""
+        now = datetime.now()
+        operations = [
+            UpdateOne(
+                {
+                    'customer_name': name,
+                    '$or': [{'summary_upto': {'$exists': False}}, {'summary_upto': {'$lt': summary_upto}}],
+                },
+                {'$set': {'summary': summary, 'summary_upto': summary_upto, 'updated_at': now}},
+            )
+            for name, (summary, summary_upto) in summaries.items()
+        ]
+        if operations:
+            self.conversations_collection.bulk_write(operations, ordered=False)
+
     def get_all_customers(self):
         """Get list of all customers who have conversations"""
         customers = self.conversations_collection.find({}, {'customer_name': 1, '_id': 0})
@@ -219,3 +1103,41 @@ class RestaurantDatabase:
     def delete_conversation(self, customer_name):
         """Delete conversation for a customer"""
         self.conversations_collection.delete_one({'customer_name': customer_name})
+        self.conversation_buckets_collection.delete_many({'customer_name': customer_name})
+
+
+
+def open_database():
+    """Build the storage backend chosen by STORAGE_BACKEND ("mongo", "sqlite" or "memory")
+
+    Defaults to mongo when MONGODB_URI is set and to SQLite (SQLITE_PATH, default
+    restaurant.db) otherwise.
+    """
+    backend = (get_setting('STORAGE_BACKEND') or ('mongo' if get_setting('MONGODB_URI') else 'sqlite')).lower()
+    if backend == 'mongo':
+        return RestaurantDatabase()
+    from embedded_database import MemoryDatabase, SQLiteDatabase
+    if backend == 'sqlite':
+        return SQLiteDatabase(get_setting('SQLITE_PATH') or 'restaurant.db')
+    if backend == 'memory':
+        return MemoryDatabase()
+    raise RuntimeError(f"Unknown STORAGE_BACKEND {backend!r}; use mongo, sqlite or memory.")
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    database = RestaurantDatabase()
+    if command == 'ensure-indexes':
+        database.ensure_indexes()
+        print("Indexes are in place")
+    elif command == 'load-menu':
+        loaded = database.load_menu_data(force='--force' in sys.argv)
+        print("Menu loaded" if loaded else "Menu already up to date")
+    elif command == 'rebuild-rollups':
+        database.rebuild_order_rollups()
+        print("Order rollups rebuilt")
+    elif command == 'explain':
+        for method, plan in database.explain_queries().items():
+            flag = "COLLSCAN" if plan['collection_scan'] else "ok"
+            print(f"{method:28} {flag:9} stages={plan['stages']} indexes={plan['indexes']}")
+    else:
+        print("Usage: python database.py [ensure-indexes|explain|load-menu|rebuild-rollups]")
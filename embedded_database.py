@@ -0,0 +1,701 @@
+import copy
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from database import (
+    APPLIED_BATCHES_KEPT, CONVERSATION_MAX_MESSAGES, CONVERSATION_OVERFLOW, ORDER_FEED_PROJECTION, ORDER_LIST_PROJECTION, RestaurantStore,
+    _decode_page_token, _orders_page,
+)
+
+
+USAGE_FIELDS = ('calls', 'prompt_tokens', 'completion_tokens', 'cached_tokens', 'cost')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS menu (id INTEGER PRIMARY KEY, category TEXT, doc TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS menu_category ON menu (category);
+CREATE TABLE IF NOT EXISTS orders (
+    id TEXT PRIMARY KEY,
+    customer_name TEXT,
+    customer_phone TEXT,
+    items TEXT,
+    total_amount NUMERIC,
+    status TEXT,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS orders_status_created ON orders (status, created_at, id);
+CREATE INDEX IF NOT EXISTS orders_created ON orders (created_at, id);
+CREATE INDEX IF NOT EXISTS orders_updated ON orders (updated_at, id);
+CREATE TABLE IF NOT EXISTS order_rollups (
+    day TEXT, status TEXT, count INTEGER, revenue NUMERIC, PRIMARY KEY (day, status)
+);
+CREATE TABLE IF NOT EXISTS token_usage (
+    day TEXT, customer TEXT, purpose TEXT, model TEXT,
+    calls INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER, cached_tokens INTEGER, cost NUMERIC,
+    PRIMARY KEY (day, customer, purpose, model)
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    customer_name TEXT PRIMARY KEY,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    summary TEXT,
+    summary_upto INTEGER,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    customer_name TEXT, position INTEGER, message TEXT, PRIMARY KEY (customer_name, position)
+) WITHOUT ROWID;
+"""
+
+ORDER_COLUMNS = 'id, customer_name, customer_phone, items, total_amount, status, created_at, updated_at'
+
+
+def _ts(value):
+    return value.isoformat(timespec='microseconds')
+
+
+def _order_id(order_id):
+    """Canonical string form of an order ID, or None if it is not a valid ObjectId"""
+    try:
+        return str(ObjectId(order_id))
+    except Exception:
+        return None
+
+
+def _usage_since(days):
+    return (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+
+
+def _list_fields(order, projection=ORDER_LIST_PROJECTION):
+    """Restrict an order to the fields the Orders page lists, like ORDER_LIST_PROJECTION does in Mongo"""
+    return {key: value for key, value in order.items() if key == '_id' or key in projection}
+
+
+def _apply_once(doc, batch_id):
+    """Record batch_id in doc's applied_batches, like database._once does in Mongo; False if already there"""
+    if batch_id is None:
+        return True
+    if batch_id in doc['applied_batches']:
+        return False
+    doc['applied_batches'].append(batch_id)
+    del doc['applied_batches'][:-APPLIED_BATCHES_KEPT]
+    return True
+
+
+class SQLiteDatabase(RestaurantStore):
+    """Embedded SQLite backend for a single host: kiosks, CI and load tests
+
+    The database runs in WAL mode so readers never block the writer. Each thread
+    gets its own connection, and writes go through short BEGIN IMMEDIATE
+    transactions. Conversations are kept whole in a messages table, so no overflow
+    buckets are needed.
+    """
+
+    def __init__(self, path='restaurant.db'):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        # Every connection to :memory: opens a separate database, so that case shares one
+        self._shared = self._connect() if path == ':memory:' else None
+        self._conn().executescript(SCHEMA)
+        self.load_menu_data()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _conn(self):
+        if self._shared is not None:
+            return self._shared
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @contextmanager
+    def _read(self):
+        if self._shared is None:
+            yield self._conn()
+        else:
+            with self._write_lock:
+                yield self._shared
+
+    @contextmanager
+    def _transaction(self):
+        with self._write_lock:
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    # Menu
+
+    def _stored_menu_version(self):
+        with self._read() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'menu_version'").fetchone()
+        return row['value'] if row else None
+
+    def _has_menu(self):
+        with self._read() as conn:
+            return conn.execute('SELECT 1 FROM menu LIMIT 1').fetchone() is not None
+
+    def _menu_documents(self):
+        with self._read() as conn:
+            rows = conn.execute('SELECT doc FROM menu ORDER BY id').fetchall()
+        return [json.loads(row['doc']) for row in rows]
+
+    def _replace_menu(self, version, documents):
+        # One transaction: WAL readers keep seeing the previous menu until it commits
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM menu')
+            conn.executemany(
+                'INSERT INTO menu (category, doc) VALUES (?, ?)',
+                [(doc.get('category'), json.dumps(doc)) for doc in documents],
+            )
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('menu_version', ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (version,),
+            )
+
+    # Orders
+
+    @staticmethod
+    def _order_from_row(row):
+        return {
+            '_id': row['id'],
+            'customer_name': row['customer_name'],
+            'customer_phone': row['customer_phone'],
+            'items': json.loads(row['items']),
+            'total_amount': row['total_amount'],
+            'status': row['status'],
+            'created_at': datetime.fromisoformat(row['created_at']),
+            'updated_at': datetime.fromisoformat(row['updated_at']),
+        }
+
+    @staticmethod
+    def _bump_rollups(conn, changes):
+        """Apply (created_at, status, count, revenue) deltas to the per-day, per-status rollups"""
+        conn.executemany(
+            'INSERT INTO order_rollups (day, status, count, revenue) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (day, status) DO UPDATE SET '
+            'count = count + excluded.count, revenue = revenue + excluded.revenue',
+            [(created_at.strftime('%Y-%m-%d'), status, count, revenue) for created_at, status, count, revenue in changes],
+        )
+
+    def insert_orders(self, orders):
+        """Insert prepared order documents and update the rollups in one transaction
+
+        Orders already stored are skipped, so a retried batch is not counted twice.
+        """
+        if not orders:
+            return
+        with self._transaction() as conn:
+            inserted = [
+                order for order in orders
+                if conn.execute(
+                    f'INSERT INTO orders ({ORDER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO NOTHING',
+                    (str(order['_id']), order['customer_name'], order['customer_phone'], json.dumps(order['items']),
+                     order['total_amount'], order['status'], _ts(order['created_at']), _ts(order['updated_at'])),
+                ).rowcount
+            ]
+            self._bump_rollups(conn, [
+                (order['created_at'], order['status'], 1, order.get('total_amount') or 0) for order in inserted
+            ])
+
+    def get_orders(self, status=None):
+        """Get orders, optionally filtered by status"""
+        sql = f'SELECT {ORDER_COLUMNS} FROM orders'
+        params = ()
+        if status:
+            sql += ' WHERE status = ?'
+            params = (status,)
+        with self._read() as conn:
+            rows = conn.execute(sql + ' ORDER BY created_at, id', params).fetchall()
+        return [self._order_from_row(row) for row in rows]
+
+    def get_orders_page(self, status=None, page_size=20, page_token=None):
+        """Get one page of orders, newest first, using keyset pagination on (created_at, id)"""
+        where, params = [], []
+        if status:
+            where.append('status = ?')
+            params.append(status)
+        direction = 'next'
+        if page_token:
+            direction, created_at, oid = _decode_page_token(page_token)
+            where.append(f"(created_at, id) {'<' if direction == 'next' else '>'} (?, ?)")
+            params.extend([_ts(created_at), str(oid)])
+
+        order = 'DESC' if direction == 'next' else 'ASC'
+        sql = f'SELECT {ORDER_COLUMNS} FROM orders'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += f' ORDER BY created_at {order}, id {order} LIMIT ?'
+        with self._read() as conn:
+            rows = conn.execute(sql, (*params, page_size + 1)).fetchall()
+        orders = [_list_fields(self._order_from_row(row)) for row in rows]
+        return _orders_page(orders, page_size, direction, page_token)
+
+    def _last_order_change(self):
+        with self._read() as conn:
+            row = conn.execute('SELECT id, updated_at FROM orders ORDER BY updated_at DESC, id DESC LIMIT 1').fetchone()
+        return {'_id': row['id'], 'updated_at': datetime.fromisoformat(row['updated_at'])} if row else None
+
+    def _orders_changed_after(self, after, limit):
+        sql, params = f'SELECT {ORDER_COLUMNS} FROM orders', []
+        if after:
+            updated_at, seen = after
+            sql += f" WHERE updated_at > ? OR (updated_at = ? AND id NOT IN ({', '.join('?' * len(seen))}))"
+            params = [_ts(updated_at), _ts(updated_at), *seen]
+        with self._read() as conn:
+            rows = conn.execute(sql + ' ORDER BY updated_at, id LIMIT ?', (*params, limit)).fetchall()
+        return [_list_fields(self._order_from_row(row), ORDER_FEED_PROJECTION) for row in rows]
+
+    def update_order_status(self, order_id, status):
+        """Update order status"""
+        oid = _order_id(order_id)
+        if oid is None:
+            return
+        with self._transaction() as conn:
+            previous = conn.execute(
+                'SELECT status, created_at, total_amount FROM orders WHERE id = ?', (oid,)
+            ).fetchone()
+            if previous is None:
+                return
+            conn.execute(
+                'UPDATE orders SET status = ?, updated_at = ? WHERE id = ?', (status, _ts(datetime.now()), oid)
+            )
+            if previous['status'] != status:
+                created_at = datetime.fromisoformat(previous['created_at'])
+                amount = previous['total_amount'] or 0
+                self._bump_rollups(conn, [
+                    (created_at, previous['status'], -1, -amount),
+                    (created_at, status, 1, amount),
+                ])
+
+    def get_order_stats(self):
+        """Get order statistics for dashboard (read from the rollups)"""
+        with self._read() as conn:
+            status_rows = conn.execute(
+                'SELECT status, SUM(count) AS count FROM order_rollups GROUP BY status HAVING SUM(count) > 0 '
+                'ORDER BY status'
+            ).fetchall()
+            daily_rows = conn.execute(
+                "SELECT day, revenue, count FROM order_rollups WHERE status = 'completed' AND count > 0 ORDER BY day"
+            ).fetchall()
+        return {
+            'status_stats': [{'_id': row['status'], 'count': row['count']} for row in status_rows],
+            'daily_stats': [{'_id': row['day'], 'revenue': row['revenue'], 'count': row['count']} for row in daily_rows],
+        }
+
+    def bump_token_usage(self, rows, batch_id=None):
+        """Add per-call usage to the (day, customer, purpose, model) rollups in one transaction
+
+        A failed transaction leaves nothing behind, so retries need no batch_id.
+        """
+        if not rows:
+            return
+        with self._transaction() as conn:
+            conn.executemany(
+                f"INSERT INTO token_usage (day, customer, purpose, model, {', '.join(USAGE_FIELDS)}) "
+                f"VALUES (?, ?, ?, ?, {', '.join('?' * len(USAGE_FIELDS))}) "
+                f"ON CONFLICT (day, customer, purpose, model) DO UPDATE SET "
+                + ', '.join(f'{field} = {field} + excluded.{field}' for field in USAGE_FIELDS),
+                [(*key, *(increments.get(field, 0) for field in USAGE_FIELDS)) for key, increments in rows],
+            )
+
+    def get_token_usage_summary(self, days=30):
+        """Token and cost totals for the last `days` days, grouped per day, per customer and per purpose"""
+        totals = ', '.join(f'SUM({field}) AS {field}' for field in USAGE_FIELDS)
+        summary = {}
+        with self._read() as conn:
+            for group in ('day', 'customer', 'purpose', 'model'):
+                rows = conn.execute(
+                    f'SELECT {group} AS _id, {totals} FROM token_usage WHERE day >= ? GROUP BY {group} ORDER BY {group}',
+                    (_usage_since(days),),
+                ).fetchall()
+                summary[group] = [dict(row) for row in rows]
+        return summary
+
+    # Conversations
+
+    def save_conversation(self, customer_name, messages):
+        """Save conversation history for a customer, replacing the stored messages"""
+        now = _ts(datetime.now())
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM messages WHERE customer_name = ?', (customer_name,))
+            conn.executemany(
+                'INSERT INTO messages (customer_name, position, message) VALUES (?, ?, ?)',
+                [(customer_name, position, json.dumps(message)) for position, message in enumerate(messages)],
+            )
+            conn.execute(
+                'INSERT INTO conversations (customer_name, message_count, created_at, updated_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (customer_name) DO UPDATE SET '
+                'message_count = excluded.message_count, updated_at = excluded.updated_at',
+                (customer_name, len(messages), now, now),
+            )
+
+    def append_conversations(self, appends, batch_id=None):
+        """Append messages for many customers ({customer_name: [messages]}) in one transaction
+
+        A failed transaction leaves nothing behind, so retries need no batch_id.
+        """
+        now = _ts(datetime.now())
+        with self._transaction() as conn:
+            for customer_name, messages in appends.items():
+                messages = list(messages)
+                if not messages:
+                    continue
+                row = conn.execute(
+                    'SELECT message_count FROM conversations WHERE customer_name = ?', (customer_name,)
+                ).fetchone()
+                count = row['message_count'] if row else 0
+                conn.execute(
+                    'INSERT INTO conversations (customer_name, message_count, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?) ON CONFLICT (customer_name) DO UPDATE SET '
+                    'message_count = excluded.message_count, updated_at = excluded.updated_at',
+                    (customer_name, count + len(messages), now, now),
+                )
+                conn.executemany(
+                    'INSERT INTO messages (customer_name, position, message) VALUES (?, ?, ?)',
+                    [(customer_name, count + i, json.dumps(message)) for i, message in enumerate(messages)],
+                )
+                if CONVERSATION_OVERFLOW == 'truncate':
+                    conn.execute(
+                        'DELETE FROM messages WHERE customer_name = ? AND position < ?',
+                        (customer_name, count + len(messages) - CONVERSATION_MAX_MESSAGES),
+                    )
+
+    def _messages(self, conn, customer_name, start=0, end=None, last=None):
+        """Messages at positions [start, end), or only the last `last` of them"""
+        sql = 'SELECT message FROM messages WHERE customer_name = ? AND position >= ?'
+        params = [customer_name, start]
+        if end is not None:
+            sql += ' AND position < ?'
+            params.append(end)
+        if last:
+            rows = conn.execute(sql + ' ORDER BY position DESC LIMIT ?', (*params, last)).fetchall()[::-1]
+        else:
+            rows = conn.execute(sql + ' ORDER BY position', params).fetchall()
+        return [json.loads(row['message']) for row in rows]
+
+    def get_conversation(self, customer_name, limit=None):
+        """Get conversation history for a customer, optionally only the most recent limit messages"""
+        with self._read() as conn:
+            return self._messages(conn, customer_name, last=limit)
+
+    def get_conversation_window(self, customer_name, limit=None):
+        """Get the latest messages with their absolute start position and the rolling summary"""
+        with self._read() as conn:
+            conversation = conn.execute(
+                'SELECT message_count, summary, summary_upto FROM conversations WHERE customer_name = ?',
+                (customer_name,),
+            ).fetchone()
+            if conversation is None:
+                return {'messages': [], 'start': 0, 'summary': None, 'summary_upto': 0}
+            messages = self._messages(conn, customer_name, last=limit)
+        return {
+            'messages': messages,
+            'start': conversation['message_count'] - len(messages),
+            'summary': json.loads(conversation['summary']) if conversation['summary'] else None,
+            'summary_upto': conversation['summary_upto'] or 0,
+        }
+
+    def get_conversation_page(self, customer_name, before, limit=30):
+        """Get up to limit messages ending just before absolute position before"""
+        with self._read() as conn:
+            conversation = conn.execute(
+                'SELECT message_count, (SELECT MIN(position) FROM messages WHERE customer_name = ?) AS first '
+                'FROM conversations WHERE customer_name = ?',
+                (customer_name, customer_name),
+            ).fetchone()
+            if conversation is None or before <= 0:
+                return {'messages': [], 'start': 0, 'has_more': False}
+            before = min(before, conversation['message_count'])
+            messages = self._messages(conn, customer_name, max(0, before - limit), before)
+        start = before - len(messages)
+        first = conversation['first'] or 0
+        return {'messages': messages, 'start': start, 'has_more': bool(messages) and start > first}
+
+    def save_conversation_summaries(self, summaries):
+        """Store several rolling summaries ({customer_name: (summary, summary_upto)}) in one transaction"""
+        now = _ts(datetime.now())
+        with self._transaction() as conn:
+            conn.executemany(
+                'UPDATE conversations SET summary = ?, summary_upto = ?, updated_at = ? '
+                'WHERE customer_name = ? AND (summary_upto IS NULL OR summary_upto < ?)',
+                [
+                    (json.dumps(summary), summary_upto, now, customer_name, summary_upto)
+                    for customer_name, (summary, summary_upto) in summaries.items()
+                ],
+            )
+
+    def get_all_customers(self):
+        """Get list of all customers who have conversations"""
+        with self._read() as conn:
+            return [row['customer_name'] for row in conn.execute('SELECT customer_name FROM conversations')]
+
+    def delete_conversation(self, customer_name):
+        """Delete conversation for a customer"""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM messages WHERE customer_name = ?', (customer_name,))
+            conn.execute('DELETE FROM conversations WHERE customer_name = ?', (customer_name,))
+
+
+class MemoryDatabase(RestaurantStore):
+    """Process-local backend holding everything in dicts, for tests and load-test drivers
+
+    Nothing survives a restart. Reads return copies, so callers cannot change stored
+    data by mutating results, just as with the other backends. As in Mongo, conversations
+    and usage rollups keep the IDs of recently applied batches, so retrying a batch is a no-op.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._menu_version = None
+        self._menu_docs = []
+        self._orders = {}
+        self._rollups = {}
+        self._usage = {}
+        self._conversations = {}
+        self.load_menu_data()
+
+    # Menu
+
+    def _stored_menu_version(self):
+        return self._menu_version
+
+    def _has_menu(self):
+        return bool(self._menu_docs)
+
+    def _menu_documents(self):
+        return copy.deepcopy(self._menu_docs)
+
+    def _replace_menu(self, version, documents):
+        documents = copy.deepcopy(documents)
+        with self._lock:
+            self._menu_docs, self._menu_version = documents, version
+
+    # Orders
+
+    def _bump_rollups(self, changes):
+        for created_at, status, count, revenue in changes:
+            rollup = self._rollups.setdefault((created_at.strftime('%Y-%m-%d'), status), {'count': 0, 'revenue': 0})
+            rollup['count'] += count
+            rollup['revenue'] += revenue
+
+    def insert_orders(self, orders):
+        """Insert prepared order documents and update the rollups, skipping orders already stored"""
+        with self._lock:
+            inserted = [order for order in orders if str(order['_id']) not in self._orders]
+            for order in inserted:
+                stored = copy.deepcopy(order)
+                stored['_id'] = str(order['_id'])
+                self._orders[stored['_id']] = stored
+            self._bump_rollups([
+                (order['created_at'], order['status'], 1, order.get('total_amount') or 0) for order in inserted
+            ])
+
+    def _sorted_orders(self, status=None, reverse=False):
+        orders = [order for order in self._orders.values() if not status or order['status'] == status]
+        return sorted(orders, key=lambda order: (order['created_at'], order['_id']), reverse=reverse)
+
+    def get_orders(self, status=None):
+        """Get orders, optionally filtered by status"""
+        with self._lock:
+            return copy.deepcopy(self._sorted_orders(status))
+
+    def get_orders_page(self, status=None, page_size=20, page_token=None):
+        """Get one page of orders, newest first, using keyset pagination on (created_at, _id)"""
+        direction = 'next'
+        with self._lock:
+            orders = self._sorted_orders(status, reverse=True)
+            if page_token:
+                direction, created_at, oid = _decode_page_token(page_token)
+                key = (created_at, str(oid))
+                if direction == 'next':
+                    orders = [order for order in orders if (order['created_at'], order['_id']) < key]
+                else:
+                    orders = [order for order in orders[::-1] if (order['created_at'], order['_id']) > key]
+            orders = [_list_fields(order) for order in copy.deepcopy(orders[:page_size + 1])]
+        return _orders_page(orders, page_size, direction, page_token)
+
+    def _changed_orders(self):
+        return sorted(self._orders.values(), key=lambda order: (order['updated_at'], order['_id']))
+
+    def _last_order_change(self):
+        with self._lock:
+            orders = self._changed_orders()
+            return copy.deepcopy(orders[-1]) if orders else None
+
+    def _orders_changed_after(self, after, limit):
+        with self._lock:
+            orders = [
+                order for order in self._changed_orders()
+                if after is None or order['updated_at'] > after[0]
+                or (order['updated_at'] == after[0] and order['_id'] not in after[1])
+            ]
+            return [_list_fields(order, ORDER_FEED_PROJECTION) for order in copy.deepcopy(orders[:limit])]
+
+    def update_order_status(self, order_id, status):
+        """Update order status"""
+        with self._lock:
+            order = self._orders.get(_order_id(order_id))
+            if order is None:
+                return
+            previous = order['status']
+            order['status'] = status
+            order['updated_at'] = datetime.now()
+            if previous != status:
+                amount = order.get('total_amount') or 0
+                self._bump_rollups([
+                    (order['created_at'], previous, -1, -amount),
+                    (order['created_at'], status, 1, amount),
+                ])
+
+    def get_order_stats(self):
+        """Get order statistics for dashboard (read from the rollups)"""
+        with self._lock:
+            counts = {}
+            for (day, status), rollup in self._rollups.items():
+                counts[status] = counts.get(status, 0) + rollup['count']
+            daily = sorted(
+                (day, rollup) for (day, status), rollup in self._rollups.items()
+                if status == 'completed' and rollup['count'] > 0
+            )
+            return {
+                'status_stats': [{'_id': status, 'count': count} for status, count in sorted(counts.items()) if count > 0],
+                'daily_stats': [{'_id': day, 'revenue': rollup['revenue'], 'count': rollup['count']} for day, rollup in daily],
+            }
+
+    def bump_token_usage(self, rows, batch_id=None):
+        """Add per-call usage to the (day, customer, purpose, model) rollups (batch_id: see RestaurantStore)"""
+        with self._lock:
+            for key, increments in rows:
+                totals = self._usage.setdefault(tuple(key), dict(dict.fromkeys(USAGE_FIELDS, 0), applied_batches=[]))
+                if not _apply_once(totals, batch_id):
+                    continue
+                for field in USAGE_FIELDS:
+                    totals[field] += increments.get(field, 0)
+
+    def get_token_usage_summary(self, days=30):
+        """Token and cost totals for the last `days` days, grouped per day, per customer and per purpose"""
+        since = _usage_since(days)
+        summary = {}
+        with self._lock:
+            for index, group in enumerate(('day', 'customer', 'purpose', 'model')):
+                grouped = {}
+                for key, totals in self._usage.items():
+                    if key[0] < since:
+                        continue
+                    row = grouped.setdefault(key[index], dict.fromkeys(USAGE_FIELDS, 0))
+                    for field in USAGE_FIELDS:
+                        row[field] += totals[field]
+                summary[group] = [{'_id': value, **grouped[value]} for value in sorted(grouped)]
+        return summary
+
+    # Conversations
+
+    def _conversation(self, customer_name):
+        now = datetime.now()
+        return self._conversations.setdefault(customer_name, {
+            'messages': [], 'message_count': 0, 'summary': None, 'summary_upto': None,
+            'created_at': now, 'updated_at': now, 'applied_batches': [],
+        })
+
+    def save_conversation(self, customer_name, messages):
+        """Save conversation history for a customer, replacing the stored messages"""
+        with self._lock:
+            conversation = self._conversation(customer_name)
+            conversation['messages'] = copy.deepcopy(list(messages))
+            conversation['message_count'] = len(messages)
+            conversation['updated_at'] = datetime.now()
+
+    def append_conversations(self, appends, batch_id=None):
+        """Append messages for many customers ({customer_name: [messages]}) (batch_id: see RestaurantStore)"""
+        with self._lock:
+            for customer_name, messages in appends.items():
+                messages = list(messages)
+                if not messages:
+                    continue
+                conversation = self._conversation(customer_name)
+                if not _apply_once(conversation, batch_id):
+                    continue
+                conversation['messages'].extend(copy.deepcopy(messages))
+                conversation['message_count'] += len(messages)
+                conversation['updated_at'] = datetime.now()
+                if CONVERSATION_OVERFLOW == 'truncate':
+                    del conversation['messages'][:-CONVERSATION_MAX_MESSAGES]
+
+    def get_conversation(self, customer_name, limit=None):
+        """Get conversation history for a customer, optionally only the most recent limit messages"""
+        with self._lock:
+            conversation = self._conversations.get(customer_name)
+            if conversation is None:
+                return []
+            return copy.deepcopy(conversation['messages'][-limit:] if limit else conversation['messages'])
+
+    def get_conversation_window(self, customer_name, limit=None):
+        """Get the latest messages with their absolute start position and the rolling summary"""
+        with self._lock:
+            conversation = self._conversations.get(customer_name)
+            if conversation is None:
+                return {'messages': [], 'start': 0, 'summary': None, 'summary_upto': 0}
+            messages = conversation['messages'][-limit:] if limit else conversation['messages']
+            return {
+                'messages': copy.deepcopy(messages),
+                'start': conversation['message_count'] - len(messages),
+                'summary': copy.deepcopy(conversation['summary']),
+                'summary_upto': conversation['summary_upto'] or 0,
+            }
+
+    def get_conversation_page(self, customer_name, before, limit=30):
+        """Get up to limit messages ending just before absolute position before"""
+        with self._lock:
+            conversation = self._conversations.get(customer_name)
+            if conversation is None or before <= 0:
+                return {'messages': [], 'start': 0, 'has_more': False}
+            stored = conversation['messages']
+            first = conversation['message_count'] - len(stored)
+            before = min(before, conversation['message_count'])
+            start = max(first, before - limit)
+            messages = copy.deepcopy(stored[start - first:before - first]) if before > first else []
+        start = before - len(messages)
+        return {'messages': messages, 'start': start, 'has_more': bool(messages) and start > first}
+
+    def save_conversation_summaries(self, summaries):
+        """Store several rolling summaries ({customer_name: (summary, summary_upto)})"""
+        with self._lock:
+            for customer_name, (summary, summary_upto) in summaries.items():
+                conversation = self._conversations.get(customer_name)
+                if conversation is None:
+                    continue
+                if conversation['summary_upto'] is None or conversation['summary_upto'] < summary_upto:
+                    conversation['summary'] = copy.deepcopy(summary)
+                    conversation['summary_upto'] = summary_upto
+                    conversation['updated_at'] = datetime.now()
+
+    def get_all_customers(self):
+        """Get list of all customers who have conversations"""
+        with self._lock:
+            return list(self._conversations)
+
+    def delete_conversation(self, customer_name):
+        """Delete conversation for a customer"""
+        with self._lock:
+            self._conversations.pop(customer_name, None)
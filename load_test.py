@@ -0,0 +1,338 @@
+"""Simulate concurrent customers through the chat turn path against a mock OpenRouter
+
+    python load_test.py --sessions 50 --turns 6 --backend memory --json results.json
+    python load_test.py --sessions 50 --compare results.json
+
+Each session logs in, runs its turns the way main.handle_turn does (menu context,
+streamed reply alongside order extraction, or one combined call, then write-behind
+persistence and summary folding) and checks out if it ordered. Reports p50/p95/p99
+turn latency, throughput, LLM calls per turn, storage calls per turn, the share of
+prompt tokens served from the provider's prefix cache and waiter prompt build time.
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import mock_openrouter
+from prompt_budget import SUMMARY_FOLD_BATCH, fold_into_summary, render_summary, summary_boundary
+
+
+# {item} is filled with a menu item picked per session, so menu context varies the way real traffic does
+PROMPTS = [
+    "Hi there!",
+    "What pizzas do you have?",
+    "Do you deliver to Gulberg?",
+    "I'd like 2 {item} and a large chicken tikka pizza",
+    "What comes in the {item}?",
+    "Add a {item} too please",
+    "How can I pay?",
+    "That's all, please confirm my order",
+]
+# Metrics compared by --compare, with the direction that counts as better
+COMPARED = {
+    "turn_p50": "lower", "turn_p95": "lower", "turn_p99": "lower", "ttft_p50": "lower",
+    "throughput": "higher", "llm_calls_per_turn": "lower", "store_calls_per_turn": "lower",
+    "db_round_trips_per_turn": "lower", "fallback_turns": "lower",
+    "cached_prompt_share": "higher", "prompt_build_p50_us": "lower",
+}
+
+
+def _percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return round(samples[min(len(samples) - 1, int(len(samples) * q))], 4)
+
+
+class CountingStore:
+    """Proxy that counts calls to a storage backend's public methods"""
+
+    # Pure helpers that never touch storage
+    UNCOUNTED = {"new_order_document"}
+
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if name.startswith("_") or name in self.UNCOUNTED or not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            with self._lock:
+                self.calls[name] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+class CommandCounter:
+    """pymongo command listener counting round trips to MongoDB"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        with self._lock:
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class Session:
+    def __init__(self, name):
+        self.name = name
+        self.messages = []
+        self.summary = None
+        self.summary_upto = 0
+        self.current_order = []
+
+
+def run_turn(client, db, writer, session, prompt, extractor, stats):
+    """One customer message, following main.handle_turn"""
+    started = time.perf_counter()
+    session.messages.append({"role": "user", "content": prompt})
+    menu_context = db.get_menu_context(prompt, session.messages)
+    summary = render_summary(session.summary, session.current_order)
+    ttft = None
+    if client.turn_mode == "combined":
+        reply, order_info = client.get_waiter_response_with_order(
+            prompt, menu_context, chat_history=session.messages[session.summary_upto:], summary=summary
+        )
+    else:
+        extract_future = client.submit_order_extraction(prompt)
+        stream = client.get_waiter_response(
+            prompt, menu_context, chat_history=session.messages[session.summary_upto:], stream=True, summary=summary
+        )
+        reply = "".join(stream)
+        ttft = stream.ttft
+        order_info = client.collect_order_info(extract_future)
+    session.messages.append({"role": "assistant", "content": reply})
+
+    writer.append_conversation(session.name, session.messages[-2:])
+    end = summary_boundary(session.messages)
+    if end - session.summary_upto >= SUMMARY_FOLD_BATCH:
+        session.summary = fold_into_summary(session.summary, session.messages[session.summary_upto:end], extractor)
+        writer.save_conversation_summary(session.name, session.summary, end)
+        session.summary_upto = end
+    if order_info["items"] and order_info["is_complete_order"]:
+        session.current_order.extend(order_info["items"])
+
+    elapsed = time.perf_counter() - started
+    with stats["lock"]:
+        stats["turns"].append(elapsed)
+        if ttft is not None:
+            stats["ttft"].append(ttft)
+        if reply in stats["fallback_replies"]:
+            stats["fallbacks"] += 1
+
+
+def run_session(index, args, client, db, writer, extractor, stats, menu_names):
+    session = Session(f"loadtest-{args.run_id}-{index}")
+    rng = random.Random(index)
+    db.get_conversation_window(session.name, limit=30)
+    for turn in range(args.turns):
+        if turn and args.think_time:
+            time.sleep(args.think_time)
+        try:
+            prompt = PROMPTS[(index + turn) % len(PROMPTS)].format(item=rng.choice(menu_names))
+            run_turn(client, db, writer, session, prompt, extractor, stats)
+        except Exception as e:
+            with stats["lock"]:
+                stats["errors"].append(f"{type(e).__name__}: {e}")
+    if session.current_order:
+        writer.create_order(session.name, "03000000000", session.current_order, 0)
+
+
+def open_store(backend):
+    from database import RestaurantDatabase
+    from embedded_database import MemoryDatabase, SQLiteDatabase
+
+    if backend == "memory":
+        return MemoryDatabase()
+    if backend == "sqlite":
+        return SQLiteDatabase(os.environ.get("SQLITE_PATH") or "loadtest.db")
+    return RestaurantDatabase(database_name=os.environ.get("MONGODB_DATABASE") or "restaurant_chatbot_loadtest")
+
+
+def time_prompt_build(client, db, rounds=2000):
+    """Waiter prompt build time in microseconds over a mid-conversation turn: (p50, p95)"""
+    history = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": PROMPTS[i % len(PROMPTS)]} for i in range(12)
+    ]
+    prompt = PROMPTS[3].format(item="garlic bread")
+    menu_context = db.get_menu_context(prompt, history)
+    summary = render_summary({"notes": ["prefers thin crust"], "items": []}, ["Garlic Bread"])
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        client._payload(client._assemble_waiter_messages(prompt, menu_context, history, summary), 0.7)
+        samples.append((time.perf_counter() - started) * 1e6)
+    return _percentile(samples, 0.50), _percentile(samples, 0.95)
+
+
+def run_load_test(args):
+    """Run the scenario and return the results dict"""
+    mock = None
+    base_url = args.openrouter_url
+    if not base_url:
+        mock = mock_openrouter.from_args(args, port=0)
+        base_url = mock.start()
+    os.environ["OPENROUTER_BASE_URL"] = base_url
+    os.environ.setdefault("OPENROUTER_API_KEY", "load-test")
+    os.environ["OPENROUTER_TURN_MODE"] = args.mode
+    if args.max_in_flight:
+        os.environ["OPENROUTER_MAX_IN_FLIGHT"] = str(args.max_in_flight)
+
+    # Imported after the environment is set: these modules read their settings at import time
+    from openrouter_client import FALLBACK_REPLY, OFFLINE_REPLY, OpenRouterClient
+    from order_extractor import MenuOrderExtractor
+    from usage import UsageRecorder
+    from write_behind import WriteBehindQueue
+
+    commands = None
+    if args.backend == "mongo":
+        from pymongo import monitoring
+        commands = CommandCounter()
+        monitoring.register(commands)
+    store = open_store(args.backend)
+    db = CountingStore(store)
+    writer = WriteBehindQueue(db, enabled=not args.sync_writes)
+    client = OpenRouterClient()
+    menu_items = store.get_menu_items()
+    menu_names = [item["name"] for item in menu_items if item.get("name")]
+    extractor = MenuOrderExtractor(menu_items)
+    client.order_extractor = extractor
+    client.usage_recorder = UsageRecorder(writer)
+    llm_calls = Counter()
+    client.session.hooks["response"].append(lambda response, *a, **k: llm_calls.update([response.status_code]))
+
+    stats = {
+        "lock": threading.Lock(), "turns": [], "ttft": [], "errors": [], "fallbacks": 0,
+        "fallback_replies": {FALLBACK_REPLY, OFFLINE_REPLY},
+    }
+    db.calls.clear()
+    commands_before = commands.count if commands else 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions, thread_name_prefix="session") as pool:
+        futures = [
+            pool.submit(run_session, i, args, client, db, writer, extractor, stats, menu_names)
+            for i in range(args.sessions)
+        ]
+        for future in futures:
+            future.result()
+    wall = time.perf_counter() - started
+    writer.flush(timeout=30)
+    writer.close()
+    build_p50, build_p95 = time_prompt_build(client, store)
+    usage = client.usage_recorder.totals
+
+    turns = len(stats["turns"]) or 1
+    results = {
+        "run_at": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "sessions": args.sessions, "turns": args.turns, "mode": args.mode, "backend": args.backend,
+            "latency": args.latency, "token_delay": args.token_delay, "error_rate": args.error_rate,
+            "think_time": args.think_time, "max_in_flight": client.max_in_flight,
+            "write_behind": not args.sync_writes, "openrouter_url": args.openrouter_url,
+        },
+        "turns": len(stats["turns"]),
+        "wall_seconds": round(wall, 3),
+        "throughput": round(len(stats["turns"]) / wall, 3) if wall else None,
+        "turn_mean": round(sum(stats["turns"]) / turns, 4),
+        "turn_p50": _percentile(stats["turns"], 0.50),
+        "turn_p95": _percentile(stats["turns"], 0.95),
+        "turn_p99": _percentile(stats["turns"], 0.99),
+        "turn_max": _percentile(stats["turns"], 1.0),
+        "ttft_p50": _percentile(stats["ttft"], 0.50),
+        "ttft_p95": _percentile(stats["ttft"], 0.95),
+        "llm_calls_per_turn": round(sum(llm_calls.values()) / turns, 3),
+        "llm_statuses": {str(status): count for status, count in sorted(llm_calls.items())},
+        "store_calls_per_turn": round(sum(db.calls.values()) / turns, 3),
+        "store_calls": dict(db.calls.most_common()),
+        "db_round_trips_per_turn": round((commands.count - commands_before) / turns, 3) if commands else None,
+        "cached_prompt_share": round(usage["cached_tokens"] / usage["prompt_tokens"], 3) if usage["prompt_tokens"] else None,
+        "prompt_build_p50_us": build_p50,
+        "prompt_build_p95_us": build_p95,
+        "fallback_turns": stats["fallbacks"],
+        "errors": stats["errors"][:20],
+        "error_count": len(stats["errors"]),
+        "breaker": client.breaker.stats(),
+        "write_behind": writer.stats(),
+        "mock": mock.stats() if mock else None,
+    }
+    if mock:
+        mock.stop()
+    return results
+
+
+def compare(results, baseline):
+    """Print each compared metric next to the baseline with its relative change"""
+    print(f"\n{'metric':26}{'baseline':>12}{'now':>12}{'change':>10}")
+    for metric, better in COMPARED.items():
+        old, new = baseline.get(metric), results.get(metric)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        worse = change > 0 if better == "lower" else change < 0
+        flag = "  worse" if worse and abs(change) >= 10 else ""
+        print(f"{metric:26}{old:>12}{new:>12}{change:>9.1f}%{flag}")
+
+
+def build_parser():
+    parser = mock_openrouter.build_parser()
+    parser.description = __doc__.splitlines()[0]
+    parser.add_argument("--sessions", type=int, default=20, help="concurrent customer sessions")
+    parser.add_argument("--turns", type=int, default=6, help="messages per session")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds between a session's turns")
+    parser.add_argument("--mode", choices=("split", "combined"), default="split")
+    parser.add_argument("--backend", choices=("memory", "sqlite", "mongo"), default="memory")
+    parser.add_argument("--max-in-flight", type=int, default=None)
+    parser.add_argument("--sync-writes", action="store_true", help="bypass the write-behind queue")
+    parser.add_argument("--openrouter-url", default=None, help="use this API base URL instead of a local mock")
+    parser.add_argument("--run-id", default=datetime.now().strftime("%H%M%S"))
+    parser.add_argument("--json", default=None, metavar="PATH", help="write the results here")
+    parser.add_argument("--compare", default=None, metavar="PATH", help="baseline results to compare against")
+    return parser
+
+
+def main(argv):
+    args = build_parser().parse_args(argv)
+    results = run_load_test(args)
+    print(f"{results['turns']} turns from {args.sessions} sessions in {results['wall_seconds']}s "
+          f"({results['throughput']} turns/s)")
+    print(f"turn latency  p50 {results['turn_p50']}s  p95 {results['turn_p95']}s  p99 {results['turn_p99']}s")
+    if results['ttft_p50'] is not None:
+        print(f"first token   p50 {results['ttft_p50']}s  p95 {results['ttft_p95']}s")
+    print(f"LLM calls/turn {results['llm_calls_per_turn']} {results['llm_statuses']}  "
+          f"storage calls/turn {results['store_calls_per_turn']}"
+          + (f"  Mongo round trips/turn {results['db_round_trips_per_turn']}"
+             if results['db_round_trips_per_turn'] is not None else ""))
+    if results['cached_prompt_share'] is not None:
+        print(f"cached prompt share {results['cached_prompt_share']:.1%}  "
+              f"prompt build p50 {results['prompt_build_p50_us']}µs  p95 {results['prompt_build_p95_us']}µs")
+    print(f"fallback replies {results['fallback_turns']}, errors {results['error_count']}, "
+          f"circuit {results['breaker']['state']} (trips {results['breaker']['trips']})")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f))
+    return 1 if results["error_count"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
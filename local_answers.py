@@ -0,0 +1,147 @@
+import json
+import re
+
+from database import build_menu_documents
+from order_extractor import MenuOrderExtractor, normalize_text, tokenize
+
+
+PAYMENT_RE = re.compile(r"\b(pay|paying|payment|payments|card|cards|cash|wallet|wallets|easypaisa|jazzcash)\b")
+DEALS_RE = re.compile(r"\b(deals?|offers?|promos?|promotions?|discounts?|combos?|specials?)\b")
+SERVICES_RE = re.compile(
+    r"\b(deliver|delivery|deliveries|takeaway|take away|pick ?up|dine in|catering|birthday|corporate|"
+    r"franchise|services?)\b"
+)
+MENU_RE = re.compile(r"\b(menu|what do you (?:have|serve|sell)|what can i (?:get|order)|options)\b")
+GREETING_RE = re.compile(r"^(hi|hello|hey|salam|assalam o alaikum|aoa|good (?:morning|afternoon|evening))\b")
+
+# Extra words customers use for a category, mapped to a word from the category's own name
+CATEGORY_SYNONYMS = {"drink": "beverage", "soda": "beverage", "sweet": "dessert", "child": "kid", "children": "kid"}
+# Category-name words too ambiguous to identify a category on their own
+CATEGORY_STOPWORDS = {"and", "chicken", "meal"}
+
+MAX_ITEMS_PER_LIST = 12
+
+
+def _bullets(lines):
+    return "\n".join(f"- {line}" for line in lines)
+
+
+def _item_line(item):
+    name = item.get("name") or item.get("description") or ""
+    description = item.get("description")
+    if item.get("name") and description and description != name:
+        return f"**{name}**: {description}"
+    return f"**{name}**" if item.get("name") else name
+
+
+class LocalAnswerer:
+    """Templated answers built from data.json, used when the LLM is unavailable
+
+    Covers the menu per category, individual items, deals, services, payment
+    methods and simple orders; anything else returns None.
+    """
+
+    def __init__(self, data):
+        self.restaurant = data.get("restaurant", {})
+        self.name = self.restaurant.get("name", "our restaurant")
+        self.payment_methods = data.get("payment_methods", [])
+        self.menu = data.get("menu", {})
+        self.deals = data.get("deals", {})
+        self.extractor = MenuOrderExtractor(
+            [doc for doc in build_menu_documents(data) if doc.get("type") != "restaurant_info"]
+        )
+
+        self._category_words = {}
+        for category in self.menu:
+            for token in tokenize(category):
+                if token not in CATEGORY_STOPWORDS:
+                    self._category_words.setdefault(token, category)
+
+    @classmethod
+    def from_file(cls, path="data.json"):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def _category_in(self, tokens):
+        for token in tokens:
+            token = CATEGORY_SYNONYMS.get(token, token)
+            if token in self._category_words:
+                return self._category_words[token]
+        return None
+
+    def answer(self, message):
+        """Return a templated reply for the message, or None if it needs the LLM"""
+        text = normalize_text(message)
+        if not text:
+            return None
+        extracted = self.extractor.extract(message)
+
+        if extracted["is_complete_order"] and extracted["confidence"] >= self.extractor.min_confidence:
+            return self.order_answer(extracted)
+        if PAYMENT_RE.search(text):
+            return self.payment_answer()
+        if DEALS_RE.search(text):
+            return self.deals_answer()
+        if SERVICES_RE.search(text):
+            return self.services_answer()
+        if extracted["matches"]:
+            return self.items_answer(extracted["matches"])
+
+        category = self._category_in(tokenize(text))
+        if category:
+            return self.category_answer(category)
+        if MENU_RE.search(text):
+            return self.menu_answer()
+        if GREETING_RE.search(text):
+            return f"Hi there! Welcome to {self.name}! 🍕 What can I get started for you today?"
+        return None
+
+    def order_answer(self, extracted):
+        lines = [f"{quantity} × {item}" for item, quantity in zip(extracted["items"], extracted["quantities"])]
+        reply = f"Great choice! I've noted:\n{_bullets(lines)}"
+        if extracted["special_requests"]:
+            reply += f"\n\nSpecial requests: {extracted['special_requests']}"
+        return reply + "\n\nAnything else, or shall I confirm your order?"
+
+    def payment_answer(self):
+        return f"You can pay with:\n{_bullets(self.payment_methods)}\n\nIs there anything I can get for you?"
+
+    def deals_answer(self):
+        sections = []
+        for deal_type, deals in self.deals.items():
+            sections.append(f"**{deal_type}**\n{_bullets(_item_line(deal) for deal in deals)}")
+        return "Here are our current deals:\n\n" + "\n\n".join(sections) + "\n\nWould you like one of these?"
+
+    def services_answer(self):
+        services = self.restaurant.get("services", [])
+        return f"At {self.name} we offer:\n{_bullets(services)}\n\nHow would you like to order today?"
+
+    def items_answer(self, matches):
+        lines = []
+        for match in matches:
+            item = next(i for i in self.extractor.items if i["name"] == match["name"])
+            lines.append(_item_line(item))
+        return f"{_bullets(dict.fromkeys(lines))}\n\nWould you like to order it?"
+
+    def category_answer(self, category):
+        items = self.menu[category]
+        if isinstance(items, dict):
+            sections = [
+                f"**{subcategory}**\n{_bullets(_item_line(item) for item in subitems[:MAX_ITEMS_PER_LIST])}"
+                for subcategory, subitems in items.items()
+            ]
+            body = "\n\n".join(sections)
+        else:
+            body = _bullets(
+                _item_line(item) if isinstance(item, dict) else item for item in items[:MAX_ITEMS_PER_LIST]
+            )
+        return f"Here's our {category} selection:\n\n{body}\n\nWhat would you like?"
+
+    def menu_answer(self):
+        lines = []
+        for category, items in self.menu.items():
+            if isinstance(items, dict):
+                items = [item for subitems in items.values() for item in subitems]
+            examples = [item.get("name") if isinstance(item, dict) else item for item in items[:3]]
+            lines.append(f"**{category}**: {', '.join(examples)}")
+        return f"Our menu has:\n{_bullets(lines)}\n\nWhich of these would you like to hear more about?"
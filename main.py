@@ -1,10 +1,37 @@
 import streamlit as st
+import copy
 import os
-from database import RestaurantDatabase
+import time
+from database import open_database
 from openrouter_client import OpenRouterClient
+from local_answers import LocalAnswerer
+from order_extractor import MenuOrderExtractor
+from prompt_budget import SUMMARY_FOLD_BATCH, empty_summary, fold_into_summary, render_summary, summary_boundary
+from response_cache import ResponseCache
+from session_store import SessionStore
+from tracing import start_metrics_server, tracer
+from usage import UsageRecorder, attribute_usage
+from write_behind import WriteBehindQueue
 import json
 
 
+ORDERS_PAGE_SIZE = 20
+# Seconds between order feed polls while the Orders page is open, and between full reloads
+ORDER_BOARD_POLL_SECONDS = 5
+ORDER_BOARD_RELOAD_SECONDS = 300
+# Recent messages rendered as chat bubbles and kept in session_state
+HISTORY_WINDOW = 30
+# Older messages fetched per "Load older messages" click
+HISTORY_PAGE_SIZE = 30
+
+
+# session_state keys kept in the shared session store so any replica can serve the next run
+SHARED_SESSION_KEYS = (
+    'authenticated', 'customer_name', 'messages', 'current_order',
+    'conversation_summary', 'summary_upto', 'history_offset',
+)
+
+
 def normalize_username(name: str) -> str:
     return " ".join((name or "").strip().lower().split())
 
@@ -19,23 +46,71 @@ if 'customer_name' not in st.session_state:
     st.session_state.customer_name = ""
 if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
+if 'history_offset' not in st.session_state:
+    st.session_state.history_offset = 0
+if 'conversation_summary' not in st.session_state:
+    st.session_state.conversation_summary = empty_summary()
+if 'summary_upto' not in st.session_state:
+    st.session_state.summary_upto = 0
+if 'history_pages' not in st.session_state:
+    st.session_state.history_pages = []
+if 'history_anchor' not in st.session_state:
+    st.session_state.history_anchor = None
 
 # Initialize database and AI client
 @st.cache_resource
 def init_database():
-    return RestaurantDatabase()
+    return open_database()
 
 @st.cache_resource
 def init_ai_client():
     return OpenRouterClient()
 
+@st.cache_resource(max_entries=1)
+def init_order_extractor(_db, menu_version):
+    return MenuOrderExtractor(_db.get_menu_items())
+
+@st.cache_resource
+def init_local_answers():
+    return LocalAnswerer.from_file('data.json')
+
+@st.cache_resource
+def init_writer(_db):
+    return WriteBehindQueue.from_settings(_db)
+
+@st.cache_resource
+def init_usage_recorder(_writer):
+    return UsageRecorder(_writer)
+
+@st.cache_resource
+def init_metrics_server():
+    return start_metrics_server() if tracer.enabled else None
+
+@st.cache_resource
+def init_response_cache(_db):
+    return ResponseCache.from_settings(_db.response_cache_collection, version_fn=_db.get_menu_version)
+
+@st.cache_resource
+def init_session_store(_db):
+    return SessionStore.from_settings(_db.sessions_collection)
+
 try:
     db = init_database()
+    writer = init_writer(db)
+    sessions = init_session_store(db)
 except Exception as e:
     db = None
+    writer = None
+    sessions = None
     db_init_error = e
 
 ai_client = init_ai_client()
+init_metrics_server()
+ai_client.local_answers = init_local_answers()
+if db is not None:
+    ai_client.order_extractor = init_order_extractor(db, db.get_menu_version())
+    ai_client.response_cache = init_response_cache(db)
+    ai_client.usage_recorder = init_usage_recorder(writer)
 
 
 def login_page():
@@ -43,7 +118,7 @@ def login_page():
     st.subheader("Welcome! Please enter your name")
 
     if db is None:
-        st.error("Database is not connected. Please set MONGODB_URI in Streamlit Secrets (or .env locally).")
+        st.error("Database is not connected. Check MONGODB_URI and STORAGE_BACKEND in Streamlit Secrets (or .env locally).")
         st.code(str(db_init_error))
         st.stop()
     
@@ -54,12 +129,59 @@ def login_page():
         if username_key:
             st.session_state.customer_name = username_key
             st.session_state.authenticated = True
-            # Load existing conversation
-            st.session_state.messages = db.get_conversation(username_key)
+            if sessions is not None and not st.query_params.get("session"):
+                # The token in the URL lets any replica (or a reloaded tab) pick this session up
+                st.query_params["session"] = SessionStore.new_token()
+            # Load existing conversation, including any writes still queued from a previous session
+            writer.flush()
+            window = db.get_conversation_window(username_key, limit=HISTORY_WINDOW)
+            st.session_state.messages = window['messages']
+            st.session_state.history_offset = window['start']
+            st.session_state.conversation_summary = window['summary'] or empty_summary()
+            st.session_state.summary_upto = window['summary_upto']
+            reset_history_view()
             st.rerun()
 
 
 
+def restore_session():
+    """Adopt the shared session state if it changed since this replica last saw it"""
+    token = st.query_params.get("session")
+    if sessions is None or not token:
+        return
+    loaded = sessions.load(token)
+    if loaded is None or loaded[0] == st.session_state.get('session_version'):
+        return
+    version, state = loaded
+    for key in SHARED_SESSION_KEYS:
+        if key in state:
+            st.session_state[key] = state[key]
+    st.session_state.session_version = version
+    # A separate copy: handle_turn appends to the live lists in place
+    st.session_state.session_saved = copy.deepcopy(state)
+    reset_history_view()
+
+
+def persist_session():
+    """Write the shared keys this run changed, merged with anything changed elsewhere meanwhile"""
+    token = st.query_params.get("session")
+    if sessions is None or not token:
+        return
+    saved = st.session_state.get('session_saved') or {}
+    changes = {
+        key: st.session_state[key] for key in SHARED_SESSION_KEYS
+        if key not in saved or saved[key] != st.session_state[key]
+    }
+    if not changes:
+        return
+    try:
+        version, state = sessions.save(token, changes, base=saved)
+    except Exception as e:
+        print(f"Failed to save session state: {e}")
+        return
+    st.session_state.session_version = version
+    st.session_state.session_saved = state
+
 
 def main():
     if db is None:
@@ -69,7 +191,7 @@ def main():
             layout="wide"
         )
         st.title("🍕 Broadway Pizza")
-        st.error("Database is not connected. Please set MONGODB_URI in Streamlit Secrets (or .env locally).")
+        st.error("Database is not connected. Check MONGODB_URI and STORAGE_BACKEND in Streamlit Secrets (or .env locally).")
         st.code(str(db_init_error))
         st.stop()
 
@@ -94,9 +216,15 @@ def main():
             st.session_state.authenticated = False
             st.session_state.customer_name = ""
             st.session_state.messages = []
+            st.session_state.history_offset = 0
+            st.session_state.conversation_summary = empty_summary()
+            st.session_state.summary_upto = 0
+            reset_history_view()
             if "login_name" in st.session_state:
                 st.session_state.login_name = ""
             st.rerun()
+        if tracer.enabled and st.checkbox("🐞 Debug timings"):
+            show_debug_panel()
     
     if page == "Chatbot":
         chatbot_page()
@@ -109,54 +237,169 @@ def main():
 
 
 
+@st.cache_data(ttl=3600, max_entries=500, show_spinner=False)
+def load_history_block(customer_name, before, limit):
+    """One page of older messages, fetched once and pre-rendered as a single markdown block"""
+    page = db.get_conversation_page(customer_name, before, limit)
+    lines = [
+        f"**{'You' if message.get('role') == 'user' else 'Paulo'}:** {message.get('content', '')}"
+        for message in page['messages']
+    ]
+    return {'start': page['start'], 'has_more': page['has_more'], 'markdown': "\n\n".join(lines)}
+
+def reset_history_view():
+    st.session_state.history_pages = []
+    st.session_state.history_anchor = None
+
+def show_chat_history():
+    """Render the recent window as chat bubbles and any loaded older pages as static blocks"""
+    messages = st.session_state.messages
+    offset = st.session_state.history_offset
+    render_from = st.session_state.history_anchor
+    if render_from is None:
+        render_from = offset + max(0, len(messages) - HISTORY_WINDOW)
+
+    blocks = [
+        load_history_block(st.session_state.customer_name, before, HISTORY_PAGE_SIZE)
+        for before in st.session_state.history_pages
+    ]
+    has_more = blocks[-1]['has_more'] if blocks else render_from > 0
+    if has_more and st.button("⬆️ Load older messages"):
+        # Older pages are read from the database, so queued writes must land first
+        writer.flush()
+        st.session_state.history_anchor = render_from
+        st.session_state.history_pages.append(blocks[-1]['start'] if blocks else render_from)
+        st.rerun()
+    for block in reversed(blocks):
+        st.markdown(block['markdown'])
+    if blocks:
+        st.divider()
+
+    for message in messages[max(0, render_from - offset):]:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+def trim_session_history():
+    """Drop already-summarized messages beyond the render window from session_state
+
+    They stay in the database and can be paged back in with "Load older messages".
+    """
+    messages = st.session_state.messages
+    offset = st.session_state.history_offset
+    keep_from = min(offset + len(messages) - HISTORY_WINDOW, st.session_state.summary_upto)
+    if st.session_state.history_anchor is not None:
+        keep_from = min(keep_from, st.session_state.history_anchor)
+    drop = keep_from - offset
+    if drop > 0:
+        st.session_state.messages = messages[drop:]
+        st.session_state.history_offset += drop
+
 def chatbot_page():
     st.header("🤖 Chat with Paulo")
     
     # Display chat messages
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+    show_chat_history()
     
     # Chat input
     if prompt := st.chat_input("What would you like to order?"):
-        # Add user message
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.markdown(prompt)
-        
-        # Get AI response
-        with st.chat_message("assistant"):
-            menu_context = get_menu_context()
-            response = ai_client.get_waiter_response(
+        with tracer.turn(), attribute_usage(st.session_state.customer_name):
+            handle_turn(prompt)
+
+def handle_turn(prompt):
+    """Answer one customer message: reply, persistence and order extraction"""
+    # Add user message
+    st.session_state.messages.append({"role": "user", "content": prompt})
+    with st.chat_message("user"):
+        st.markdown(prompt)
+    
+    # Get AI response
+    with st.chat_message("assistant"):
+        menu_context = get_menu_context(prompt)
+        summary = render_summary(st.session_state.conversation_summary, st.session_state.current_order)
+        if ai_client.turn_mode == "combined":
+            # One completion returns both the reply and the parsed order
+            response, order_info = ai_client.get_waiter_response_with_order(
                 prompt,
                 menu_context,
-                chat_history=st.session_state.messages,
+                chat_history=unsummarized_history(),
+                summary=summary,
             )
             st.markdown(response)
-            
-            # Check if user is trying to place an order
-            order_info = ai_client.extract_order_info(prompt)
-            if order_info['items'] and order_info['is_complete_order']:
-                st.session_state.current_order.extend(order_info['items'])
-                show_order_summary()
-        
-        # Add assistant message
-        st.session_state.messages.append({"role": "assistant", "content": response})
-        
-        # Save conversation to database after AI response
-        if st.session_state.customer_name:
-            db.save_conversation(st.session_state.customer_name, st.session_state.messages)
+            extract_future = None
+        else:
+            # Order extraction runs alongside the streamed reply
+            extract_future = ai_client.submit_order_extraction(prompt)
+            reply_stream = ai_client.get_waiter_response(
+                prompt,
+                menu_context,
+                chat_history=unsummarized_history(),
+                stream=True,
+                summary=summary,
+            )
+            st.write_stream(reply_stream)
+            response = reply_stream.text
+    
+    # Add assistant message
+    st.session_state.messages.append({"role": "assistant", "content": response})
+    
+    # Save the new user/assistant pair to the database after AI response
+    if st.session_state.customer_name:
+        with tracer.span("save_conversation"):
+            writer.append_conversation(st.session_state.customer_name, st.session_state.messages[-2:])
+            update_conversation_summary()
+        trim_session_history()
+
+    # Check if user is trying to place an order
+    if extract_future is not None:
+        with tracer.span("order_wait"):
+            order_info = ai_client.collect_order_info(extract_future)
+    if order_info['items'] and order_info['is_complete_order']:
+        st.session_state.current_order.extend(order_info['items'])
+        show_order_summary()
+
+
 
 
+def show_debug_panel():
+    """Stage timings of the last turn and aggregates since start (sidebar, TRACING=on only)"""
+    turns = tracer.recent_turns()
+    if turns:
+        st.caption(f"Last turn {turns[-1]['turn_id']}")
+        for name, seconds in turns[-1]['spans']:
+            st.write(f"{name}: {seconds * 1000:.1f} ms")
+    summary = tracer.stage_summary()
+    if summary:
+        import pandas as pd
+        st.caption("All turns (p50/p95 are histogram bucket bounds, seconds)")
+        st.dataframe(pd.DataFrame.from_dict(summary, orient='index'))
 
+def unsummarized_history():
+    """The loaded messages not yet folded into the summary, which the prompt carries verbatim"""
+    skip = st.session_state.summary_upto - st.session_state.history_offset
+    return st.session_state.messages[max(0, skip):]
+
+def update_conversation_summary():
+    """Fold messages that have left the verbatim window into the stored rolling summary"""
+    messages = st.session_state.messages
+    offset = st.session_state.history_offset
+    start = max(st.session_state.summary_upto, offset)
+    end = offset + summary_boundary(messages)
+    if end - start < SUMMARY_FOLD_BATCH:
+        return
+
+    summary = fold_into_summary(
+        st.session_state.conversation_summary,
+        messages[start - offset:end - offset],
+        ai_client.order_extractor,
+    )
+    writer.save_conversation_summary(st.session_state.customer_name, summary, end)
+    st.session_state.conversation_summary = summary
+    st.session_state.summary_upto = end
 
-def get_menu_context():
+def get_menu_context(prompt=None):
     """Get menu context for AI"""
-    menu_items = db.get_menu_items()
-    context = "Available menu items:\n"
-    for item in menu_items[:10]:  # Limit to first 10 items
-        context += f"- {item.get('name', 'Unknown')}: {item.get('description', 'No description')}\n"
-    return context
+    with tracer.span("menu_context"):
+        return db.get_menu_context(prompt, st.session_state.messages)
 
 def show_order_summary():
     """Show current order summary"""
@@ -179,12 +422,14 @@ def show_customer_form():
     if st.button("Place Order"):
         if name and phone:
             # Create order in database
-            order_id = db.create_order(
+            order_id = writer.create_order(
                 name, phone, st.session_state.current_order, 0  # Calculate total
             )
             st.success(f"Order placed successfully! Order ID: {order_id}")
             st.session_state.current_order = []
+            st.session_state.history_offset += len(st.session_state.messages)
             st.session_state.messages = []
+            reset_history_view()
         else:
             st.error("Please fill in name and phone number")
 
@@ -209,6 +454,56 @@ def dashboard_page():
             df = pd.DataFrame(stats['daily_stats'])
             st.line_chart(df.set_index('_id')['revenue'])
 
+    with st.expander("💾 Write-behind queue"):
+        queue_stats = writer.stats()
+        st.write(f"Depth: {queue_stats['depth']} (max {queue_stats['max_depth']}), "
+                 f"batches: {queue_stats['batches']}, coalesced writes: {queue_stats['coalesced']}, "
+                 f"full-queue waits: {queue_stats['backpressure_waits']}, errors: {queue_stats['errors']}")
+        if queue_stats['flush_p50'] is not None:
+            st.write(f"Flush latency p50 {queue_stats['flush_p50'] * 1000:.0f} ms, "
+                     f"p95 {queue_stats['flush_p95'] * 1000:.0f} ms")
+
+    routing = ai_client.router.snapshot()
+    with st.expander("🔀 Model routing"):
+        breaker = ai_client.breaker.stats()
+        st.write(f"OpenRouter circuit: **{breaker['state']}** "
+                 f"(trips: {breaker['trips']}, fast-failed calls: {breaker['rejected']})")
+        if routing['models']:
+            import pandas as pd
+            st.dataframe(pd.DataFrame(routing['models']), hide_index=True)
+            st.caption("Latency is time to first chunk for the stream task and full completion time otherwise.")
+            st.dataframe(pd.DataFrame(routing['decisions'][::-1]), hide_index=True)
+        else:
+            st.write("No model calls yet in this process.")
+
+    with st.expander("🔢 Token usage (last 30 days)"):
+        show_token_usage()
+
+def show_token_usage():
+    """Tokens and estimated cost per day, per customer and per call type"""
+    usage = db.get_token_usage_summary(days=30)
+    if not usage['day']:
+        st.write("No token usage recorded yet.")
+        return
+    import pandas as pd
+    columns = ['calls', 'prompt_tokens', 'completion_tokens', 'cached_tokens', 'cost']
+    daily = pd.DataFrame(usage['day']).set_index('_id')
+    total_cost = daily['cost'].sum()
+    total_tokens = int(daily['prompt_tokens'].sum() + daily['completion_tokens'].sum())
+    prompt_tokens = daily['prompt_tokens'].sum()
+    cached_share = daily['cached_tokens'].sum() / prompt_tokens if prompt_tokens else 0
+    st.write(f"**{total_tokens:,}** tokens, estimated cost **${total_cost:.4f}**, "
+             f"**{cached_share:.0%}** of prompt tokens served from the provider's prompt cache")
+    st.bar_chart(daily[['prompt_tokens', 'completion_tokens']])
+    for title, key in (("Per day", 'day'), ("Per customer", 'customer'), ("Per call type", 'purpose'),
+                       ("Per model", 'model')):
+        st.subheader(title)
+        df = pd.DataFrame(usage[key]).rename(columns={'_id': key})
+        df['cache_hit_%'] = (100 * df['cached_tokens'] / df['prompt_tokens'].where(df['prompt_tokens'] > 0)).round(1)
+        if key == 'customer':
+            df = df.sort_values('cost', ascending=False)
+        st.dataframe(df[[key] + columns + ['cache_hit_%']], hide_index=True)
+
 def menu_page():
     st.header("📋 Menu")
     
@@ -236,14 +531,67 @@ def orders_page():
     
     # Filter by status
     status_filter = st.selectbox("Filter by Status", ["All", "pending", "completed", "cancelled"])
-    
-    if status_filter == "All":
-        orders = db.get_orders()
-    else:
-        orders = db.get_orders(status_filter)
+    if st.session_state.get('orders_filter') != status_filter:
+        st.session_state.orders_filter = status_filter
+        st.session_state.orders_page_token = None
+
+    order_board(None if status_filter == "All" else status_filter)
+
+
+def load_order_board(status, page_token):
+    """Read one page of orders in full, with the feed position to patch it from"""
+    # Position first, so changes made while the page is read are replayed rather than lost
+    token = db.get_order_changes()['token']
+    page = db.get_orders_page(status, page_size=ORDERS_PAGE_SIZE, page_token=page_token)
+    return {
+        'key': (status, page_token),
+        'orders': {order['_id']: order for order in page['orders']},
+        'next_token': page['next_token'],
+        'prev_token': page['prev_token'],
+        'token': token,
+        'loaded_at': time.monotonic(),
+    }
+
+
+def patch_order_board(board):
+    """Apply the orders changed since the board's feed position; False if it must be reloaded"""
+    status, page_token = board['key']
+    while True:
+        changes = db.get_order_changes(board['token'])
+        if changes['reset']:
+            return False
+        for order in changes['orders']:
+            listed = order['_id'] in board['orders']
+            if status is None or order['status'] == status:
+                # Orders new to the board only join the newest page; older pages just update
+                if listed or page_token is None:
+                    board['orders'][order['_id']] = order
+            elif listed:
+                del board['orders'][order['_id']]
+        board['token'] = changes['token']
+        if not changes['more']:
+            return True
+
+
+@st.fragment(run_every=ORDER_BOARD_POLL_SECONDS)
+def order_board(status):
+    """Orders list kept in session_state and patched from the order feed every few seconds"""
+    board = st.session_state.get('order_board')
+    page_token = st.session_state.get('orders_page_token')
+    if (board is None or board['key'] != (status, page_token)
+            or time.monotonic() - board['loaded_at'] > ORDER_BOARD_RELOAD_SECONDS
+            or not patch_order_board(board)):
+        board = load_order_board(status, page_token)
+        st.session_state.order_board = board
+
+    orders = sorted(board['orders'].values(), key=lambda order: (order['created_at'], order['_id']), reverse=True)
+    # Status changes still in the write-behind queue
+    pending_statuses = writer.pending_order_statuses()
     
     if orders:
         for order in orders:
+            if str(order.get('_id')) in pending_statuses:
+                order = dict(order, status=pending_statuses[str(order.get('_id'))])
             with st.expander(f"Order for {order.get('customer_name', 'Unknown')} - {order.get('status', 'Unknown')}"):
                 st.write(f"**Phone:** {order.get('customer_phone', 'N/A')}")
                 st.write(f"**Items:** {', '.join(order.get('items', []))}")
@@ -253,10 +601,24 @@ def orders_page():
                 # Update status buttons
                 if order.get('status') != 'completed':
                     if st.button(f"Mark as Complete", key=f"complete_{order.get('_id')}"):
-                        db.update_order_status(order.get('_id'), 'completed')
+                        writer.update_order_status(order.get('_id'), 'completed')
                         st.rerun()
+
+        newer, older = st.columns(2)
+        with newer:
+            if board['prev_token'] and st.button("← Newer orders"):
+                st.session_state.orders_page_token = board['prev_token']
+                st.rerun()
+        with older:
+            if board['next_token'] and st.button("Older orders →"):
+                st.session_state.orders_page_token = board['next_token']
+                st.rerun()
     else:
         st.write("No orders found")
 
 if __name__ == "__main__":
-    main()
+    restore_session()
+    try:
+        main()
+    finally:
+        persist_session()
@@ -0,0 +1,142 @@
+import math
+from difflib import get_close_matches
+
+from order_extractor import tokenize
+from prompt_budget import estimate_tokens
+
+
+STOPWORDS = {
+    "a", "an", "and", "the", "of", "with", "to", "for", "in", "on", "or", "is", "are", "it",
+    "i", "you", "me", "my", "we", "do", "what", "have", "some", "can", "get", "want", "please",
+    "e", "g", "any", "your", "there", "that", "this", "be", "like", "would", "will",
+}
+
+# Weight of words from earlier user turns relative to the current message
+HISTORY_WEIGHT = 0.5
+
+# Items scoring below this fraction of the best match are left out of the prompt
+MIN_RELATIVE_SCORE = 0.3
+
+TYPO_CACHE_SIZE = 5000
+_MISSING = object()
+
+# First line of the whole-menu context; prompts recognise that block as static by it
+FULL_MENU_HEADING = "Full menu:\n"
+
+
+def _terms(text):
+    return [token for token in tokenize(text) if token not in STOPWORDS]
+
+
+def format_menu_line(item):
+    name = item.get('name') or item.get('subcategory') or 'Unknown'
+    description = item.get('description') or ''
+    label = item.get('category') or ''
+    if item.get('category') == 'deals':
+        label = f"deal, {item.get('subcategory')}" if item.get('name') else 'deal'
+    line = f"- {name}"
+    if label:
+        line += f" ({label})"
+    if description and description != name:
+        line += f": {description}"
+    return line + "\n"
+
+
+class MenuIndex:
+    """BM25 index over menu items and deals for picking prompt context"""
+
+    def __init__(self, items, k1=1.2, b=0.75):
+        self.items = list(items)
+        self.k1 = k1
+        self.b = b
+        self.lines = [format_menu_line(item) for item in self.items]
+        self.categories = list(dict.fromkeys(item.get('category') for item in self.items if item.get('category')))
+
+        self._postings = {}
+        self._lengths = []
+        for doc_id, item in enumerate(self.items):
+            name_terms = _terms(item.get('name') or '')
+            terms = name_terms * 2 + _terms(item.get('description') or '')
+            terms += _terms(item.get('category') or '') + _terms(item.get('subcategory') or '')
+            self._lengths.append(len(terms) or 1)
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, tf in counts.items():
+                self._postings.setdefault(term, []).append((doc_id, tf))
+
+        total = len(self.items)
+        self._avg_length = sum(self._lengths) / total if total else 1.0
+        self._idf = {
+            term: math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+        self._vocabulary = list(self._postings)
+        self._typo_map = {}
+
+    def _resolve(self, term):
+        if term in self._postings:
+            return term
+        # One lookup: another thread may clear the map between a membership test and a read
+        resolved = self._typo_map.get(term, _MISSING)
+        if resolved is _MISSING:
+            if len(self._typo_map) >= TYPO_CACHE_SIZE:
+                self._typo_map.clear()
+            close = get_close_matches(term, self._vocabulary, n=1, cutoff=0.8) if len(term) > 3 else []
+            resolved = self._typo_map[term] = close[0] if close else None
+        return resolved
+
+    def search(self, query, history=None, limit=None):
+        """Return [(score, item_index)] for items relevant to the query, best first"""
+        weights = {}
+        for term in _terms(query):
+            weights[term] = weights.get(term, 0.0) + 1.0
+        for text in history or []:
+            for term in _terms(text):
+                weights[term] = weights.get(term, 0.0) + HISTORY_WEIGHT
+
+        scores = {}
+        for raw_term, weight in weights.items():
+            term = self._resolve(raw_term)
+            if term is None:
+                continue
+            idf = self._idf[term]
+            for doc_id, tf in self._postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[doc_id] / self._avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight * idf * tf * (self.k1 + 1) / (tf + norm)
+
+        ranked = sorted(((score, doc_id) for doc_id, score in scores.items()), reverse=True)
+        if ranked:
+            floor = ranked[0][0] * MIN_RELATIVE_SCORE
+            ranked = [(score, doc_id) for score, doc_id in ranked if score >= floor]
+        return ranked[:limit] if limit else ranked
+
+    def build_full_context(self):
+        """The whole menu as one block, identical for every query"""
+        return f"{FULL_MENU_HEADING}Menu categories: {', '.join(self.categories)}\n" + "".join(self.lines)
+
+    def build_context(self, query, history=None, token_budget=400):
+        """Build a menu context block of the most relevant items within token_budget"""
+        ranked = [doc_id for _, doc_id in self.search(query, history)]
+        if ranked:
+            heading = "Menu items relevant to this conversation:\n"
+        else:
+            # Nothing specific asked about: show the first item of every category instead
+            seen, ranked = set(), []
+            for doc_id, item in enumerate(self.items):
+                if item.get('category') not in seen:
+                    seen.add(item.get('category'))
+                    ranked.append(doc_id)
+            heading = "A few items from the menu:\n"
+
+        context = f"Menu categories: {', '.join(self.categories)}\n{heading}"
+        used = estimate_tokens(context)
+
+        for doc_id in ranked:
+            line = self.lines[doc_id]
+            cost = estimate_tokens(line)
+            if used + cost > token_budget:
+                break
+            context += line
+            used += cost
+        return context
@@ -0,0 +1,288 @@
+"""Local stand-in for the OpenRouter chat completions API, for load tests and offline runs
+
+    python mock_openrouter.py --port 8765 --latency lognormal:0.8:0.4 --error-rate 0.02
+
+then start the app with OPENROUTER_BASE_URL=http://127.0.0.1:8765/api/v1. Answers
+JSON and SSE streaming requests with canned replies, sleeping for a sampled latency
+(the whole response, or the time to the first chunk when streaming) and failing a
+share of requests with 429/5xx. Like providers with prompt caching, it reports the
+leading part of each prompt it has already seen for the model as cached tokens.
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+WAITER_REPLY = (
+    "Great choice! Our Broadway Pizza menu has classic and signature pizzas, wings, pastas and "
+    "desserts. Would you like a large pizza with garlic bread, or shall I tell you about today's deals?"
+)
+EMPTY_ORDER = {"items": [], "quantities": [], "special_requests": "", "is_complete_order": False}
+# Prompt prefixes are cached in blocks of this many characters (about 64 tokens)
+CACHE_BLOCK_CHARS = 256
+# Shortest prefix providers cache (in tokens, at ~4 characters per token)
+CACHE_MIN_TOKENS = 1024
+# Prefix hashes remembered per model before the cache is emptied
+CACHE_MAX_BLOCKS = 200_000
+
+
+def _text(message):
+    """Text of a message whose content is a string or a list of content parts"""
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "".join(part.get("text") or "" for part in content)
+    return content
+
+
+class Latency:
+    """Latency distribution parsed from "fixed:S", "uniform:LO:HI", "normal:MEAN:SD" or "lognormal:MEDIAN:SIGMA" """
+
+    def __init__(self, spec="fixed:0"):
+        kind, *params = spec.split(":")
+        params = [float(param) for param in params]
+        samplers = {
+            "fixed": lambda rng: params[0],
+            "uniform": lambda rng: rng.uniform(params[0], params[1]),
+            "normal": lambda rng: rng.gauss(params[0], params[1]),
+            "lognormal": lambda rng: params[0] * rng.lognormvariate(0, params[1]),
+        }
+        if kind not in samplers:
+            raise ValueError(f"Unknown latency distribution {spec!r}")
+        self.spec = spec
+        self._sample = samplers[kind]
+
+    def sample(self, rng):
+        return max(0.0, self._sample(rng))
+
+
+class MockOpenRouter:
+    """Threaded HTTP server answering POST /api/v1/chat/completions
+
+    latency and model_latency ({model: Latency}) set the delay before the response
+    (or its first SSE chunk); token_delay spaces the streamed chunks. error_rate of
+    the requests fail with a status from error_statuses, 429s with a Retry-After.
+    With prefix_cache, leading blocks of the prompt seen before for the same model
+    count as cached once at least cache_min_tokens long.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=None, model_latency=None, token_delay=0.0,
+                 error_rate=0.0, error_statuses=(429, 503), retry_after=1, reply=WAITER_REPLY, seed=None,
+                 prefix_cache=True, cache_min_tokens=CACHE_MIN_TOKENS):
+        self.latency = latency or Latency()
+        self.model_latency = model_latency or {}
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.retry_after = retry_after
+        self.reply = reply
+        self.prefix_cache = prefix_cache
+        self.cache_min_tokens = cache_min_tokens
+        self._prefixes = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.streamed = 0
+        self.statuses = Counter()
+        self.models = Counter()
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                if self.path.rstrip("/") != "/api/v1/chat/completions":
+                    self._send_json(404, {"error": {"message": "not found"}})
+                    return
+                mock._handle(self, body)
+
+            def _send_json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="mock-openrouter", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "streamed": self.streamed,
+                "statuses": dict(self.statuses),
+                "models": dict(self.models),
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+            }
+
+    def _content_for(self, body):
+        """Canned content shaped like what the client asked for"""
+        messages = body.get("messages") or []
+        if (body.get("response_format") or {}).get("type") == "json_object":
+            return json.dumps({"reply": self.reply, "order": EMPTY_ORDER})
+        if messages and _text(messages[0]).startswith("You are an order extraction assistant"):
+            return json.dumps(EMPTY_ORDER)
+        return self.reply
+
+    def _cached_chars(self, model, prompt):
+        """Length of the longest block-aligned prefix of prompt seen before for model, remembering this one"""
+        if not self.prefix_cache:
+            return 0
+        digest = hashlib.sha1()
+        cached, hit = 0, True
+        with self._lock:
+            seen = self._prefixes.setdefault(model, set())
+            if len(seen) > CACHE_MAX_BLOCKS:
+                seen.clear()
+            for end in range(CACHE_BLOCK_CHARS, len(prompt) + 1, CACHE_BLOCK_CHARS):
+                digest.update(prompt[end - CACHE_BLOCK_CHARS:end].encode("utf-8"))
+                key = digest.digest()
+                if hit and key in seen:
+                    cached = end
+                else:
+                    hit = False
+                    seen.add(key)
+        return cached if cached // 4 >= self.cache_min_tokens else 0
+
+    def _usage(self, body, content):
+        prompt = "".join(f"{message.get('role')}\n{_text(message)}\n" for message in body.get("messages") or [])
+        prompt_tokens = len(prompt) // 4
+        cached_tokens = self._cached_chars(body.get("model", ""), prompt) // 4
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": prompt_tokens + len(content) // 4,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            "cost": 0,
+        }
+
+    def _handle(self, handler, body):
+        model = body.get("model", "")
+        with self._lock:
+            self.requests += 1
+            self.models[model] += 1
+            fail = self.error_rate and self._rng.random() < self.error_rate
+            status = self._rng.choice(self.error_statuses) if fail else 200
+            delay = self.model_latency.get(model, self.latency).sample(self._rng)
+            self.statuses[status] += 1
+        time.sleep(delay)
+
+        if status != 200:
+            headers = {"Retry-After": str(self.retry_after)} if status == 429 else {}
+            handler._send_json(status, {"error": {"code": status, "message": "injected failure"}}, headers)
+            return
+
+        content = self._content_for(body)
+        usage = self._usage(body, content)
+        if not body.get("stream"):
+            handler._send_json(200, {
+                "id": "gen-mock", "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        with self._lock:
+            self.streamed += 1
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        handler.close_connection = True
+        events = [": OPENROUTER PROCESSING"]
+        events += [
+            "data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": word}}]})
+            for word in content.replace(" ", " \0").split("\0")
+        ]
+        events.append("data: " + json.dumps({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                                             "usage": usage}))
+        events.append("data: [DONE]")
+        try:
+            for i, event in enumerate(events):
+                if i > 1 and self.token_delay:
+                    time.sleep(self.token_delay)
+                handler.wfile.write((event + "\n\n").encode("utf-8"))
+                handler.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed a losing hedge or gave up on the stream
+            pass
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="lognormal:0.8:0.4",
+                        help="response / first-chunk latency in seconds (default lognormal:0.8:0.4)")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SPEC",
+                        help="latency override for one model; repeatable")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests that fail (0-1)")
+    parser.add_argument("--error-status", default="429,503", help="comma-separated statuses for injected failures")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--no-prefix-cache", action="store_true", help="report no cached prompt tokens")
+    parser.add_argument("--cache-min-tokens", type=int, default=CACHE_MIN_TOKENS,
+                        help="shortest prefix counted as cached (0 caches any repeated prefix)")
+    return parser
+
+
+def from_args(args, port=None):
+    return MockOpenRouter(
+        host=args.host,
+        port=args.port if port is None else port,
+        latency=Latency(args.latency),
+        model_latency={
+            model: Latency(spec) for model, spec in (item.split("=", 1) for item in args.model_latency)
+        },
+        token_delay=args.token_delay,
+        error_rate=args.error_rate,
+        error_statuses=[int(status) for status in args.error_status.split(",") if status],
+        retry_after=args.retry_after,
+        seed=args.seed,
+        prefix_cache=not args.no_prefix_cache,
+        cache_min_tokens=args.cache_min_tokens,
+    )
+
+
+if __name__ == "__main__":
+    mock = from_args(build_parser().parse_args())
+    print(f"Mock OpenRouter listening on {mock.base_url} (Ctrl+C to stop)")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(mock.stats(), indent=2))
@@ -0,0 +1,158 @@
+import threading
+import time
+from collections import deque
+from settings import get_setting
+
+# Ordered candidates per task; the first healthy model is the primary, the rest are hedges
+DEFAULT_MODELS = {
+    "reply": [
+        "tngtech/deepseek-r1t2-chimera:free",
+        "meta-llama/llama-3.3-70b-instruct:free",
+    ],
+    "extract": [
+        "mistralai/mistral-small-3.2-24b-instruct:free",
+        "meta-llama/llama-3.3-70b-instruct:free",
+    ],
+}
+MODEL_SETTINGS = {"reply": "OPENROUTER_REPLY_MODELS", "extract": "OPENROUTER_EXTRACT_MODELS"}
+
+# Streamed replies and combined JSON replies use the reply models but keep their own
+# stats, since time to first chunk and full-completion time are not comparable
+TASK_MODELS = {"stream": "reply", "combined": "reply"}
+
+# Hedge delay used until a model has MIN_SAMPLES latencies of its own
+DEFAULT_HEDGE_DELAY = {"reply": 8.0, "stream": 5.0, "combined": 10.0, "extract": 4.0}
+MIN_HEDGE_DELAY = 0.5
+MAX_HEDGE_DELAY = 20.0
+
+WINDOW = 50
+MIN_SAMPLES = 5
+# Models failing more often than this over the window are tried after the healthy ones
+MAX_ERROR_RATE = 0.5
+DECISION_LOG_SIZE = 50
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class ModelStats:
+    """Rolling latency and error window for one model on one task"""
+
+    def __init__(self, window=WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.requests = 0
+        self.primary = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record(self, latency, ok):
+        self.requests += 1
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+
+    def percentile(self, fraction):
+        if len(self.latencies) < MIN_SAMPLES:
+            return None
+        return _percentile(sorted(self.latencies), fraction)
+
+    @property
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+
+class ModelRouter:
+    """Picks the model order per task and decides when to hedge
+
+    Latency is whatever the caller measures: time to first chunk for streamed
+    replies, total time for everything else.
+    """
+
+    def __init__(self, models=None):
+        self.models = {task: list(candidates) for task, candidates in (models or DEFAULT_MODELS).items()}
+        self._stats = {}
+        self._decisions = deque(maxlen=DECISION_LOG_SIZE)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        """Read comma-separated model lists from OPENROUTER_REPLY_MODELS / OPENROUTER_EXTRACT_MODELS"""
+        models = {}
+        for task, key in MODEL_SETTINGS.items():
+            configured = [model.strip() for model in (get_setting(key) or "").split(",") if model.strip()]
+            models[task] = configured or DEFAULT_MODELS[task]
+        return cls(models)
+
+    def _stat(self, task, model):
+        key = (task, model)
+        if key not in self._stats:
+            self._stats[key] = ModelStats()
+        return self._stats[key]
+
+    def candidates(self, task):
+        """Models for the task in the order to try them, unhealthy ones last"""
+        models = self.models.get(TASK_MODELS.get(task, task)) or self.models["reply"]
+        with self._lock:
+            healthy = [
+                model for model in models
+                if len(self._stat(task, model).outcomes) < MIN_SAMPLES
+                or self._stat(task, model).error_rate <= MAX_ERROR_RATE
+            ]
+        return healthy + [model for model in models if model not in healthy]
+
+    def hedge_delay(self, task, model):
+        """Seconds to wait for model before hedging: its observed p95, clamped"""
+        with self._lock:
+            p95 = self._stat(task, model).percentile(0.95)
+        if p95 is None:
+            return DEFAULT_HEDGE_DELAY.get(task, DEFAULT_HEDGE_DELAY["reply"])
+        return min(max(p95, MIN_HEDGE_DELAY), MAX_HEDGE_DELAY)
+
+    def record(self, task, model, latency, ok):
+        with self._lock:
+            self._stat(task, model).record(latency, ok)
+
+    def record_decision(self, task, attempted, winner, latency):
+        """Log one routed call; attempted[0] is the primary, the rest were hedges"""
+        with self._lock:
+            for position, model in enumerate(attempted):
+                stat = self._stat(task, model)
+                if position == 0:
+                    stat.primary += 1
+                else:
+                    stat.hedges += 1
+                    if model == winner:
+                        stat.hedge_wins += 1
+            self._decisions.append({
+                "at": time.time(),
+                "task": task,
+                "attempted": list(attempted),
+                "winner": winner,
+                "hedged": len(attempted) > 1,
+                "latency": round(latency, 3),
+            })
+
+    def snapshot(self):
+        """Per task/model latency, error and hedge figures plus the most recent routing decisions"""
+        with self._lock:
+            models = []
+            for (task, model), stat in sorted(self._stats.items()):
+                p50, p95 = stat.percentile(0.5), stat.percentile(0.95)
+                models.append({
+                    "task": task,
+                    "model": model,
+                    "requests": stat.requests,
+                    "p50": round(p50, 3) if p50 is not None else None,
+                    "p95": round(p95, 3) if p95 is not None else None,
+                    "error_rate": round(stat.error_rate, 3),
+                    "primary": stat.primary,
+                    "hedges": stat.hedges,
+                    "hedge_wins": stat.hedge_wins,
+                    "hedge_win_rate": round(stat.hedge_wins / stat.hedges, 3) if stat.hedges else None,
+                })
+            return {"models": models, "decisions": list(self._decisions)}
@@ -1,64 +1,55 @@
-import os
+import contextvars
+import queue
+import re
+import time
+import random
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from email.utils import parsedate_to_datetime
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from dotenv import load_dotenv
+from circuit_breaker import CircuitBreaker
+from menu_index import FULL_MENU_HEADING
+from model_router import ModelRouter
+from settings import get_setting
+from tracing import tracer
 
-load_dotenv()
+FALLBACK_REPLY = "I'm having trouble connecting right now. Could you please try again in a moment?"
+OFFLINE_REPLY = (
+    "I'm running a little slow right now, but I can still tell you about our menu, deals, "
+    "delivery and payment options, or take down your order. What would you like?"
+)
 
-try:
-    import streamlit as st
-except Exception:
-    st = None
+REPLY_TIMEOUT = 60
+EXTRACT_TIMEOUT = 20
+PROBE_TIMEOUT = 10
 
+# Upstream calls allowed in flight at once per process, shared by every Streamlit session
+MAX_IN_FLIGHT = int(get_setting("OPENROUTER_MAX_IN_FLIGHT") or 8)
+MAX_RETRIES = int(get_setting("OPENROUTER_MAX_RETRIES") or 2)
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
 
-def _get_setting(key: str):
-    if st is not None:
-        try:
-            if key in st.secrets:
-                return st.secrets[key]
-        except Exception:
-            pass
-    return os.getenv(key)
 
-class OpenRouterClient:
-    def __init__(self):
-        self.api_key = _get_setting("OPENROUTER_API_KEY")
-        self.base_url = "https://openrouter.ai/api/v1"
-        self.model = "tngtech/deepseek-r1t2-chimera:free"
-        
-    def chat_completion(self, messages, temperature=0.7):
-        """Send chat completion request to OpenRouter"""
-        if not self.api_key:
-            print("OPENROUTER_API_KEY is not set. Please add it to your .env file.")
-            return None
+TURN_MODES = ("split", "combined")
 
-        response = requests.post(
-            url=f"{self.base_url}/chat/completions",
-            headers={
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "http://localhost:8501",
-                "X-Title": "Restaurant Chatbot",
-            },
-            data=json.dumps({
-                "model": self.model,
-                "messages": messages,
-                "temperature": temperature,
-                "max_tokens": 1000,
-            }),
-            timeout=60,
-        )
+COMBINED_FORMAT_PROMPT = """
+Respond ONLY with a JSON object of this exact shape, no other text:
+{"reply": "<what Paulo says to the customer>",
+ "order": {"items": [<menu items the customer is ordering in their latest message>],
+           "quantities": [<quantity for each item, same order>],
+           "special_requests": "<any special instructions, or empty string>",
+           "is_complete_order": <true if the latest message places or confirms a complete order>}}
+"""
 
-        try:
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"Error calling OpenRouter API: {e} | Response: {response.text}")
-            return None
-    
-    def get_waiter_response(self, user_message, menu_context="", chat_history=None):
-        """Get response from AI waiter with restaurant context"""
-        system_prompt = f"""
+EXTRACTION_SYSTEM_PROMPT = "You are an order extraction assistant. Respond only with valid JSON."
+
+# The waiter persona and rules. Every waiter request starts with this exact text, followed
+# by the whole menu with MENU_CONTEXT=full, so providers that cache prompt prefixes can
+# reuse both; per-turn context goes after them.
+WAITER_SYSTEM_PROMPT = """
 Role & Identity
 You are "Paulo, the Friendly Pizza Waiter."
 You work at Broadway Pizza restaurant and your job is to greet customers, help them explore the menu, answer questions, take orders, recommend items, and provide warm, human-like customer service.
@@ -69,9 +60,6 @@ Polite, patient, and helpful at all times.
 Use natural, human-sounding language — never robotic.
 Add small touches of personality ("Absolutely!", "Sure thing!", "Great choice!") without being over-the-top.
 
-Menu Context:
-{menu_context}
-
 Core Abilities
 You must:
 - Take Orders: Ask clarifying questions (size, crust, toppings, dips, drinks, quantity, etc.). Confirm items before finalizing. Present a clear, well-formatted order summary.
@@ -95,25 +83,361 @@ Opening Greeting Example
 "Hi there! Welcome to Broadway Pizza! 🍕 What can I get started for you today?"
 """
 
-        messages = [{"role": "system", "content": system_prompt}]
+# Leading messages of each prompt, built once: the waiter prefix, and the combined-mode prefix
+WAITER_PREFIX = ({"role": "system", "content": WAITER_SYSTEM_PROMPT},)
+COMBINED_PREFIX = WAITER_PREFIX + ({"role": "system", "content": COMBINED_FORMAT_PROMPT},)
+STATIC_PROMPTS = {WAITER_SYSTEM_PROMPT, COMBINED_FORMAT_PROMPT, EXTRACTION_SYSTEM_PROMPT}
 
-        if chat_history:
-            for msg in chat_history[-12:]:
-                role = msg.get("role")
-                content = msg.get("content")
-                if role in {"user", "assistant"} and content:
-                    messages.append({"role": role, "content": content})
+# Whether to mark the static prefix with a cache_control breakpoint: "auto" does so for
+# providers that only cache marked prefixes (others cache automatically), "on" always, "off" never
+PROMPT_CACHE_CONTROL = (get_setting("PROMPT_CACHE_CONTROL") or "auto").lower()
+CACHE_CONTROL_MODEL_PREFIXES = ("anthropic/", "google/gemini")
 
-        messages.append({"role": "user", "content": user_message})
-        
-        response = self.chat_completion(messages)
+
+def _is_static(message):
+    """Whether the message is the same on every turn (per menu version for the full menu)"""
+    content = message.get("content")
+    return isinstance(content, str) and (content in STATIC_PROMPTS or content.startswith(FULL_MENU_HEADING))
+
+
+def with_cache_hints(messages, model, mode=None):
+    """Copy of messages with a cache_control breakpoint on the last message of the static prefix
+
+    Providers only cache prefixes of 1024 tokens or more; the persona alone is shorter,
+    so this only pays off with MENU_CONTEXT=full, where the breakpoint lands after the menu.
+    """
+    mode = mode or PROMPT_CACHE_CONTROL
+    if mode == "off" or (mode != "on" and not model.startswith(CACHE_CONTROL_MODEL_PREFIXES)):
+        return messages
+    end = 0
+    while end < len(messages) and _is_static(messages[end]):
+        end += 1
+    if not end:
+        return messages
+    marked = dict(messages[end - 1])
+    marked["content"] = [{"type": "text", "text": marked["content"], "cache_control": {"type": "ephemeral"}}]
+    return messages[:end - 1] + [marked] + messages[end:]
+
+
+def _in_context(fn):
+    """Wrap fn so it runs with the caller's context variables (current turn, usage customer) on a pool thread"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def _empty_order():
+    return {"items": [], "quantities": [], "special_requests": "", "is_complete_order": False}
+
+
+class StreamInterrupted(Exception):
+    """A streamed reply stopped early (error chunk or dropped connection) after some text arrived"""
+
+
+# Queued by a hedge pump after its stream was interrupted
+_TRUNCATED = object()
+
+
+class _Abandoned(requests.exceptions.RequestException):
+    """The call was abandoned (a hedge lost) before it could start"""
+
+
+class _Call:
+    """One request's concurrency-limiter slot and live response
+
+    release() frees the slot at most once, whichever thread gets there first, so a
+    hedge that loses can be abandoned from the winner's thread: its response is
+    closed and its slot handed back straight away.
+    """
+
+    def __init__(self, limiter):
+        self._limiter = limiter
+        self._lock = threading.Lock()
+        self._held = False
+        self.response = None
+        self.abandoned = False
+
+    def acquire(self):
+        self._limiter.acquire()
+        with self._lock:
+            if not self.abandoned:
+                self._held = True
+                return
+        self._limiter.release()
+        raise _Abandoned()
+
+    def release(self):
+        with self._lock:
+            held, self._held = self._held, False
+        if held:
+            self._limiter.release()
+
+    def attach(self, response):
+        with self._lock:
+            self.response = response
+            abandoned = self.abandoned
+        if abandoned:
+            response.close()
+
+    def abandon(self):
+        with self._lock:
+            self.abandoned = True
+            response = self.response
+        if response is not None:
+            response.close()
+        self.release()
+
+
+def _counts_as_outage(status_code):
+    """Rate limits and server errors trip the circuit breaker; other 4xx are our own fault"""
+    return status_code in RETRYABLE_STATUS or status_code >= 500
+
+
+def _retry_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number attempt: Retry-After if given, else jittered exponential backoff"""
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), BACKOFF_MAX)
+        except ValueError:
+            try:
+                wait = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                return min(max(wait, 0.0), BACKOFF_MAX)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _parse_json_object(text):
+    """Pull the first JSON object out of a model reply, tolerating fences, reasoning and chatter"""
+    if not text:
+        return None
+    text = re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL).strip()
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text).strip()
+    try:
+        data = json.loads(text)
+        return data if isinstance(data, dict) else None
+    except json.JSONDecodeError:
+        pass
+
+    decoder = json.JSONDecoder()
+    start = text.find("{")
+    while start != -1:
+        try:
+            data, _ = decoder.raw_decode(text, start)
+            if isinstance(data, dict):
+                return data
+        except json.JSONDecodeError:
+            pass
+        start = text.find("{", start + 1)
+    return None
+
+
+def _normalize_order(data):
+    """Coerce an extracted order dict into the items/quantities/special_requests shape"""
+    order = _empty_order()
+    if not isinstance(data, dict):
+        return order
+    items = data.get("items") or []
+    quantities = data.get("quantities") or []
+    order["items"] = [str(item) for item in items] if isinstance(items, list) else [str(items)]
+    order["quantities"] = quantities if isinstance(quantities, list) else [quantities]
+    order["special_requests"] = str(data.get("special_requests") or "")
+    order["is_complete_order"] = bool(data.get("is_complete_order")) and bool(order["items"])
+    return order
+
+
+class ChatStream:
+    """Iterable over streamed reply chunks that also assembles the full text and timings"""
+
+    def __init__(self, chunks, fallback_text="", on_complete=None):
+        self._chunks = chunks
+        self.fallback_text = fallback_text
+        self.on_complete = on_complete
+        self.text = ""
+        self.ttft = None
+        self.total_time = None
+        # True if the reply was cut off; the partial text is shown but never cached
+        self.truncated = False
+
+    def __iter__(self):
+        started = time.perf_counter()
+        parts = []
+        try:
+            for chunk in self._chunks:
+                if self.ttft is None:
+                    self.ttft = time.perf_counter() - started
+                parts.append(chunk)
+                yield chunk
+        except StreamInterrupted:
+            self.truncated = True
+
+        received = bool(parts)
+        fallback = self.fallback_text() if callable(self.fallback_text) else self.fallback_text
+        if not parts and fallback:
+            parts.append(fallback)
+            yield fallback
+
+        self.text = "".join(parts)
+        self.total_time = time.perf_counter() - started
+        if received:
+            tracer.observe("llm_ttft", self.ttft)
+            tracer.observe("llm_total", self.total_time)
+        if received and not self.truncated and self.on_complete is not None:
+            self.on_complete(self.text)
+
+
+class OpenRouterBase:
+    """Configuration, prompt building and response parsing shared by the sync and async clients"""
+
+    def __init__(self):
+        self.api_key = get_setting("OPENROUTER_API_KEY")
+        self.base_url = get_setting("OPENROUTER_BASE_URL") or "https://openrouter.ai/api/v1"
+        # Ordered models per task with rolling latency stats; see model_router.py
+        self.router = ModelRouter.from_settings()
+        self.model = self.router.models["reply"][0]
+        self.max_in_flight = MAX_IN_FLIGHT
+        self.max_retries = MAX_RETRIES
+        turn_mode = (get_setting("OPENROUTER_TURN_MODE") or "split").lower()
+        self.turn_mode = turn_mode if turn_mode in TURN_MODES else "split"
+        # Optional order_extractor.MenuOrderExtractor; when set, the LLM is only a fallback
+        self.order_extractor = None
+        # Optional response_cache.ResponseCache for repeat, history-independent questions
+        self.response_cache = None
+        # Optional local_answers.LocalAnswerer used while OpenRouter is failing
+        self.local_answers = None
+        # Optional usage.UsageRecorder receiving the token usage of every call
+        self.usage_recorder = None
+        self.breaker = CircuitBreaker.from_settings(probe=self._probe)
+
+    def _headers(self):
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "http://localhost:8501",
+            "X-Title": "Restaurant Chatbot",
+        }
+
+    def _payload(self, messages, temperature, model=None, **extra):
+        model = model or self.model
+        payload = {
+            "model": model,
+            "messages": with_cache_hints(messages, model),
+            "temperature": temperature,
+            "max_tokens": 1000,
+            # Ask OpenRouter for token counts and cost, also on the last chunk of streams
+            "usage": {"include": True},
+        }
+        payload.update(extra)
+        return json.dumps(payload)
+
+    def _probe(self):
+        """One-token completions on the routed models until one answers
+
+        The circuit breaker calls this to detect recovery. The breaker covers every
+        model, so it closes as soon as any model a turn could be routed to is back.
+        """
+        if not self.api_key:
+            return False
+        models = []
+        for task in ("reply", "extract"):
+            models += [model for model in self.router.candidates(task) if model not in models]
+        for model in models:
+            try:
+                response = requests.post(
+                    url=f"{self.base_url}/chat/completions",
+                    headers=self._headers(),
+                    data=self._payload([{"role": "user", "content": "ping"}], 0, model=model, max_tokens=1),
+                    timeout=PROBE_TIMEOUT,
+                )
+            except requests.exceptions.RequestException:
+                continue
+            if response.status_code == 200:
+                return True
+        return False
+
+    def _fallback_reply(self, user_message, default=FALLBACK_REPLY):
+        """Templated local answer for the message if there is one, else default"""
+        if self.local_answers is not None:
+            try:
+                answer = self.local_answers.answer(user_message)
+            except Exception as e:
+                print(f"Local answer failed: {e}")
+                answer = None
+            if answer:
+                return answer
+        return default
+
+    @staticmethod
+    def _content(response):
         if response and 'choices' in response and len(response['choices']) > 0:
             return response['choices'][0]['message']['content']
-        else:
-            return "I'm having trouble connecting right now. Could you please try again in a moment?"
-    
-    def extract_order_info(self, user_message):
-        """Extract order information from user message"""
+        return None
+
+    def _record_usage(self, task, model, usage):
+        if usage and self.usage_recorder is not None:
+            self.usage_recorder.record(task, model, usage)
+
+    @staticmethod
+    def _parse_sse_line(line):
+        """Return (content, usage) for one SSE line
+
+        content is the delta text, "" for none, or None at end of stream; usage is the
+        usage block OpenRouter sends on the final chunk, else None. An error chunk
+        raises StreamInterrupted.
+        """
+        # SSE comments (": OPENROUTER PROCESSING") are keep-alives
+        if not line or line.startswith(":") or not line.startswith("data:"):
+            return "", None
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return None, None
+        try:
+            chunk = json.loads(data)
+        except json.JSONDecodeError:
+            return "", None
+        if "error" in chunk:
+            raise StreamInterrupted(chunk["error"])
+        choices = chunk.get("choices") or []
+        content = ""
+        if choices:
+            content = (choices[0].get("delta") or {}).get("content") or ""
+        return content, chunk.get("usage")
+
+    def _build_waiter_messages(self, user_message, menu_context="", chat_history=None, summary="",
+                               prefix=WAITER_PREFIX):
+        with tracer.span("prompt_build"):
+            return self._assemble_waiter_messages(user_message, menu_context, chat_history, summary, prefix)
+
+    def _assemble_waiter_messages(self, user_message, menu_context, chat_history, summary, prefix=WAITER_PREFIX):
+        """Build the message list for the waiter persona
+
+        The constant prefix comes first, then the parts that change from turn to turn,
+        least often changing first: menu context, summary, history and the new message.
+        chat_history is sent verbatim, so callers pass only the messages the rolling
+        summary does not cover (see prompt_budget.summary_boundary).
+        """
+        messages = list(prefix)
+        if menu_context and menu_context.startswith(FULL_MENU_HEADING):
+            # Sent as is so it stays byte-identical, and so cacheable, from turn to turn
+            messages.append({"role": "system", "content": menu_context})
+        elif menu_context:
+            messages.append({"role": "system", "content": f"Menu Context:\n{menu_context}"})
+        if summary:
+            messages.append({"role": "system", "content": f"Conversation summary:\n{summary}"})
+
+        history = [
+            {"role": msg.get("role"), "content": msg.get("content")}
+            for msg in chat_history or []
+            if msg.get("role") in {"user", "assistant"} and msg.get("content")
+        ]
+        # The caller usually has already appended the current message to its history
+        if history and history[-1] == {"role": "user", "content": user_message}:
+            history.pop()
+        messages.extend(history)
+
+        messages.append({"role": "user", "content": user_message})
+        return messages
+
+    def _build_extraction_messages(self, user_message):
         extraction_prompt = f"""
 Extract order information from this customer message: "{user_message}"
 
@@ -128,16 +452,455 @@ If no order information is found, return {{"items": [], "quantities": [], "speci
 Respond only with valid JSON, no other text.
 """
         
-        messages = [
-            {"role": "system", "content": "You are an order extraction assistant. Respond only with valid JSON."},
+        return [
+            {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
             {"role": "user", "content": extraction_prompt}
         ]
-        
-        response = self.chat_completion(messages, temperature=0.1)
-        if response and 'choices' in response and len(response['choices']) > 0:
+
+    def _build_combined_messages(self, user_message, menu_context="", chat_history=None, summary=""):
+        return self._build_waiter_messages(user_message, menu_context, chat_history, summary, prefix=COMBINED_PREFIX)
+
+    def _cached_reply(self, user_message, chat_history):
+        cache = self.response_cache
+        return cache.get(user_message, chat_history) if cache is not None else None
+
+    def _cache_reply(self, user_message, chat_history, reply):
+        if self.response_cache is not None:
+            self.response_cache.put(user_message, chat_history, reply)
+
+    def _extract_locally(self, user_message):
+        """Return the local extractor's result if it is confident enough, else None"""
+        if self.order_extractor is None:
+            return None
+        with tracer.span("local_extraction"):
+            result = self.order_extractor.extract(user_message)
+        if result["confidence"] < self.order_extractor.min_confidence:
+            return None
+        result["source"] = "local"
+        return result
+
+    def _canonicalize_order(self, order):
+        if self.order_extractor is not None:
+            order["items"] = [self.order_extractor.canonicalize(item) for item in order["items"]]
+        return order
+
+    def _order_from_response(self, response):
+        data = _parse_json_object(self._content(response))
+        if data is None:
+            return _empty_order()
+        return self._canonicalize_order(_normalize_order(data))
+
+    def _combined_from_response(self, response, user_message, chat_history):
+        """Split a combined-mode completion into (reply, order_info)"""
+        content = self._content(response)
+        if content is None:
+            return self._fallback_reply(user_message), self._extract_locally(user_message) or _empty_order()
+        data = _parse_json_object(content)
+        if data is None or not isinstance(data.get("reply"), str):
+            return content.strip() or FALLBACK_REPLY, _empty_order()
+        self._cache_reply(user_message, chat_history, data["reply"])
+        return data["reply"], self._canonicalize_order(_normalize_order(data.get("order")))
+
+
+class OpenRouterClient(OpenRouterBase):
+    def __init__(self):
+        super().__init__()
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="openrouter")
+        # One pooled keep-alive session instead of a fresh TCP+TLS handshake per call
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_in_flight)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._limiter = threading.BoundedSemaphore(self.max_in_flight)
+        # Hedged calls get their own pool so a reply running on _executor never waits on it
+        self._hedge_executor = ThreadPoolExecutor(max_workers=self.max_in_flight * 2, thread_name_prefix="openrouter-hedge")
+
+    def _post(self, payload, timeout, call):
+        """POST to chat/completions under the concurrency limit, retrying 429/5xx with backoff
+
+        The body is left unread so an abandoned call can be cut off while it downloads;
+        the caller must close the response and release the call's slot. The slot is
+        released while backing off.
+        """
+        for attempt in range(self.max_retries + 1):
+            call.acquire()
             try:
-                return json.loads(response['choices'][0]['message']['content'])
-            except json.JSONDecodeError:
-                return {"items": [], "quantities": [], "special_requests": "", "is_complete_order": False}
-        
-        return {"items": [], "quantities": [], "special_requests": "", "is_complete_order": False}
+                response = self.session.post(
+                    url=f"{self.base_url}/chat/completions",
+                    headers=self._headers(),
+                    data=payload,
+                    timeout=timeout,
+                    stream=True,
+                )
+            except BaseException:
+                call.release()
+                raise
+            call.attach(response)
+            if response.status_code not in RETRYABLE_STATUS or attempt == self.max_retries:
+                return response
+            call.release()
+            response.close()
+            delay = _retry_delay(attempt, response.headers.get("Retry-After"))
+            print(f"OpenRouter returned {response.status_code}; retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    def chat_completion(self, messages, temperature=0.7, timeout=REPLY_TIMEOUT, model=None, call=None, **extra):
+        """Send chat completion request to OpenRouter
+
+        call, if given, is a _Call another thread may abandon; an abandoned call
+        returns None without counting against the circuit breaker.
+        """
+        if not self.api_key:
+            print("OPENROUTER_API_KEY is not set. Please add it to your .env file.")
+            return None
+        if not self.breaker.allow():
+            return None
+
+        call = call or _Call(self._limiter)
+        try:
+            response = self._post(self._payload(messages, temperature, model, **extra), timeout, call)
+        except requests.exceptions.RequestException as e:
+            if call.abandoned:
+                return None
+            # Timeouts and connection errors surface here now that callers bound them
+            print(f"Error calling OpenRouter API: {e}")
+            self.breaker.record_failure()
+            return None
+
+        try:
+            response.raise_for_status()
+            data = response.json()
+        except Exception as e:
+            # Closing the response from another thread can surface as any error mid-read
+            if call.abandoned:
+                return None
+            if not isinstance(e, requests.exceptions.RequestException):
+                raise
+            print(f"Error calling OpenRouter API: {e} | Response: {response.text}")
+            if _counts_as_outage(response.status_code):
+                self.breaker.record_failure()
+            return None
+        finally:
+            response.close()
+            call.release()
+        self.breaker.record_success()
+        return data
+
+    def chat_completion_stream(self, messages, temperature=0.7, timeout=REPLY_TIMEOUT, model=None, on_usage=None,
+                               call=None):
+        """Stream a chat completion from OpenRouter, yielding content chunks as they arrive
+
+        on_usage, if given, is called with the usage block from the end of the stream.
+        Raises StreamInterrupted if the stream fails after content has been yielded.
+        An abandoned call (see chat_completion) just ends the stream.
+        """
+        if not self.api_key:
+            print("OPENROUTER_API_KEY is not set. Please add it to your .env file.")
+            return
+        if not self.breaker.allow():
+            return
+
+        call = call or _Call(self._limiter)
+        try:
+            response = self._post(self._payload(messages, temperature, model, stream=True), timeout, call)
+        except requests.exceptions.RequestException as e:
+            if call.abandoned:
+                return
+            print(f"Error streaming from OpenRouter API: {e}")
+            self.breaker.record_failure()
+            return
+
+        received = False
+        try:
+            response.raise_for_status()
+            response.encoding = "utf-8"
+            for line in response.iter_lines(decode_unicode=True):
+                content, usage = self._parse_sse_line(line)
+                if usage and on_usage is not None:
+                    on_usage(usage)
+                if content is None:
+                    break
+                if content:
+                    received = True
+                    yield content
+            if call.abandoned:
+                return
+            if received:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+        except Exception as e:
+            # Closing the response from another thread can surface as any error mid-read
+            if call.abandoned:
+                return
+            if not isinstance(e, (requests.exceptions.RequestException, StreamInterrupted)):
+                raise
+            print(f"Error streaming from OpenRouter API: {e}")
+            # A stream that breaks off is an upstream failure even though it started with a 200
+            if received or isinstance(e, StreamInterrupted) or _counts_as_outage(response.status_code):
+                self.breaker.record_failure()
+            if received:
+                raise StreamInterrupted(str(e)) from e
+        finally:
+            response.close()
+            call.release()
+
+    def _timed_completion(self, task, model, messages, temperature, timeout, call=None, **extra):
+        started = time.perf_counter()
+        response = self.chat_completion(messages, temperature, timeout, model=model, call=call, **extra)
+        if call is not None and call.abandoned:
+            # Cut off because another model won, which says nothing about this one
+            return response
+        self.router.record(task, model, time.perf_counter() - started, self._content(response) is not None)
+        self._record_usage(task, model, (response or {}).get("usage"))
+        return response
+
+    def _routed_completion(self, task, messages, temperature=0.7, timeout=REPLY_TIMEOUT, **extra):
+        """Call the task's primary model, hedging to the next candidate once it runs past its p95
+
+        The first usable answer wins. Hedges that have not started are cancelled; ones
+        already in flight have their response closed and limiter slot freed right away.
+        """
+        candidates = self.router.candidates(task)
+        started = time.perf_counter()
+        pending, calls, attempted = {}, {}, []
+        winner = response = None
+
+        def launch():
+            model = candidates.pop(0)
+            attempted.append(model)
+            call = _Call(self._limiter)
+            future = self._hedge_executor.submit(
+                _in_context(self._timed_completion), task, model, messages, temperature, timeout, call=call, **extra
+            )
+            pending[future] = model
+            calls[future] = call
+
+        launch()
+        while pending:
+            wait_for = started + timeout - time.perf_counter()
+            if candidates:
+                wait_for = min(wait_for, self.router.hedge_delay(task, attempted[-1]))
+            done, _ = wait(pending, timeout=max(wait_for, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                model = pending.pop(future)
+                result = future.result()
+                if winner is None and self._content(result) is not None:
+                    winner, response = model, result
+            if winner is not None:
+                break
+            if not done:
+                if not candidates:
+                    break
+                launch()
+            elif not pending and candidates:
+                launch()
+
+        for future in pending:
+            future.cancel()
+            calls[future].abandon()
+        self.router.record_decision(task, attempted, winner, time.perf_counter() - started)
+        return response
+
+    def _routed_stream(self, task, messages, temperature=0.7, timeout=REPLY_TIMEOUT):
+        """Stream from the task's primary model, hedging when its first chunk is later than its p95
+
+        Whichever model produces the first chunk wins; the other streams are closed
+        from this thread and their limiter slots freed, without waiting on their pumps.
+        """
+        candidates = self.router.candidates(task)
+        started = time.perf_counter()
+        chunks = queue.Queue()
+        stops, calls, attempted = {}, {}, []
+
+        def pump(model, stop, call):
+            launched = time.perf_counter()
+            stream = self.chat_completion_stream(
+                messages, temperature, timeout, model=model,
+                on_usage=lambda usage: self._record_usage(task, model, usage), call=call,
+            )
+            first = True
+            try:
+                for chunk in stream:
+                    if first:
+                        self.router.record(task, model, time.perf_counter() - launched, True)
+                        first = False
+                    if stop.is_set():
+                        break
+                    chunks.put((model, chunk))
+            except StreamInterrupted:
+                chunks.put((model, _TRUNCATED))
+            finally:
+                stream.close()
+                if first and not stop.is_set():
+                    self.router.record(task, model, time.perf_counter() - launched, False)
+                chunks.put((model, None))
+
+        def launch():
+            model = candidates.pop(0)
+            attempted.append(model)
+            stops[model] = threading.Event()
+            calls[model] = _Call(self._limiter)
+            self._hedge_executor.submit(_in_context(pump), model, stops[model], calls[model])
+
+        launch()
+        running, winner = 1, None
+        try:
+            while winner is None and running:
+                wait_for = started + timeout - time.perf_counter()
+                if candidates:
+                    wait_for = min(wait_for, self.router.hedge_delay(task, attempted[-1]))
+                try:
+                    model, chunk = chunks.get(timeout=max(wait_for, 0))
+                except queue.Empty:
+                    if not candidates:
+                        break
+                    launch()
+                    running += 1
+                    continue
+                if chunk is None:
+                    running -= 1
+                    if not running and candidates:
+                        launch()
+                        running += 1
+                    continue
+                if chunk is _TRUNCATED:
+                    continue
+                winner = model
+                for other, stop in stops.items():
+                    if other != winner:
+                        stop.set()
+                        calls[other].abandon()
+                self.router.record_decision(task, attempted, winner, time.perf_counter() - started)
+                yield chunk
+
+            if winner is None:
+                self.router.record_decision(task, attempted, None, time.perf_counter() - started)
+                return
+            while True:
+                model, chunk = chunks.get()
+                if model != winner:
+                    continue
+                if chunk is None:
+                    break
+                if chunk is _TRUNCATED:
+                    raise StreamInterrupted(winner)
+                yield chunk
+        finally:
+            for model, stop in stops.items():
+                stop.set()
+                calls[model].abandon()
+
+    def get_waiter_response(self, user_message, menu_context="", chat_history=None, stream=False,
+                            timeout=REPLY_TIMEOUT, summary=""):
+        """Get response from AI waiter with restaurant context
+
+        With stream=True a ChatStream is returned instead of a string; iterate it to
+        receive chunks, then read .text, .ttft and .total_time once it is exhausted.
+        """
+        cached = self._cached_reply(user_message, chat_history)
+        if cached is not None:
+            return ChatStream(iter([cached])) if stream else cached
+        if self.breaker.is_open:
+            # Answer from data.json in milliseconds instead of waiting on a dead upstream
+            reply = self._fallback_reply(user_message, OFFLINE_REPLY)
+            return ChatStream(iter([reply])) if stream else reply
+
+        messages = self._build_waiter_messages(user_message, menu_context, chat_history, summary)
+
+        if stream:
+            return ChatStream(
+                self._routed_stream("stream", messages, timeout=timeout),
+                fallback_text=lambda: self._fallback_reply(user_message),
+                on_complete=lambda text: self._cache_reply(user_message, chat_history, text),
+            )
+
+        with tracer.span("llm_total"):
+            reply = self._content(self._routed_completion("reply", messages, timeout=timeout))
+        if reply is not None:
+            self._cache_reply(user_message, chat_history, reply)
+            return reply
+        else:
+            return self._fallback_reply(user_message)
+
+    def extract_order_info(self, user_message, timeout=EXTRACT_TIMEOUT):
+        """Extract order information from user message"""
+        with tracer.span("order_extraction"):
+            local = self._extract_locally(user_message)
+            if local is not None:
+                return local
+
+            messages = self._build_extraction_messages(user_message)
+            response = self._routed_completion("extract", messages, temperature=0.1, timeout=timeout)
+            return self._order_from_response(response)
+
+    def get_waiter_response_with_order(self, user_message, menu_context="", chat_history=None,
+                                       timeout=REPLY_TIMEOUT, summary=""):
+        """Get the waiter reply and the extracted order from a single JSON-mode completion
+
+        Returns (reply, order_info). If the model ignores the JSON format, its raw text is
+        used as the reply and the order comes back empty.
+        """
+        cached = self._cached_reply(user_message, chat_history)
+        if cached is not None:
+            # Only order-free FAQ questions are cacheable, so there is nothing to extract
+            return cached, _empty_order()
+        if self.breaker.is_open:
+            return self._fallback_reply(user_message, OFFLINE_REPLY), self.extract_order_info(user_message)
+
+        messages = self._build_combined_messages(user_message, menu_context, chat_history, summary)
+        with tracer.span("llm_total"):
+            response = self._routed_completion(
+                "combined", messages, timeout=timeout, response_format={"type": "json_object"}
+            )
+        return self._combined_from_response(response, user_message, chat_history)
+
+    def run_turn(self, user_message, menu_context="", chat_history=None, mode=None, summary=""):
+        """Produce (reply, order_info) for one chat turn using the combined or split path"""
+        if (mode or self.turn_mode) == "combined":
+            return self.get_waiter_response_with_order(user_message, menu_context, chat_history, summary=summary)
+        return self.respond_and_extract(user_message, menu_context, chat_history, summary=summary)
+
+    def submit_order_extraction(self, user_message, timeout=EXTRACT_TIMEOUT):
+        """Start order extraction in the background and return its Future
+
+        A confident local extraction resolves immediately without a network call.
+        """
+        local = self._extract_locally(user_message)
+        if local is not None:
+            future = Future()
+            future.set_result(local)
+            return future
+        return self._executor.submit(_in_context(self.extract_order_info), user_message, timeout=timeout)
+
+    def collect_order_info(self, future, timeout=EXTRACT_TIMEOUT):
+        """Wait up to timeout seconds for an extraction Future
+
+        On timeout the Future is cancelled (or, if already running, abandoned; its HTTP
+        call is bounded by the same timeout) and an empty order is returned.
+        """
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            print(f"Order extraction did not finish within {timeout}s; skipping it for this turn")
+        except Exception as e:
+            print(f"Order extraction failed: {e}")
+        return _empty_order()
+
+    def respond_and_extract(self, user_message, menu_context="", chat_history=None,
+                            reply_timeout=REPLY_TIMEOUT, extract_timeout=EXTRACT_TIMEOUT, summary=""):
+        """Issue the waiter reply and order extraction together and return (reply, order_info)"""
+        extract_future = self.submit_order_extraction(user_message, timeout=extract_timeout)
+        reply_future = self._executor.submit(
+            _in_context(self.get_waiter_response), user_message, menu_context, chat_history,
+            timeout=reply_timeout, summary=summary,
+        )
+
+        try:
+            reply = reply_future.result(timeout=reply_timeout)
+        except FutureTimeoutError:
+            reply_future.cancel()
+            reply = self._fallback_reply(user_message)
+
+        return reply, self.collect_order_info(extract_future, timeout=extract_timeout)
@@ -0,0 +1,253 @@
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+
+QUANTITY_WORDS = {
+    "a": 1, "an": 1, "one": 1, "single": 1, "two": 2, "couple": 2, "pair": 2, "double": 2,
+    "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9,
+    "ten": 10, "eleven": 11, "twelve": 12, "dozen": 12,
+}
+
+SIZE_WORDS = {
+    "small": "Small", "regular": "Regular", "medium": "Medium", "large": "Large",
+    "xl": "XL", "jumbo": "Jumbo", "personal": "Personal",
+}
+
+# Words that describe a category rather than a specific item; they are dropped from
+# aliases ("Kebab Zone Calzone" -> "kebab zone") but never matched on their own.
+GENERIC_WORDS = {
+    "pizza", "calzone", "pasta", "wing", "meal", "box", "bread", "cake", "deal",
+    "chicken", "beef", "special", "classic",
+}
+
+# Matched against normalize_text() output, so apostrophes are already gone ("i'll" -> "ill")
+ORDER_INTENT_RE = re.compile(
+    r"\b(ill have|i will have|ill take|i want|id like|i would like|can i (?:get|have)|"
+    r"could i (?:get|have)|get me|give me|order|add|place|make it|checkout|confirm)\b"
+)
+# Matched against normalize_text() output, which has dropped the "?"; extract() checks the raw message for that
+QUESTION_RE = re.compile(r"^\s*(what|which|how|do|does|is|are|tell me)\b")
+SPECIAL_REQUEST_RE = re.compile(
+    r"\b(?:no|without|extra|less|more|light|well done|hold the)\s+[a-z]+(?:\s+(?:sauce|cheese|crust|spicy))?"
+)
+MULTIPLIER_RE = re.compile(r"^(?:x(\d{1,2})|(\d{1,2})x)$")
+
+FUZZY_THRESHOLD = 0.82
+# A local result is only trusted on its own when every item matched at least this well
+LOCAL_ACCEPT_SCORE = 0.95
+
+# Words that make a message look like an order even when nothing on the menu matched
+FOOD_WORDS = GENERIC_WORDS | {
+    "pepperoni", "cheese", "coke", "pepsi", "drink", "soda", "fries", "burger", "sandwich",
+    "wing", "slice", "dip", "topping", "dessert", "combo",
+}
+
+
+def normalize_text(text):
+    """Lowercase, strip accents and punctuation so names and messages compare cleanly"""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    text = text.replace("&", " and ").replace("’", "").replace("'", "")
+    text = re.sub(r"(\d+)\s*(?:-\s*)?(?:inch(?:es)?|\")", r"\1inch", text)
+    text = re.sub(r"[^a-z0-9 ]+", " ", text)
+    return " ".join(text.split())
+
+
+def _stem(token):
+    if len(token) > 3 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    """Normalized, crudely singularized tokens"""
+    return [_stem(token) for token in normalize_text(text).split()]
+
+
+class MenuOrderExtractor:
+    """Deterministic order extractor over the restaurant's own menu
+
+    All aliases are compiled into a single alternation regex for exact phrase hits;
+    token n-grams left over are compared fuzzily against the aliases to absorb typos.
+    """
+
+    def __init__(self, menu_items, min_confidence=0.75):
+        self.min_confidence = min_confidence
+        self.items = []
+        self._aliases = {}
+        for item in menu_items:
+            name = (item.get("name") or "").strip()
+            if not name:
+                continue
+            self.items.append(item)
+            for alias in self._aliases_for(name):
+                self._aliases.setdefault(alias, item)
+
+        # Longest aliases first so "chicken zone calzone" wins over shorter overlaps
+        ordered = sorted(self._aliases, key=len, reverse=True)
+        self._pattern = re.compile(r"\b(" + "|".join(re.escape(a) for a in ordered) + r")\b") if ordered else None
+        # Fuzzy candidates are bucketed by (token count, first letter); typos rarely hit the first letter
+        self._fuzzy_buckets = {}
+        for alias in ordered:
+            self._fuzzy_buckets.setdefault((len(alias.split()), alias[0]), []).append(alias)
+        self._lengths = sorted({length for length, _ in self._fuzzy_buckets}, reverse=True)
+
+    @staticmethod
+    def _aliases_for(name):
+        base = re.sub(r"\(.*?\)", " ", name)
+        tokens = tokenize(base)
+        aliases = {" ".join(tokenize(name)), " ".join(tokens)}
+        specific = [token for token in tokens if token not in GENERIC_WORDS]
+        if len(specific) >= 2:
+            aliases.add(" ".join(specific))
+        return {alias for alias in aliases if alias}
+
+    def match_name(self, text):
+        """Map free text (e.g. an LLM-extracted item) to (menu item, score), or (None, 0.0)"""
+        tokens = [token for token in tokenize(re.sub(r"\(.*?\)", " ", text)) if token not in SIZE_WORDS]
+        if not tokens:
+            return None, 0.0
+        phrases = {" ".join(tokens), " ".join(t for t in tokens if t not in GENERIC_WORDS)}
+        phrases.discard("")
+        for phrase in phrases:
+            if phrase in self._aliases:
+                return self._aliases[phrase], 1.0
+        best_alias, best_score = None, 0.0
+        for phrase in phrases:
+            for alias in self._aliases:
+                score = SequenceMatcher(None, phrase, alias).ratio()
+                if score > best_score:
+                    best_alias, best_score = alias, score
+        if best_score >= FUZZY_THRESHOLD:
+            return self._aliases[best_alias], best_score
+        return None, best_score
+
+    def canonicalize(self, name):
+        """Rewrite a free-text item name as the matching menu entry, keeping any size"""
+        item, _ = self.match_name(name)
+        if item is None:
+            return name
+        sizes = [SIZE_WORDS[token] for token in tokenize(name) if token in SIZE_WORDS]
+        return f"{item['name']} ({sizes[0]})" if sizes else item["name"]
+
+    def _fuzzy_spans(self, tokens, covered):
+        spans = []
+        for length in self._lengths:
+            for start in range(len(tokens) - length + 1):
+                if any(covered[start:start + length]):
+                    continue
+                gram = " ".join(tokens[start:start + length])
+                if length == 1 and (len(gram) < 5 or gram in GENERIC_WORDS):
+                    continue
+                best_alias, best_score = None, 0.0
+                for alias in self._fuzzy_buckets.get((length, gram[0]), ()):
+                    matcher = SequenceMatcher(None, gram, alias)
+                    if matcher.real_quick_ratio() < FUZZY_THRESHOLD or matcher.quick_ratio() < FUZZY_THRESHOLD:
+                        continue
+                    score = matcher.ratio()
+                    if score > best_score:
+                        best_alias, best_score = alias, score
+                if best_alias and best_score >= FUZZY_THRESHOLD:
+                    spans.append((start, start + length, best_alias, best_score))
+                    for i in range(start, start + length):
+                        covered[i] = True
+        return spans
+
+    @staticmethod
+    def _modifiers(tokens, start, end):
+        quantity, size = None, None
+        for token in tokens[end:end + 2]:
+            multiplier = MULTIPLIER_RE.match(token)
+            if quantity is None and multiplier:
+                quantity = int(multiplier.group(1) or multiplier.group(2))
+            if size is None and token in SIZE_WORDS:
+                size = SIZE_WORDS[token]
+        for token in reversed(tokens[max(0, start - 3):start]):
+            if quantity is None:
+                if token.isdigit() and int(token) < 50:
+                    quantity = int(token)
+                    continue
+                if token in QUANTITY_WORDS:
+                    quantity = QUANTITY_WORDS[token]
+                    continue
+                multiplier = MULTIPLIER_RE.match(token)
+                if multiplier:
+                    quantity = int(multiplier.group(1) or multiplier.group(2))
+                    continue
+            if size is None:
+                if token in SIZE_WORDS:
+                    size = SIZE_WORDS[token]
+                elif token.endswith("inch") and token[:-4].isdigit():
+                    size = f'{token[:-4]}"'
+        return quantity or 1, size
+
+    @staticmethod
+    def _looks_like_order(tokens):
+        """Whether the message carries quantities, sizes or food words"""
+        for token in tokens:
+            if token.isdigit() and int(token) < 50 or MULTIPLIER_RE.match(token):
+                return True
+            if token in QUANTITY_WORDS and token not in ("a", "an"):
+                return True
+            if token in SIZE_WORDS or token in FOOD_WORDS or token.endswith("inch") and token[:-4].isdigit():
+                return True
+        return False
+
+    def extract(self, message):
+        """Extract canonical menu items from a customer message
+
+        Returns the same shape as OpenRouterClient.extract_order_info plus
+        "matches" (per-item detail) and "confidence" in [0, 1].
+        """
+        text = normalize_text(message)
+        tokens = [_stem(token) for token in text.split()]
+        stemmed = " ".join(tokens)
+        covered = [False] * len(tokens)
+
+        spans = []
+        if self._pattern is not None:
+            for hit in self._pattern.finditer(stemmed):
+                start = len(stemmed[:hit.start()].split())
+                end = start + len(hit.group(1).split())
+                spans.append((start, end, hit.group(1), 1.0))
+                for i in range(start, end):
+                    covered[i] = True
+        spans.extend(self._fuzzy_spans(tokens, covered))
+        spans.sort()
+
+        matches = []
+        for start, end, alias, score in spans:
+            item = self._aliases[alias]
+            quantity, size = self._modifiers(tokens, start, end)
+            matches.append({
+                "name": item["name"],
+                "category": item.get("category"),
+                "subcategory": item.get("subcategory"),
+                "quantity": quantity,
+                "size": size,
+                "score": round(score, 3),
+            })
+
+        has_intent = bool(ORDER_INTENT_RE.search(text))
+        is_question = (bool(QUESTION_RE.search(text)) or (message or "").rstrip().endswith("?")) and not has_intent
+        if matches:
+            # Without order intent, or with fuzzy-only spans, the LLM has to decide
+            confidence = min(match["score"] for match in matches)
+            if not has_intent or confidence < LOCAL_ACCEPT_SCORE:
+                confidence = 0.0
+        else:
+            # Nothing on the menu was mentioned: confident for small talk, not when the
+            # customer is clearly trying to order something we failed to recognize
+            confidence = 0.0 if has_intent or self._looks_like_order(tokens) else 1.0
+
+        return {
+            "items": [f"{m['name']} ({m['size']})" if m["size"] else m["name"] for m in matches],
+            "quantities": [m["quantity"] for m in matches],
+            "special_requests": ", ".join(SPECIAL_REQUEST_RE.findall(text)),
+            "is_complete_order": bool(matches) and has_intent and not is_question,
+            "matches": matches,
+            "confidence": round(confidence, 3),
+        }
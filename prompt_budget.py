@@ -0,0 +1,99 @@
+import math
+import re
+
+
+# Approximate token budget for verbatim chat history in the waiter prompt
+HISTORY_TOKEN_BUDGET = 1200
+# Approximate token budget for the rolling summary of older turns
+SUMMARY_TOKEN_BUDGET = 250
+# Most recent messages that always stay verbatim and are never folded into the summary
+KEEP_RECENT_MESSAGES = 8
+# Fold older messages in batches so the summary is not rewritten on every turn
+SUMMARY_FOLD_BATCH = 4
+
+MAX_SUMMARY_ITEMS = 30
+MAX_NOTE_CHARS = 120
+
+_TOKEN_RE = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]")
+
+
+def estimate_tokens(text):
+    """Local token estimate: words split into ~4-character pieces, digits and symbols counted separately"""
+    if not text:
+        return 0
+    return sum(math.ceil(len(piece) / 4) if piece[0].isalpha() else 1 for piece in _TOKEN_RE.findall(text))
+
+
+def message_tokens(message):
+    # Chat formats add a few tokens of framing per message
+    return estimate_tokens(message.get("content") or "") + 4
+
+
+def select_recent(messages, token_budget=HISTORY_TOKEN_BUDGET):
+    """Return the longest suffix of messages that fits the token budget"""
+    kept, used = [], 0
+    for message in reversed(messages):
+        cost = message_tokens(message)
+        if kept and used + cost > token_budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    return kept
+
+
+def summary_boundary(messages):
+    """How many leading messages have left the verbatim window and belong in the summary
+
+    The window is the last KEEP_RECENT_MESSAGES messages, fewer if they do not fit
+    HISTORY_TOKEN_BUDGET. Prompts carry every message from the summary's end onwards,
+    so each message is either summarised or verbatim, never both or neither.
+    """
+    return len(messages) - len(select_recent(messages[-KEEP_RECENT_MESSAGES:], HISTORY_TOKEN_BUDGET))
+
+
+def empty_summary():
+    return {"notes": [], "items": []}
+
+
+def fold_into_summary(summary, messages, order_extractor=None):
+    """Fold messages that are leaving the verbatim window into the running summary
+
+    Only the new messages are processed; the existing summary is extended, never
+    recomputed. Customer requests become short notes, and any menu items mentioned
+    by either side are remembered so earlier order items survive.
+    """
+    summary = {
+        "notes": list((summary or {}).get("notes", [])),
+        "items": list((summary or {}).get("items", [])),
+    }
+    for message in messages:
+        content = " ".join((message.get("content") or "").split())
+        if not content:
+            continue
+        if message.get("role") == "user":
+            note = content if len(content) <= MAX_NOTE_CHARS else content[:MAX_NOTE_CHARS - 3] + "..."
+            summary["notes"].append(f"Customer: {note}")
+        if order_extractor is not None:
+            for match in order_extractor.extract(content)["matches"]:
+                if match["name"] not in summary["items"]:
+                    summary["items"].append(match["name"])
+
+    summary["items"] = summary["items"][-MAX_SUMMARY_ITEMS:]
+    # Oldest notes go first once the summary outgrows its budget
+    while summary["notes"] and estimate_tokens(render_summary(summary)) > SUMMARY_TOKEN_BUDGET:
+        summary["notes"].pop(0)
+    return summary
+
+
+def render_summary(summary, current_order=None):
+    """Format the summary (and the current cart) as text for the system prompt"""
+    lines = []
+    if summary and summary.get("items"):
+        lines.append("Menu items discussed earlier: " + ", ".join(summary["items"]))
+    if summary and summary.get("notes"):
+        lines.append("Earlier in this conversation:")
+        lines.extend(f"- {note}" for note in summary["notes"])
+    if current_order:
+        lines.append("Current order: " + ", ".join(str(item) for item in current_order))
+    return "\n".join(lines)
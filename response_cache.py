@@ -0,0 +1,191 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from settings import get_setting
+
+# Questions whose answer depends only on the restaurant, not on the conversation so far
+FAQ_RE = re.compile(
+    r"\b(deals?|offers?|promos?|promotions?|discounts?|deliver|delivery|payments?|pay|cards?|cash|"
+    r"wallets?|hours|open|timings?|services?|catering|franchise|menu|categories|takeaway|dine in|"
+    r"birthday|corporate)\b"
+)
+# Anything that points back into the conversation or edits an order is never cached
+CONTEXTUAL_RE = re.compile(
+    r"\b(it|that|this|those|them|these|same|again|also|too|another|instead|previous|earlier|"
+    r"my order|cart|add|remove|change|cancel|ill|i want|id like|i would|confirm)\b"
+)
+MAX_CACHEABLE_WORDS = 12
+
+
+def normalize_prompt(text):
+    text = (text or "").lower().replace("'", "").replace("’", "")
+    text = re.sub(r"[^a-z0-9 ]+", " ", text)
+    return " ".join(text.split())
+
+
+def is_cacheable(prompt):
+    """True for short, history-independent restaurant questions (deals, delivery, payment, ...)"""
+    normalized = normalize_prompt(prompt)
+    if not normalized or len(normalized.split()) > MAX_CACHEABLE_WORDS:
+        return False
+    return bool(FAQ_RE.search(normalized)) and not CONTEXTUAL_RE.search(normalized)
+
+
+def history_fingerprint(chat_history):
+    """Short fingerprint of the part of the history that can change an FAQ answer
+
+    Only whether Paulo has already greeted the customer matters for these questions.
+    """
+    greeted = any(msg.get("role") == "assistant" for msg in chat_history or [])
+    return "cont" if greeted else "new"
+
+
+class MemoryCacheBackend:
+    """Single-process LRU store"""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MongoCacheBackend:
+    """Mongo-backed store shared by every app replica
+
+    Expiry is handled by a TTL index; the size bound is enforced by trimming the
+    least recently used entries every TRIM_EVERY writes.
+    """
+
+    TRIM_EVERY = 50
+
+    def __init__(self, collection, max_entries=2048):
+        self.collection = collection
+        self.max_entries = max_entries
+        self._writes = 0
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+        self.collection.create_index('last_used')
+
+    def get(self, key):
+        now = datetime.now()
+        doc = self.collection.find_one_and_update(
+            {'_id': key, 'expires_at': {'$gt': now}},
+            {'$set': {'last_used': now}},
+            projection={'value': 1},
+        )
+        return doc['value'] if doc else None
+
+    def set(self, key, value, ttl):
+        now = datetime.now()
+        self.collection.update_one(
+            {'_id': key},
+            {'$set': {'value': value, 'last_used': now, 'expires_at': now + timedelta(seconds=ttl)}},
+            upsert=True,
+        )
+        self._writes += 1
+        if self._writes % self.TRIM_EVERY == 0:
+            self._trim()
+
+    def _trim(self):
+        excess = self.collection.count_documents({}) - self.max_entries
+        if excess <= 0:
+            return
+        stale = self.collection.find({}, {'_id': 1}).sort('last_used', 1).limit(excess)
+        self.collection.delete_many({'_id': {'$in': [doc['_id'] for doc in stale]}})
+
+    def clear(self):
+        self.collection.delete_many({})
+
+    def __len__(self):
+        return self.collection.estimated_document_count()
+
+
+class ResponseCache:
+    """Reply cache for repeat questions, keyed on prompt, history fingerprint and menu version"""
+
+    def __init__(self, backend=None, ttl=600, version_fn=None):
+        self.backend = backend or MemoryCacheBackend()
+        self.ttl = ttl
+        self.version_fn = version_fn
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls, collection=None, version_fn=None):
+        """Build the cache chosen by RESPONSE_CACHE ("memory" or "mongo"); None when unset or "off" """
+        mode = (get_setting('RESPONSE_CACHE') or 'off').lower()
+        ttl = int(get_setting('RESPONSE_CACHE_TTL') or 600)
+        if mode == 'memory':
+            return cls(MemoryCacheBackend(), ttl=ttl, version_fn=version_fn)
+        if mode == 'mongo' and collection is not None:
+            return cls(MongoCacheBackend(collection), ttl=ttl, version_fn=version_fn)
+        return None
+
+    def _key(self, prompt, chat_history):
+        version = self.version_fn() if self.version_fn else ""
+        raw = f"{version}|{history_fingerprint(chat_history)}|{normalize_prompt(prompt)}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def get(self, prompt, chat_history=None):
+        """Return a cached reply, or None (ineligible prompts always miss without being counted)"""
+        if not is_cacheable(prompt):
+            return None
+        try:
+            value = self.backend.get(self._key(prompt, chat_history))
+        except Exception as e:
+            print(f"Response cache lookup failed: {e}")
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, prompt, chat_history, reply):
+        if not reply or not is_cacheable(prompt):
+            return
+        try:
+            self.backend.set(self._key(prompt, chat_history), reply, self.ttl)
+        except Exception as e:
+            print(f"Response cache write failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": len(self.backend),
+        }
@@ -0,0 +1,227 @@
+import copy
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pymongo.errors import DuplicateKeyError
+from settings import get_setting
+
+
+def _merge_list(latest, base, new):
+    """Apply the edits that turned base into new (items removed, items appended) to latest"""
+    merged = list(latest)
+    added = list(new)
+    for item in base:
+        if item in added:
+            added.remove(item)
+        elif item in merged:
+            merged.remove(item)
+    return merged + added
+
+
+class SessionConflict(Exception):
+    """The stored session changed since the version a write was based on"""
+
+
+class MemorySessionBackend:
+    """Single-process store: sessions survive reruns and page reloads, not restarts"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, token, unless_version=None):
+        """(version, state), or None if missing or still at unless_version"""
+        with self._lock:
+            entry = self._sessions.get(token)
+            if entry is None or entry[0] == unless_version:
+                return None
+            return entry[0], copy.deepcopy(entry[1])
+
+    def put(self, token, state, expected_version):
+        """Store state if the session is still at expected_version (0: new); returns the new version"""
+        with self._lock:
+            current = self._sessions.get(token, (0, None))[0]
+            if current != expected_version:
+                raise SessionConflict(token)
+            self._sessions[token] = (current + 1, copy.deepcopy(state))
+            return current + 1
+
+    def delete(self, token):
+        with self._lock:
+            self._sessions.pop(token, None)
+
+
+class MongoSessionBackend:
+    """Mongo-backed store shared by every app replica
+
+    Each session is one document with a version counter. Writes are conditional on
+    that counter, and a TTL index removes sessions idle for longer than ttl_hours.
+    """
+
+    def __init__(self, collection, ttl_hours=72):
+        self.collection = collection
+        self.collection.create_index('updated_at', expireAfterSeconds=int(ttl_hours * 3600))
+
+    def get(self, token, unless_version=None):
+        query = {'_id': token}
+        if unless_version is not None:
+            # Nothing comes back over the wire while the cached version is current
+            query['version'] = {'$ne': unless_version}
+        doc = self.collection.find_one(query)
+        return (doc['version'], doc['state']) if doc else None
+
+    def put(self, token, state, expected_version):
+        now = datetime.now()
+        if expected_version == 0:
+            try:
+                self.collection.insert_one({'_id': token, 'version': 1, 'state': state, 'updated_at': now})
+            except DuplicateKeyError:
+                raise SessionConflict(token)
+            return 1
+        result = self.collection.update_one(
+            {'_id': token, 'version': expected_version},
+            {'$set': {'state': state, 'updated_at': now}, '$inc': {'version': 1}},
+        )
+        if result.matched_count == 0:
+            raise SessionConflict(token)
+        return expected_version + 1
+
+    def delete(self, token):
+        self.collection.delete_one({'_id': token})
+
+
+class SessionStore:
+    """Per-session state (login, cart, recent messages) shared across app replicas
+
+    Reads go through a local cache. Once an entry is older than revalidate_after
+    seconds, it is checked with a conditional read that returns nothing while the
+    version is unchanged. Writes are conditional on the version they were based on.
+    On a conflict, the latest state is fetched and the update is applied again, so
+    an update must be an edit of the state (see save) rather than a replacement.
+    """
+
+    def __init__(self, backend=None, revalidate_after=1.0, max_retries=3, max_cached=1024):
+        self.backend = backend or MemorySessionBackend()
+        self.revalidate_after = revalidate_after
+        self.max_retries = max_retries
+        self.max_cached = max_cached
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.writes = 0
+        self.conflicts = 0
+
+    @classmethod
+    def from_settings(cls, collection=None):
+        """Build the store chosen by SESSION_STORE ("mongo", "memory" or "off")
+
+        Defaults to mongo when the storage backend provides a sessions collection and to
+        memory otherwise; returns None when "off".
+        """
+        mode = (get_setting('SESSION_STORE') or ('mongo' if collection is not None else 'memory')).lower()
+        revalidate_after = float(get_setting('SESSION_REVALIDATE_SECONDS') or 1.0)
+        if mode == 'mongo' and collection is not None:
+            ttl_hours = float(get_setting('SESSION_TTL_HOURS') or 72)
+            return cls(MongoSessionBackend(collection, ttl_hours=ttl_hours), revalidate_after=revalidate_after)
+        if mode == 'memory':
+            return cls(MemorySessionBackend(), revalidate_after=revalidate_after)
+        return None
+
+    @staticmethod
+    def new_token():
+        return secrets.token_urlsafe(16)
+
+    def _remember(self, token, version, state):
+        with self._lock:
+            self._cache[token] = (version, state, time.monotonic())
+            self._cache.move_to_end(token)
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+
+    def load(self, token):
+        """(version, state) for the session, or None if it does not exist; state is a private copy"""
+        with self._lock:
+            cached = self._cache.get(token)
+            if cached is not None and time.monotonic() - cached[2] < self.revalidate_after:
+                self.hits += 1
+                return cached[0], copy.deepcopy(cached[1])
+
+        try:
+            fresh = self.backend.get(token, unless_version=cached[0] if cached else None)
+        except Exception as e:
+            print(f"Session store read failed: {e}")
+            return (cached[0], copy.deepcopy(cached[1])) if cached else None
+        with self._lock:
+            if fresh is None and cached is not None:
+                self.revalidations += 1
+            else:
+                self.misses += 1
+        if fresh is None and cached is None:
+            return None
+        fresh = fresh or cached[:2]
+        self._remember(token, *fresh)
+        return fresh[0], copy.deepcopy(fresh[1])
+
+    def update(self, token, mutate):
+        """Apply mutate(state) to the latest state and store it; returns (version, state)
+
+        mutate receives a private copy (an empty dict for a new session) and edits it in
+        place. It may run more than once if other replicas write concurrently.
+        """
+        for attempt in range(self.max_retries + 1):
+            loaded = self.load(token)
+            version, state = loaded if loaded is not None else (0, {})
+            mutate(state)
+            try:
+                new_version = self.backend.put(token, state, version)
+            except SessionConflict:
+                with self._lock:
+                    self.conflicts += 1
+                    self._cache.pop(token, None)
+                if attempt == self.max_retries:
+                    raise
+                continue
+            with self._lock:
+                self.writes += 1
+            self._remember(token, new_version, copy.deepcopy(state))
+            return new_version, state
+
+    def save(self, token, changes, base=None):
+        """Set the given fields on the session, keeping what another replica changed meanwhile
+
+        base holds the values the changes were made from. A list field that no longer
+        matches its base (e.g. another replica added to the cart) gets this write's
+        removals and additions applied to it instead of being overwritten.
+        """
+        changes = copy.deepcopy(changes)
+        base = base or {}
+
+        def apply(state):
+            for key, value in changes.items():
+                current = state.get(key)
+                if key in base and current != base[key] and isinstance(value, list) and isinstance(current, list):
+                    state[key] = _merge_list(current, base[key], value)
+                else:
+                    state[key] = value
+
+        return self.update(token, apply)
+
+    def delete(self, token):
+        with self._lock:
+            self._cache.pop(token, None)
+        self.backend.delete(token)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "cached": len(self._cache),
+                "hits": self.hits,
+                "revalidations": self.revalidations,
+                "misses": self.misses,
+                "writes": self.writes,
+                "conflicts": self.conflicts,
+            }
@@ -0,0 +1,20 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+try:
+    import streamlit as st
+except Exception:
+    st = None
+
+
+def get_setting(key: str):
+    """Streamlit secret named key, else the environment variable (.env is loaded first)"""
+    if st is not None:
+        try:
+            if key in st.secrets:
+                return st.secrets[key]
+        except Exception:
+            pass
+    return os.getenv(key)
@@ -0,0 +1,206 @@
+"""Checks for the OpenRouter circuit breaker, on a fake clock and against the local mock server
+
+    python test_circuit_breaker.py
+"""
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from unittest import mock
+
+import circuit_breaker
+import openrouter_client
+from circuit_breaker import CircuitBreaker
+from local_answers import LocalAnswerer
+from mock_openrouter import Latency, MockOpenRouter
+from model_router import ModelRouter
+from openrouter_client import OFFLINE_REPLY, OpenRouterClient
+
+
+class FakeClock:
+    """Stands in for the time module in circuit_breaker; sleep() blocks until advance() passes its deadline"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleepers = 0
+        self._cond = threading.Condition()
+
+    def monotonic(self):
+        with self._cond:
+            return self.now
+
+    def sleep(self, seconds):
+        with self._cond:
+            until = self.now + seconds
+            self.sleepers += 1
+            try:
+                while self.now < until:
+                    self._cond.wait()
+            finally:
+                self.sleepers -= 1
+
+    def advance(self, seconds):
+        with self._cond:
+            self.now += seconds
+            self._cond.notify_all()
+
+
+@contextmanager
+def fake_clock():
+    clock = FakeClock()
+    with mock.patch.object(circuit_breaker, "time", clock):
+        yield clock
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def advance_prober(clock, seconds):
+    """Let the background prober's sleep run out"""
+    wait_for(lambda: clock.sleepers)
+    clock.advance(seconds)
+
+
+def check_opens_half_opens_and_closes():
+    with fake_clock() as clock:
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+        breaker.record_failure()
+        breaker.record_failure()
+        assert breaker.allow() and breaker.state == CircuitBreaker.CLOSED
+        breaker.record_failure()
+        assert breaker.is_open and not breaker.allow() and breaker.trips == 1
+        assert breaker.stats()["rejected"] == 1
+
+        clock.advance(29)
+        assert not breaker.allow()
+        # Half-open once reset_timeout has passed: one request goes through ...
+        clock.advance(1)
+        assert breaker.allow() and not breaker.is_open
+        # ... and a single failure trips it again
+        breaker.record_failure()
+        assert breaker.is_open and breaker.trips == 2
+
+        clock.advance(30)
+        assert breaker.allow()
+        breaker.record_success()
+        assert breaker.stats() == {"state": "closed", "consecutive_failures": 0, "open_for": 0.0,
+                                   "trips": 2, "rejected": 2}
+        # Closed again, so it takes the full threshold to trip
+        breaker.record_failure()
+        breaker.record_failure()
+        assert breaker.allow()
+
+
+def check_success_resets_failure_count():
+    breaker = CircuitBreaker(failure_threshold=3)
+    for _ in range(5):
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+    assert breaker.allow() and breaker.trips == 0
+
+
+def check_probe_closes_circuit():
+    with fake_clock() as clock:
+        answers = [False, True]
+        calls = []
+
+        def probe():
+            calls.append(clock.monotonic())
+            return answers[len(calls) - 1]
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, probe=probe)
+        breaker.record_failure()
+        assert breaker.is_open and not calls
+        # With a probe the circuit never half-opens on its own
+        advance_prober(clock, 30)
+        wait_for(lambda: len(calls) == 1)
+        assert breaker.is_open
+        advance_prober(clock, 30)
+        wait_for(lambda: not breaker.is_open)
+        assert calls == [30.0, 60.0] and breaker.allow()
+
+
+@contextmanager
+def mock_client(server):
+    """OpenRouterClient pointed at a started mock server, with local answers and no retries"""
+    base_url = server.start()
+    try:
+        client = OpenRouterClient()
+        client.api_key = "test"
+        client.base_url = base_url
+        client.max_retries = 0
+        client.local_answers = LocalAnswerer.from_file("data.json")
+        yield client
+    finally:
+        server.stop()
+
+
+def check_probe_tries_every_routed_model():
+    # Both reply models are too slow for the probe; only the extraction model answers in time
+    server = MockOpenRouter(model_latency={"a/reply": Latency("fixed:1"), "b/reply": Latency("fixed:1")})
+    with mock_client(server) as client, mock.patch.object(openrouter_client, "PROBE_TIMEOUT", 0.2):
+        client.router = ModelRouter({"reply": ["a/reply", "b/reply"], "extract": ["b/reply", "c/extract"]})
+        assert client._probe()
+        assert server.stats()["models"] == {"a/reply": 1, "b/reply": 1, "c/extract": 1}
+
+
+def check_local_answers_while_open():
+    server = MockOpenRouter(error_rate=1.0, error_statuses=(503,))
+    with fake_clock() as clock, mock_client(server) as client:
+        client.router = ModelRouter({"reply": ["test/model"], "extract": ["test/model"]})
+        for _ in range(client.breaker.failure_threshold):
+            client.get_waiter_response("Tell me a joke")
+        assert client.breaker.is_open
+        requests_made = server.stats()["requests"]
+
+        payment = client.get_waiter_response("How can I pay?")
+        assert payment.startswith("You can pay with:")
+        assert "".join(client.get_waiter_response("How can I pay?", stream=True)) == payment
+        assert client.get_waiter_response("Tell me a joke") == OFFLINE_REPLY
+        reply, _ = client.get_waiter_response_with_order("How can I pay?")
+        assert reply == payment
+        # Nothing reached the upstream while the circuit was open
+        assert server.stats()["requests"] == requests_made
+
+        # The upstream recovers; the next probe closes the circuit and replies come from the LLM again
+        server.error_rate = 0.0
+        advance_prober(clock, client.breaker.reset_timeout)
+        wait_for(lambda: not client.breaker.is_open)
+        assert client.get_waiter_response("Tell me a joke") == server.reply
+
+
+CHECKS = [
+    check_opens_half_opens_and_closes,
+    check_success_resets_failure_count,
+    check_probe_closes_circuit,
+    check_probe_tries_every_routed_model,
+    check_local_answers_while_open,
+]
+
+
+def test_circuit_breaker():
+    for check in CHECKS:
+        check()
+
+
+def main():
+    failures = 0
+    for check in CHECKS:
+        try:
+            check()
+        except Exception as e:
+            failures += 1
+            print(f"FAIL {check.__name__}: {type(e).__name__} {e}")
+        else:
+            print(f"ok   {check.__name__}")
+    print("All checks passed" if not failures else f"{failures} checks failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
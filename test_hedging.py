@@ -0,0 +1,133 @@
+"""Checks for hedged OpenRouter calls against the local mock server
+
+    python test_hedging.py
+
+The primary model answers slowly, so every routed call hedges to the fallback.
+"""
+import sys
+import time
+from contextlib import contextmanager
+from unittest import mock
+
+import openrouter_client
+from mock_openrouter import Latency, MockOpenRouter
+from model_router import ModelRouter
+from openrouter_client import OpenRouterClient
+
+SLOW, FAST = "slow/model", "fast/model"
+MESSAGES = [{"role": "user", "content": "Any deals for two people?"}]
+# Well past the hedge delay, so the primary only answers after the fallback has won
+SLOW_LATENCY = 1.5
+
+
+class RecordedCall(openrouter_client._Call):
+    """_Call that remembers every instance, in creation order"""
+
+    made = []
+
+    def __init__(self, limiter):
+        super().__init__(limiter)
+        RecordedCall.made.append(self)
+
+
+@contextmanager
+def hedged_client():
+    """OpenRouterClient routed to a slow primary and a fast fallback on a fresh mock server"""
+    server = MockOpenRouter(model_latency={SLOW: Latency(f"fixed:{SLOW_LATENCY}"), FAST: Latency("fixed:0")},
+                            token_delay=0.01)
+    base_url = server.start()
+    RecordedCall.made = []
+    try:
+        with mock.patch.object(openrouter_client, "_Call", RecordedCall):
+            client = OpenRouterClient()
+            client.api_key = "test"
+            client.base_url = base_url
+            client.router = ModelRouter({"reply": [SLOW, FAST], "extract": [SLOW, FAST]})
+            # Enough fast samples that the primary's p95, and so the hedge delay, is the 0.5 s minimum
+            for task in ("reply", "stream"):
+                for _ in range(5):
+                    client.router.record(task, SLOW, 0.1, True)
+            yield client, server
+    finally:
+        server.stop()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def check_loser(client):
+    """The primary's call was abandoned, its response closed, and every limiter slot is back"""
+    assert client._limiter._value == client.max_in_flight, "abandoned call kept its slot"
+    loser, _ = RecordedCall.made
+    assert loser.abandoned
+    # The primary's headers arrive after it lost; attaching them closes the response at once
+    wait_for(lambda: loser.response is not None)
+    assert loser.response.raw.closed
+    assert client._limiter._value == client.max_in_flight
+
+
+def check_completion_hedges_to_fallback():
+    with hedged_client() as (client, server):
+        started = time.perf_counter()
+        response = client._routed_completion("reply", MESSAGES, timeout=10)
+        assert time.perf_counter() - started < SLOW_LATENCY
+        assert response["model"] == FAST and client._content(response)
+        assert not RecordedCall.made[1].abandoned
+        decision = client.router.snapshot()["decisions"][-1]
+        assert decision["attempted"] == [SLOW, FAST] and decision["winner"] == FAST
+        check_loser(client)
+        assert server.stats()["models"] == {SLOW: 1, FAST: 1}
+
+
+def check_stream_hedges_to_fallback():
+    with hedged_client() as (client, server):
+        started = time.perf_counter()
+        stream = client._routed_stream("stream", MESSAGES, timeout=10)
+        first = next(stream)
+        assert time.perf_counter() - started < SLOW_LATENCY
+        # Once the fallback's first chunk is in, only its stream still holds a slot
+        loser, winner = RecordedCall.made
+        assert loser.abandoned and not winner.abandoned
+        assert client._limiter._value == client.max_in_flight - 1
+        text = first + "".join(stream)
+        assert text == server.reply
+        decision = client.router.snapshot()["decisions"][-1]
+        assert decision["attempted"] == [SLOW, FAST] and decision["winner"] == FAST
+        check_loser(client)
+
+
+def check_waiter_reply_through_hedge():
+    with hedged_client() as (client, _):
+        stream = client.get_waiter_response("Any deals?", stream=True, timeout=10)
+        assert "".join(stream) and not stream.truncated
+        check_loser(client)
+
+
+CHECKS = [check_completion_hedges_to_fallback, check_stream_hedges_to_fallback, check_waiter_reply_through_hedge]
+
+
+def test_hedging():
+    for check in CHECKS:
+        check()
+
+
+def main():
+    failures = 0
+    for check in CHECKS:
+        try:
+            check()
+        except Exception as e:
+            failures += 1
+            print(f"FAIL {check.__name__}: {type(e).__name__} {e}")
+        else:
+            print(f"ok   {check.__name__}")
+    print("All checks passed" if not failures else f"{failures} checks failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""Table-driven checks for the local order extractor, against the menu in data.json
+
+    python test_order_extractor.py
+"""
+import json
+import sys
+
+from database import build_menu_documents
+from mock_openrouter import MockOpenRouter
+from model_router import ModelRouter
+from openrouter_client import OpenRouterClient
+from order_extractor import LOCAL_ACCEPT_SCORE, MenuOrderExtractor
+
+# Exact matches with order intent, and misspellings that still score LOCAL_ACCEPT_SCORE or better
+ACCEPTED = [
+    # (message, items, quantities)
+    ("I want 2 large tarzan tikka pizzas", ["Tarzan Tikka Pizza (Large)"], [2]),
+    ("give me 2 garlic bread and a tarzan tikka", ["Garlic Bread", "Tarzan Tikka Pizza"], [2, 1]),
+    ("Can I get a Kebab Zone calzone?", ["Kebab Zone Calzone"], [1]),
+    ("I want 2 large habanero kik pizzas", ["Habanero Kick Pizza (Large)"], [2]),
+    ("I want a tarzan tika", ["Tarzan Tikka Pizza"], [1]),
+]
+
+# Messages the LLM has to decide: confidence 0 sends them to the model
+DEFERRED = [
+    # Fuzzy match below LOCAL_ACCEPT_SCORE
+    "Ill have a mughlai beest and 2 garlic breads",
+    # Order-shaped, but nothing on the menu matched
+    "I want 2 large Pepperoni pizzas",
+    "I want two large pizzas",
+    "order 3 fajita sixer pizza",
+    # Menu items without order intent
+    "tarzan tikka please",
+    "kebab zone calzone",
+]
+
+# (message, is_question): questions about an item are never complete orders, even with a match
+QUESTIONS = [
+    ("Do you have Kebab Zone calzone?", True),
+    ("garlic bread?", True),
+    ("How much is garlic bread", True),
+    ("Are the plain wings spicy", True),
+    ("Tell me about dancing fajita", True),
+    # Order intent wins over a trailing "?"
+    ("I want a tarzan tikka?", False),
+    ("Can I get a Kebab Zone calzone?", False),
+]
+
+# Small talk: nothing to extract, and confidently so
+SMALL_TALK = ["hello there", "thanks a lot"]
+
+
+def load_extractor():
+    with open("data.json", encoding="utf-8") as f:
+        data = json.load(f)
+    return MenuOrderExtractor([doc for doc in build_menu_documents(data) if doc.get("type") != "restaurant_info"])
+
+
+def check_accepted(extractor):
+    for message, items, quantities in ACCEPTED:
+        result = extractor.extract(message)
+        assert (result["items"], result["quantities"]) == (items, quantities), message
+        assert all(match["score"] >= LOCAL_ACCEPT_SCORE for match in result["matches"]), message
+        assert result["confidence"] >= extractor.min_confidence and result["is_complete_order"], message
+
+
+def check_deferred(extractor):
+    for message in DEFERRED:
+        assert extractor.extract(message)["confidence"] == 0.0, message
+
+
+def check_questions(extractor):
+    for message, is_question in QUESTIONS:
+        result = extractor.extract(message)
+        assert result["items"], message
+        assert result["is_complete_order"] != is_question, message
+        if is_question:
+            assert result["confidence"] == 0.0, message
+
+
+def check_small_talk(extractor):
+    for message in SMALL_TALK:
+        result = extractor.extract(message)
+        assert result["items"] == [] and result["confidence"] == 1.0 and not result["is_complete_order"], message
+
+
+def check_client_defers_to_llm(extractor):
+    """Accepted messages never reach the model; deferred ones always do"""
+    server = MockOpenRouter()
+    base_url = server.start()
+    try:
+        client = OpenRouterClient()
+        client.api_key = "test"
+        client.base_url = base_url
+        client.router = ModelRouter({"reply": ["test/model"], "extract": ["test/model"]})
+        client.order_extractor = extractor
+        for message, items, _ in ACCEPTED:
+            order = client.extract_order_info(message)
+            assert order["source"] == "local" and order["items"] == items, message
+        assert server.stats()["requests"] == 0
+        for message in DEFERRED:
+            assert "source" not in client.extract_order_info(message), message
+        assert server.stats()["requests"] == len(DEFERRED)
+    finally:
+        server.stop()
+
+
+CHECKS = [check_accepted, check_deferred, check_questions, check_small_talk, check_client_defers_to_llm]
+
+
+def test_order_extractor():
+    extractor = load_extractor()
+    for check in CHECKS:
+        check(extractor)
+
+
+def main():
+    extractor = load_extractor()
+    failures = 0
+    for check in CHECKS:
+        try:
+            check(extractor)
+        except Exception as e:
+            failures += 1
+            print(f"FAIL {check.__name__}: {type(e).__name__} {e}")
+        else:
+            print(f"ok   {check.__name__}")
+    print("All checks passed" if not failures else f"{failures} checks failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Checks for the shared session store
+
+    python test_session_store.py
+
+Two SessionStore instances over one backend stand in for two app replicas.
+"""
+import sys
+
+from session_store import MemorySessionBackend, SessionConflict, SessionStore
+
+
+def replicas(revalidate_after=60.0):
+    backend = MemorySessionBackend()
+    return (SessionStore(backend, revalidate_after=revalidate_after),
+            SessionStore(backend, revalidate_after=revalidate_after))
+
+
+def check_round_trip():
+    a, b = replicas(revalidate_after=0)
+    assert a.load('t') is None
+    version, state = a.save('t', {'customer_name': 'ann', 'current_order': []})
+    assert version == 1 and b.load('t') == (1, {'customer_name': 'ann', 'current_order': []})
+    state['current_order'].append('Pepsi')
+    assert b.load('t')[1]['current_order'] == [], "callers must get private copies"
+    a.delete('t')
+    assert a.load('t') is None
+
+
+def check_stale_cache_revalidates():
+    a, b = replicas(revalidate_after=0)
+    a.save('t', {'customer_name': 'ann'})
+    b.load('t')
+    a.save('t', {'customer_name': 'bob'})
+    assert b.load('t') == (2, {'customer_name': 'bob'})
+    assert b.load('t') == (2, {'customer_name': 'bob'}) and b.stats()['revalidations'] == 1
+
+
+def check_concurrent_cart_edits_merge():
+    a, b = replicas()
+    _, base = a.save('t', {'current_order': ['Pepsi'], 'messages': [{'role': 'user', 'content': 'hi'}]})
+    b.load('t')
+
+    # Replica A adds Fries; replica B, still on its cached copy, adds Garlic Bread
+    a.save('t', {'current_order': ['Pepsi', 'Fries']}, base=base)
+    version, state = b.save('t', {'current_order': ['Pepsi', 'Garlic Bread']}, base=base)
+    assert state['current_order'] == ['Pepsi', 'Fries', 'Garlic Bread']
+    assert version == 3 and b.stats()['conflicts'] == 1
+
+    # A removal made from a stale base still removes only that item
+    a.save('t', {'current_order': ['Fries', 'Garlic Bread']}, base={'current_order': ['Pepsi', 'Fries', 'Garlic Bread']})
+    _, state = b.save('t', {'current_order': ['Pepsi']}, base={'current_order': ['Pepsi', 'Fries']})
+    assert state['current_order'] == ['Garlic Bread']
+
+
+def check_concurrent_messages_merge():
+    a, b = replicas()
+    hello = {'role': 'user', 'content': 'hello'}
+    _, base = a.save('t', {'messages': [hello], 'customer_name': 'ann'})
+    b.load('t')
+    a.save('t', {'messages': [hello, {'role': 'assistant', 'content': 'from a'}]}, base=base)
+    _, state = b.save('t', {'messages': [hello, {'role': 'assistant', 'content': 'from b'}]}, base=base)
+    assert [m['content'] for m in state['messages']] == ['hello', 'from a', 'from b']
+    assert state['customer_name'] == 'ann'
+
+
+def check_conflicts_give_up():
+    a, _ = replicas()
+    a.save('t', {'n': 0})
+
+    class Racing(MemorySessionBackend):
+        def put(self, token, state, expected_version):
+            raise SessionConflict(token)
+
+    racing = SessionStore(Racing(), max_retries=2)
+    try:
+        racing.save('t', {'n': 1})
+    except SessionConflict:
+        assert racing.stats()['conflicts'] == 3
+    else:
+        raise AssertionError("expected SessionConflict")
+
+
+CHECKS = [
+    check_round_trip, check_stale_cache_revalidates, check_concurrent_cart_edits_merge,
+    check_concurrent_messages_merge, check_conflicts_give_up,
+]
+
+
+def test_session_store():
+    for check in CHECKS:
+        check()
+
+
+def main():
+    failures = 0
+    for check in CHECKS:
+        try:
+            check()
+        except Exception as e:
+            failures += 1
+            print(f"FAIL {check.__name__}: {type(e).__name__} {e}")
+        else:
+            print(f"ok   {check.__name__}")
+    print("All checks passed" if not failures else f"{failures} checks failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
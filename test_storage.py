@@ -0,0 +1,377 @@
+"""Conformance checks and a latency benchmark for the storage backends
+
+    python test_storage.py [memory] [sqlite] [mongomock] [mongo]  run the checks
+    python test_storage.py --benchmark [--json out.json] [...]    compare per-operation latency
+
+Backends default to memory, sqlite and, when the mongomock package is installed,
+mongomock: the Mongo backend against an in-process mongomock server. mongo uses
+MONGODB_URI with a throwaway restaurant_chatbot_conformance database that is dropped
+afterwards.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import mock
+
+from pymongo import DeleteOne, InsertOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from database import (
+    CHANGE_STREAMS_UNSUPPORTED, CONVERSATION_MAX_MESSAGES, CONVERSATION_OVERFLOW, RestaurantDatabase,
+)
+from embedded_database import MemoryDatabase, SQLiteDatabase
+from menu_index import FULL_MENU_HEADING
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+def _mongomock_bulk_write(self, requests, ordered=True, **kwargs):
+    """bulk_write for mongomock, whose own one rejects the operations of current pymongo"""
+    errors = []
+    for index, request in enumerate(requests):
+        try:
+            if isinstance(request, InsertOne):
+                self.insert_one(request._doc)
+            elif isinstance(request, UpdateOne):
+                self.update_one(request._filter, request._doc, upsert=request._upsert)
+            elif isinstance(request, UpdateMany):
+                self.update_many(request._filter, request._doc, upsert=request._upsert)
+            elif isinstance(request, DeleteOne):
+                self.delete_one(request._filter)
+            else:
+                raise TypeError(f"Unsupported bulk operation {request!r}")
+        except DuplicateKeyError as e:
+            errors.append({'index': index, 'code': e.code, 'errmsg': str(e)})
+            if ordered:
+                break
+    if errors:
+        raise BulkWriteError({'writeErrors': errors, 'writeConcernErrors': [], 'nInserted': 0})
+
+
+def _mongomock_watch(self, *args, **kwargs):
+    # What a standalone mongod answers, so the order feed falls back to polling
+    raise OperationFailure("The $changeStream stage is only supported on replica sets", CHANGE_STREAMS_UNSUPPORTED)
+
+
+@contextmanager
+def scratch_database(backend):
+    """An empty database of the given backend, removed afterwards"""
+    if backend == 'memory':
+        yield MemoryDatabase()
+    elif backend == 'sqlite':
+        with tempfile.TemporaryDirectory() as directory:
+            yield SQLiteDatabase(os.path.join(directory, 'conformance.db'))
+    elif backend == 'mongomock':
+        if mongomock is None:
+            raise RuntimeError("the mongomock backend needs the mongomock package")
+        with mock.patch('database.MongoClient', mongomock.MongoClient), \
+                mock.patch.object(mongomock.collection.Collection, 'bulk_write', _mongomock_bulk_write), \
+                mock.patch.object(mongomock.collection.Collection, 'watch', _mongomock_watch, create=True), \
+                mock.patch.dict(os.environ, {'MONGODB_URI': 'mongodb://mongomock'}):
+            db = RestaurantDatabase(database_name='restaurant_chatbot_conformance')
+            try:
+                yield db
+            finally:
+                db.client.drop_database(db.db.name)
+    elif backend == 'mongo':
+        db = RestaurantDatabase(database_name='restaurant_chatbot_conformance')
+        try:
+            yield db
+        finally:
+            db.client.drop_database(db.db.name)
+    else:
+        raise ValueError(f"Unknown backend {backend!r}")
+
+
+def check_menu(db):
+    assert db.get_menu_version()
+    items = db.get_menu_items()
+    assert items and all(item.get('type') != 'restaurant_info' for item in items)
+    assert db.get_menu_items('Pizza') and all(item['category'] == 'Pizza' for item in db.get_menu_items('Pizza'))
+    assert db.get_restaurant_info().get('name')
+    assert db.load_menu_data() is False
+    assert db.load_menu_data(force=True) is True
+    assert len(db.get_menu_items()) == len(items)
+    assert any('garlic' in item['name'].lower() for item in db.search_menu('GARLIC'))
+    assert all('_id' not in item for item in db.search_menu('pizza'))
+    ranked = db.get_menu_context('large pizza please', mode='ranked')
+    assert 'pizza' in ranked.lower() and not ranked.startswith(FULL_MENU_HEADING)
+    assert ranked != db.get_menu_context('garlic bread', mode='ranked')
+    full = db.get_menu_context('large pizza please', mode='full')
+    assert full.startswith(FULL_MENU_HEADING) and full == db.get_menu_context('garlic bread', mode='full')
+    assert all(item['name'] in full for item in items if item.get('name'))
+    assert len(ranked) < len(full)
+
+
+def check_orders(db):
+    first = db.create_order('ann', '0300', ['Garlic Bread'], 10)
+    second = db.create_order('bob', '0301', ['Pepsi', 'Fries'], 5)
+    batch = [db.new_order_document('cy', '0302', ['Lasagna'], 20) for _ in range(2)]
+    db.insert_orders(batch)
+    db.insert_orders(batch)  # a retried batch must not be stored or counted twice
+    assert isinstance(first, str)
+
+    orders = db.get_orders()
+    assert len(orders) == 4 and all(isinstance(order['_id'], str) for order in orders)
+    by_id = {order['_id']: order for order in orders}
+    assert by_id[second]['items'] == ['Pepsi', 'Fries'] and by_id[second]['total_amount'] == 5
+    assert by_id[first]['status'] == 'pending'
+
+    db.update_order_status(first, 'completed')
+    db.update_order_status(str(batch[0]['_id']), 'completed')
+    db.update_order_status(str(batch[0]['_id']), 'completed')
+    db.update_order_status('not-an-id', 'completed')
+    assert {order['_id'] for order in db.get_orders('completed')} == {first, str(batch[0]['_id'])}
+    assert len(db.get_orders('pending')) == 2
+
+    stats = db.get_order_stats()
+    assert {stat['_id']: stat['count'] for stat in stats['status_stats']} == {'completed': 2, 'pending': 2}
+    assert [(day['revenue'], day['count']) for day in stats['daily_stats']] == [(30, 2)]
+
+    if isinstance(db, RestaurantDatabase):
+        # The rebuild skips an order whose insert has not bumped the rollups yet; the retried insert counts it
+        late = db.new_order_document('dee', '0303', ['Pepsi'], 3)
+        db.orders_collection.insert_one(dict(late, rollup_pending=True))
+        db.rebuild_order_rollups()
+        stats = db.get_order_stats()
+        assert {stat['_id']: stat['count'] for stat in stats['status_stats']} == {'completed': 2, 'pending': 2}
+        db.insert_orders([late])
+        stats = db.get_order_stats()
+        assert {stat['_id']: stat['count'] for stat in stats['status_stats']} == {'completed': 2, 'pending': 3}
+
+
+def check_order_pages(db):
+    ids = [db.create_order(f'page{i}', '0', ['Pepsi'], i) for i in range(5)]
+    newest_first = ids[::-1]
+
+    page = db.get_orders_page(page_size=2)
+    seen = [order['_id'] for order in page['orders']]
+    assert page['prev_token'] is None and set(page['orders'][0]) == {
+        '_id', 'customer_name', 'customer_phone', 'items', 'total_amount', 'status', 'created_at',
+    }
+    pages = [page]
+    while page['next_token']:
+        page = db.get_orders_page(page_size=2, page_token=page['next_token'])
+        pages.append(page)
+        seen += [order['_id'] for order in page['orders']]
+    assert seen[:5] == newest_first and len(seen) == len(set(seen))
+
+    back = db.get_orders_page(page_size=2, page_token=pages[1]['prev_token'])
+    assert [order['_id'] for order in back['orders']] == [order['_id'] for order in pages[0]['orders']]
+
+    db.update_order_status(ids[0], 'cancelled')
+    assert [order['_id'] for order in db.get_orders_page('cancelled')['orders']] == [ids[0]]
+
+
+def check_order_changes(db):
+    empty = db.get_order_changes()
+    assert empty['orders'] == [] and not empty['reset']
+    first = db.create_order('fay', '0', ['Pepsi'], 1)
+    second = db.create_order('gus', '0', ['Fries'], 2)
+
+    changes = db.get_order_changes(empty['token'])
+    assert [order['_id'] for order in changes['orders']] == [first, second]
+    assert changes['orders'][0]['updated_at'] and 'customer_phone' in changes['orders'][0]
+    assert db.get_order_changes(changes['token'])['orders'] == []
+
+    start = db.get_order_changes()['token']
+    db.update_order_status(first, 'completed')
+    changes = db.get_order_changes(start)
+    assert [(order['_id'], order['status']) for order in changes['orders']] == [(first, 'completed')]
+
+    batch = [db.new_order_document('hal', '0', ['Lasagna'], 3) for _ in range(3)]
+    db.insert_orders(batch)
+    page = db.get_order_changes(changes['token'], limit=2)
+    assert len(page['orders']) == 2 and page['more']
+    rest = db.get_order_changes(page['token'], limit=2)
+    assert len(rest['orders']) == 1 and not rest['more']
+    assert {order['_id'] for order in page['orders'] + rest['orders']} == {str(order['_id']) for order in batch}
+
+    # An order landing at the same updated_at as one already returned, but with a smaller ID
+    earlier, later = (db.new_order_document('ivy', '0', ['Pepsi'], 1) for _ in range(2))
+    tie = datetime.now().replace(microsecond=0) + timedelta(seconds=5)
+    earlier['updated_at'] = later['updated_at'] = tie
+    db.insert_orders([later])
+    changes = db.get_order_changes(rest['token'])
+    assert [order['_id'] for order in changes['orders']] == [str(later['_id'])]
+    db.insert_orders([earlier])
+    assert [order['_id'] for order in db.get_order_changes(changes['token'])['orders']] == [str(earlier['_id'])]
+
+
+def check_conversations(db):
+    assert db.get_conversation('dee') == []
+    assert db.get_conversation_window('dee') == {'messages': [], 'start': 0, 'summary': None, 'summary_upto': 0}
+
+    turns = [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'm{i}'} for i in range(10)]
+    db.append_conversation('dee', turns[:4])
+    db.append_conversations({'dee': turns[4:10], 'eve': turns[:2], 'nobody': []})
+    assert db.get_conversation('dee') == turns
+    assert db.get_conversation('dee', limit=3) == turns[-3:]
+
+    window = db.get_conversation_window('dee', limit=4)
+    assert window['messages'] == turns[6:] and window['start'] == 6 and window['summary_upto'] == 0
+
+    page = db.get_conversation_page('dee', before=6, limit=4)
+    assert page == {'messages': turns[2:6], 'start': 2, 'has_more': True}
+    page = db.get_conversation_page('dee', before=2, limit=4)
+    assert page == {'messages': turns[:2], 'start': 0, 'has_more': False}
+    assert db.get_conversation_page('nobody', before=5)['messages'] == []
+
+    summary = {'notes': ['likes spicy'], 'items': []}
+    db.save_conversation_summary('dee', summary, 4)
+    db.save_conversation_summaries({'dee': ({'notes': [], 'items': []}, 2), 'ghost': (summary, 2)})
+    window = db.get_conversation_window('dee')
+    assert window['summary'] == summary and window['summary_upto'] == 4 and window['messages'] == turns
+    assert 'ghost' not in db.get_all_customers()
+
+    db.save_conversation('eve', turns[:3])
+    assert db.get_conversation('eve') == turns[:3]
+    assert sorted(db.get_all_customers()) == ['dee', 'eve']
+    db.delete_conversation('eve')
+    assert db.get_conversation('eve') == [] and db.get_all_customers() == ['dee']
+
+    if isinstance(db, RestaurantDatabase) and CONVERSATION_OVERFLOW != 'truncate':
+        # A conversation saved before head_count was tracked still spills once over the limit
+        legacy = [{'role': 'user', 'content': f'old{i}'} for i in range(CONVERSATION_MAX_MESSAGES + 1)]
+        db.conversations_collection.insert_one({'customer_name': 'fay', 'messages': legacy})
+        db.append_conversations({'fay': turns[:1]})
+        doc = db.conversations_collection.find_one({'customer_name': 'fay'})
+        assert doc['head_count'] == len(doc['messages']) <= CONVERSATION_MAX_MESSAGES
+        assert doc['message_count'] == len(legacy) + 1
+        db.delete_conversation('fay')
+
+    if isinstance(db, RestaurantDatabase):
+        # Retried appends rely on the unique customer_name index, so startup must not go on without it
+        db.conversations_collection.drop_index([('customer_name', 1)])
+        db.conversations_collection.insert_many([{'customer_name': 'gus', 'messages': []} for _ in range(2)])
+        try:
+            db.ensure_indexes()
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("expected RuntimeError for duplicate conversations")
+        db.conversations_collection.delete_many({'customer_name': 'gus'})
+        db.ensure_indexes()
+
+
+def check_token_usage(db):
+    day = time.strftime('%Y-%m-%d')
+    row = {'calls': 1, 'prompt_tokens': 100, 'completion_tokens': 20, 'cached_tokens': 50, 'cost': 0.5}
+    db.bump_token_usage([((day, 'ann', 'waiter', 'm1'), row), ((day, 'bob', 'extract', 'm2'), row)])
+    db.bump_token_usage([((day, 'ann', 'waiter', 'm1'), row)])
+    db.bump_token_usage([(('2000-01-01', 'old', 'waiter', 'm1'), row)])
+
+    summary = db.get_token_usage_summary(days=30)
+    assert [(entry['_id'], entry['calls']) for entry in summary['customer']] == [('ann', 2), ('bob', 1)]
+    assert [(entry['_id'], entry['prompt_tokens']) for entry in summary['purpose']] == [('extract', 100), ('waiter', 200)]
+    assert summary['day'] == [{'_id': day, 'calls': 3, 'prompt_tokens': 300, 'completion_tokens': 60,
+                               'cached_tokens': 150, 'cost': 1.5}]
+
+
+BACKENDS = ('memory', 'sqlite', 'mongomock', 'mongo')
+DEFAULT_BACKENDS = ['memory', 'sqlite'] + (['mongomock'] if mongomock is not None else [])
+
+CHECKS = [check_menu, check_orders, check_order_pages, check_order_changes, check_conversations, check_token_usage]
+
+
+def run_conformance(backend):
+    """Run every check on a fresh database; returns the names of the failing ones"""
+    failures = []
+    for check in CHECKS:
+        with scratch_database(backend) as db:
+            try:
+                check(db)
+            except Exception as e:
+                failures.append(check.__name__)
+                print(f"FAIL {backend:7} {check.__name__}: {type(e).__name__} {e}")
+            else:
+                print(f"ok   {backend:7} {check.__name__}")
+    return failures
+
+
+def test_memory_backend():
+    assert run_conformance('memory') == []
+
+
+def test_sqlite_backend():
+    assert run_conformance('sqlite') == []
+
+
+def test_mongomock_backend():
+    import pytest
+    pytest.importorskip('mongomock')
+    assert run_conformance('mongomock') == []
+
+
+def _percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def benchmark(backend, rounds=200):
+    """Per-operation latency in microseconds: {operation: {mean, p50, p95}}"""
+    timings = {}
+
+    def timed(name, fn, *args, **kwargs):
+        started = time.perf_counter()
+        result = fn(*args, **kwargs)
+        timings.setdefault(name, []).append((time.perf_counter() - started) * 1e6)
+        return result
+
+    with scratch_database(backend) as db:
+        turn = [{'role': 'user', 'content': 'two garlic bread please'}, {'role': 'assistant', 'content': 'Sure!'}]
+        usage = {'calls': 1, 'prompt_tokens': 900, 'completion_tokens': 80, 'cached_tokens': 0, 'cost': 0}
+        for i in range(rounds):
+            customer = f"customer{i % 20}"
+            order_id = timed('create_order', db.create_order, customer, '0300', ['Garlic Bread'], 10)
+            timed('update_order_status', db.update_order_status, order_id, 'completed')
+            timed('append_conversation', db.append_conversation, customer, turn)
+            timed('save_conversation_summary', db.save_conversation_summary, customer, {'notes': [i]}, i)
+            timed('bump_token_usage', db.bump_token_usage, [((time.strftime('%Y-%m-%d'), customer, 'waiter', 'm'), usage)])
+            timed('get_conversation_window', db.get_conversation_window, customer, limit=30)
+            timed('get_conversation_page', db.get_conversation_page, customer, before=i // 20 * 2, limit=30)
+            timed('get_orders_page', db.get_orders_page, page_size=20)
+            timed('get_order_stats', db.get_order_stats)
+            timed('get_menu_context', db.get_menu_context, 'large pizza and garlic bread')
+        timed('get_orders', db.get_orders)
+
+    results = {}
+    for name, samples in timings.items():
+        samples.sort()
+        results[name] = {
+            'mean': round(sum(samples) / len(samples), 1),
+            'p50': round(_percentile(samples, 0.5), 1),
+            'p95': round(_percentile(samples, 0.95), 1),
+        }
+    return results
+
+
+def main(argv):
+    backends = [arg for arg in argv if arg in BACKENDS] or DEFAULT_BACKENDS
+    if '--benchmark' not in argv:
+        failures = [name for backend in backends for name in run_conformance(backend)]
+        print("All checks passed" if not failures else f"{len(failures)} checks failed")
+        return 1 if failures else 0
+
+    results = {backend: benchmark(backend) for backend in backends}
+    operations = list(next(iter(results.values())))
+    print(f"{'operation (µs, p50 / p95)':28}" + ''.join(f"{backend:>20}" for backend in backends))
+    for operation in operations:
+        cells = ''.join(
+            f"{results[backend][operation]['p50']:>11} / {results[backend][operation]['p95']:<6}" for backend in backends
+        )
+        print(f"{operation:28}{cells}")
+    if '--json' in argv:
+        with open(argv[argv.index('--json') + 1], 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
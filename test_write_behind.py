@@ -0,0 +1,137 @@
+"""Checks for the write-behind queue
+
+    python test_write_behind.py
+
+Runs against MemoryDatabase, with chosen writes failing once to exercise retries.
+"""
+import sys
+import time
+from datetime import datetime
+
+from embedded_database import MemoryDatabase
+from write_behind import WriteBehindQueue
+
+
+class FlakyDatabase(MemoryDatabase):
+    """MemoryDatabase whose methods named in fail_once raise on their next call
+
+    Methods named in lose_ack write first and then raise, like a write whose
+    acknowledgement never reached the client.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.fail_once = set()
+        self.lose_ack = set()
+
+    def _maybe_fail(self, name, failures):
+        if name in failures:
+            failures.discard(name)
+            raise ConnectionError(f"{name} failed")
+
+    def insert_orders(self, orders):
+        self._maybe_fail('insert_orders', self.fail_once)
+        super().insert_orders(orders)
+        self._maybe_fail('insert_orders', self.lose_ack)
+
+    def append_conversations(self, appends, batch_id=None):
+        self._maybe_fail('append_conversations', self.fail_once)
+        super().append_conversations(appends, batch_id=batch_id)
+        self._maybe_fail('append_conversations', self.lose_ack)
+
+    def bump_token_usage(self, rows, batch_id=None):
+        self._maybe_fail('bump_token_usage', self.fail_once)
+        super().bump_token_usage(rows, batch_id=batch_id)
+        self._maybe_fail('bump_token_usage', self.lose_ack)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def message(content):
+    return {'role': 'user', 'content': content}
+
+
+def check_full_queue_keeps_order():
+    db = FlakyDatabase()
+    db.fail_once = {'insert_orders', 'append_conversations'}
+    queue = WriteBehindQueue(db, sync_orders=False, max_pending=1, flush_interval=0, put_timeout=0.05)
+    order_id = queue.create_order('ann', '0300', ['Pepsi'], 1)
+    queue.append_conversation('ann', [message('first')])
+    # The insert and the append failed and wait for their retry
+    wait_for(lambda: queue.stats()['retrying'])
+    queue.append_conversation('bob', [message('fills the queue')])
+    queue.append_conversation('ann', [message('second')])
+    queue.update_order_status(order_id, 'completed')
+    assert queue.flush()
+    assert [msg['content'] for msg in db.get_conversation('ann')] == ['first', 'second']
+    assert [(order['_id'], order['status']) for order in db.get_orders()] == [(order_id, 'completed')]
+    assert queue.stats()['backpressure_waits'] >= 1
+    queue.close()
+
+
+def check_retried_steps_apply_once():
+    db = FlakyDatabase()
+    db.lose_ack = {'insert_orders', 'append_conversations', 'bump_token_usage'}
+    queue = WriteBehindQueue(db, sync_orders=False, flush_interval=0)
+    order_id = queue.create_order('ann', '0300', ['Pepsi'], 1)
+    queue.append_conversation('ann', [message('hi'), message('one Pepsi please')])
+    queue.record_usage((datetime.now().strftime('%Y-%m-%d'), 'ann', 'waiter', 'm1'), {'calls': 1, 'prompt_tokens': 50})
+    assert queue.flush()
+    # Every step was written, reported as failed and retried under the same batch ID
+    assert queue.stats()['errors'] == 3 and not db.lose_ack
+    assert [order['_id'] for order in db.get_orders()] == [order_id]
+    assert [row['count'] for row in db.get_order_stats()['status_stats']] == [1]
+    assert [msg['content'] for msg in db.get_conversation('ann')] == ['hi', 'one Pepsi please']
+    assert db.get_conversation_window('ann')['start'] == 0
+    usage = db.get_token_usage_summary()['customer']
+    assert [(row['_id'], row['calls'], row['prompt_tokens']) for row in usage] == [('ann', 1, 50)]
+    queue.close()
+
+
+def check_applied_batches():
+    db = MemoryDatabase()
+    db.append_conversations({'ann': [message('hi')]}, batch_id='b1')
+    db.append_conversations({'ann': [message('hi')], 'bob': [message('hello')]}, batch_id='b1')
+    assert [msg['content'] for msg in db.get_conversation('ann')] == ['hi']
+    # The batch was applied to ann only, so bob still gets it
+    assert [msg['content'] for msg in db.get_conversation('bob')] == ['hello']
+    db.append_conversations({'ann': [message('again')]}, batch_id='b2')
+    db.append_conversations({'ann': [message('untagged')]})
+    db.append_conversations({'ann': [message('untagged')]})
+    assert [msg['content'] for msg in db.get_conversation('ann')] == ['hi', 'again', 'untagged', 'untagged']
+
+    key = (datetime.now().strftime('%Y-%m-%d'), 'ann', 'waiter', 'm1')
+    for batch_id in ('b1', 'b1', 'b2'):
+        db.bump_token_usage([(key, {'calls': 1})], batch_id=batch_id)
+    assert db.get_token_usage_summary()['model'][0]['calls'] == 2
+
+
+CHECKS = [check_full_queue_keeps_order, check_retried_steps_apply_once, check_applied_batches]
+
+
+def test_write_behind():
+    for check in CHECKS:
+        check()
+
+
+def main():
+    failures = 0
+    for check in CHECKS:
+        try:
+            check()
+        except Exception as e:
+            failures += 1
+            print(f"FAIL {check.__name__}: {type(e).__name__} {e}")
+        else:
+            print(f"ok   {check.__name__}")
+    print("All checks passed" if not failures else f"{failures} checks failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import contextvars
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from settings import get_setting
+
+# Upper bounds (seconds) of the latency histogram buckets, Prometheus style
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RECENT_TURNS = 50
+
+_current_turn = contextvars.ContextVar("turn", default=None)
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "started")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.observe(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class Histogram:
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (like histogram_quantile)"""
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class Tracer:
+    """Per-turn spans for the chat hot path, aggregated into latency histograms
+
+    When disabled every call returns immediately (span() hands back a shared no-op
+    context manager), so instrumentation can stay in place permanently.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.turns = deque(maxlen=RECENT_TURNS)
+        self.turns_total = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(enabled=(get_setting("TRACING") or "off").lower() in ("on", "1", "true"))
+
+    def span(self, name):
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self, name)
+
+    def observe(self, name, seconds):
+        """Record a duration for a stage, attached to the current turn if there is one"""
+        if not self.enabled or seconds is None:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+        turn = _current_turn.get()
+        if turn is not None:
+            turn["spans"].append((name, seconds))
+
+    def turn(self):
+        """Context manager grouping the spans of one chat turn under a fresh turn ID"""
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Turn(self)
+
+    def recent_turns(self):
+        with self._lock:
+            return list(self.turns)
+
+    def stage_summary(self):
+        """{stage: {count, mean, p50, p95}} from the histograms"""
+        with self._lock:
+            return {
+                name: {
+                    "count": h.count,
+                    "mean": h.sum / h.count if h.count else None,
+                    "p50": h.quantile(0.5),
+                    "p95": h.quantile(0.95),
+                }
+                for name, h in sorted(self.histograms.items())
+            }
+
+    def render_prometheus(self):
+        """All histograms in the Prometheus text exposition format"""
+        lines = [
+            "# HELP chatbot_stage_duration_seconds Time spent in each stage of a chat turn.",
+            "# TYPE chatbot_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for name, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    lines.append(f'chatbot_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'chatbot_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {h.count}')
+                lines.append(f'chatbot_stage_duration_seconds_sum{{stage="{name}"}} {h.sum:.6f}')
+                lines.append(f'chatbot_stage_duration_seconds_count{{stage="{name}"}} {h.count}')
+            lines.append("# HELP chatbot_turns_total Chat turns traced.")
+            lines.append("# TYPE chatbot_turns_total counter")
+            lines.append(f"chatbot_turns_total {self.turns_total}")
+        return "\n".join(lines) + "\n"
+
+
+class _Turn:
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def __enter__(self):
+        self.record = {"turn_id": uuid.uuid4().hex[:12], "at": time.time(), "spans": []}
+        self.started = time.perf_counter()
+        self.token = _current_turn.set(self.record)
+        return self.record
+
+    def __exit__(self, *exc_info):
+        self.tracer.observe("turn", time.perf_counter() - self.started)
+        _current_turn.reset(self.token)
+        with self.tracer._lock:
+            self.tracer.turns.append(self.record)
+            self.tracer.turns_total += 1
+        return False
+
+
+tracer = Tracer.from_settings()
+
+
+def start_metrics_server(port=None, host="127.0.0.1"):
+    """Serve tracer.render_prometheus() at http://host:port/metrics from a daemon thread
+
+    The port defaults to the METRICS_PORT setting; returns None when neither is set.
+    """
+    port = port or get_setting("METRICS_PORT")
+    if not port:
+        return None
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = tracer.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,89 @@
+import contextvars
+import json
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from settings import get_setting
+
+# Router task -> call type shown on the dashboard
+PURPOSES = {"reply": "waiter", "stream": "waiter", "combined": "combined", "extract": "extract"}
+
+USAGE_FIELDS = ("calls", "prompt_tokens", "completion_tokens", "cached_tokens", "cost")
+
+_customer = contextvars.ContextVar("usage_customer", default=None)
+
+
+@contextmanager
+def attribute_usage(customer_name):
+    """Charge every OpenRouter call made inside the block (and work it hands to threads) to a customer"""
+    token = _customer.set(customer_name)
+    try:
+        yield
+    finally:
+        _customer.reset(token)
+
+
+def load_prices():
+    """Per-model USD prices per million tokens from MODEL_PRICES
+
+    MODEL_PRICES is JSON like {"model/id": [prompt_price, completion_price]}.
+    Models not listed (e.g. the :free ones) cost nothing.
+    """
+    raw = get_setting("MODEL_PRICES")
+    if not raw:
+        return {}
+    try:
+        return {model: (float(prices[0]), float(prices[1])) for model, prices in json.loads(raw).items()}
+    except (ValueError, TypeError, IndexError) as e:
+        print(f"Ignoring invalid MODEL_PRICES: {e}")
+        return {}
+
+
+def usage_row(usage, model, prices):
+    """Normalize an OpenRouter usage block into rollup increments"""
+    prompt = usage.get("prompt_tokens") or 0
+    completion = usage.get("completion_tokens") or 0
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    cost = usage.get("cost")
+    if not isinstance(cost, (int, float)):
+        prompt_price, completion_price = prices.get(model, (0.0, 0.0))
+        cost = (prompt * prompt_price + completion * completion_price) / 1_000_000
+    return {
+        "calls": 1,
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "cached_tokens": cached,
+        "cost": float(cost),
+    }
+
+
+class UsageRecorder:
+    """Turns per-call usage blocks into (day, customer, purpose, model) rollup increments
+
+    Increments are handed to sink.record_usage(key, increments), normally the
+    write-behind queue, which sums them per key before a bulk $inc.
+    """
+
+    def __init__(self, sink, prices=None):
+        self.sink = sink
+        self.prices = load_prices() if prices is None else prices
+        self.totals = dict.fromkeys(USAGE_FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def record(self, task, model, usage):
+        if not usage:
+            return
+        row = usage_row(usage, model, self.prices)
+        key = (
+            datetime.now().strftime("%Y-%m-%d"),
+            _customer.get() or "anonymous",
+            PURPOSES.get(task, task),
+            model,
+        )
+        with self._lock:
+            for field in USAGE_FIELDS:
+                self.totals[field] += row[field]
+        try:
+            self.sink.record_usage(key, row)
+        except Exception as e:
+            print(f"Could not record token usage: {e}")
@@ -0,0 +1,301 @@
+import atexit
+import threading
+import time
+import uuid
+from collections import deque
+from settings import get_setting
+from tracing import tracer
+
+MAX_PENDING = 1000
+# How long the worker lingers after the first queued write to gather a batch
+FLUSH_INTERVAL = 0.2
+# How long a caller waits for room in a full queue, and then for its own write to be flushed
+PUT_TIMEOUT = 2.0
+# Wait before retrying a failed flush, doubling per failure up to the maximum
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 30.0
+LATENCY_WINDOW = 200
+
+
+class WriteBehindQueue:
+    """Moves conversation and order writes off the Streamlit request path
+
+    Writes are coalesced per key (one entry per customer conversation, summary,
+    order status or token-usage rollup) and a single worker thread flushes them in bulk writes. When the
+    queue holds max_pending entries, callers wait up to put_timeout for room, then queue
+    their write anyway and wait up to put_timeout again for it to be flushed, so writes
+    land in order. Pending writes are flushed at interpreter exit.
+
+    Each step of a batch is dropped from it only once written. Whatever failed is
+    retried, with backoff, before the next batch; every step is safe to repeat.
+    """
+
+    def __init__(self, db, enabled=True, sync_orders=True, max_pending=MAX_PENDING,
+                 flush_interval=FLUSH_INTERVAL, put_timeout=PUT_TIMEOUT):
+        self.db = db
+        self.enabled = enabled
+        self.sync_orders = sync_orders
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+
+        self._appends = {}
+        self._summaries = {}
+        self._orders = []
+        self._statuses = {}
+        self._usage = {}
+        self._retry = None
+        self._cond = threading.Condition()
+        self._queued_seq = 0
+        self._flushed_seq = 0
+        self._closing = False
+
+        self.enqueued = 0
+        self.coalesced = 0
+        self.backpressure_waits = 0
+        self.batches = 0
+        self.errors = 0
+        self.max_depth = 0
+        self._flush_latencies = deque(maxlen=LATENCY_WINDOW)
+
+        self._worker = None
+        if enabled:
+            self._worker = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._worker.start()
+            atexit.register(self.close)
+
+    @classmethod
+    def from_settings(cls, db):
+        """WRITE_BEHIND=off writes synchronously; ORDER_WRITES=async also queues new orders"""
+        return cls(
+            db,
+            enabled=(get_setting('WRITE_BEHIND') or 'on').lower() != 'off',
+            sync_orders=(get_setting('ORDER_WRITES') or 'sync').lower() != 'async',
+        )
+
+    def _depth(self):
+        return (len(self._appends) + len(self._summaries) + len(self._orders) + len(self._statuses)
+                + len(self._usage))
+
+    def _enqueue(self, is_new, add, write_now):
+        """Queue a write; is_new() tells whether it needs a fresh slot or merges into an existing one"""
+        if not self.enabled:
+            write_now()
+            return
+        with self._cond:
+            closing = self._closing
+            if not closing:
+                full = False
+                if is_new():
+                    deadline = time.monotonic() + self.put_timeout
+                    while self._depth() >= self.max_pending and not self._closing:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    full = self._depth() >= self.max_pending
+                else:
+                    self.coalesced += 1
+                add()
+                self.enqueued += 1
+                self._queued_seq += 1
+                target = self._queued_seq
+                self.max_depth = max(self.max_depth, self._depth())
+                self._cond.notify_all()
+                if not full:
+                    return
+                # Backpressure: the queue stayed full, so this caller waits for its own write.
+                # It still goes through the queue, behind everything queued or retried before it.
+                self.backpressure_waits += 1
+                deadline = time.monotonic() + self.put_timeout
+                while self._flushed_seq < target and not self._closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                return
+        # At shutdown the worker drains what is queued and stops; write after it, to keep the order
+        self._worker.join()
+        write_now()
+
+    def append_conversation(self, customer_name, new_messages):
+        new_messages = list(new_messages)
+        if not new_messages:
+            return
+        self._enqueue(
+            lambda: customer_name not in self._appends,
+            lambda: self._appends.setdefault(customer_name, []).extend(new_messages),
+            lambda: self.db.append_conversation(customer_name, new_messages),
+        )
+
+    def save_conversation_summary(self, customer_name, summary, summary_upto):
+        def add():
+            current = self._summaries.get(customer_name)
+            if current is None or current[1] < summary_upto:
+                self._summaries[customer_name] = (summary, summary_upto)
+
+        self._enqueue(
+            lambda: customer_name not in self._summaries,
+            add,
+            lambda: self.db.save_conversation_summary(customer_name, summary, summary_upto),
+        )
+
+    def create_order(self, customer_name, customer_phone, items, total_amount, wait=None):
+        """Create an order and return its ID
+
+        The ID is assigned client-side, so it is valid even while the insert is still
+        queued. With wait=True (the default unless ORDER_WRITES=async) the insert
+        happens before returning.
+        """
+        order = self.db.new_order_document(customer_name, customer_phone, list(items), total_amount)
+        if wait if wait is not None else self.sync_orders:
+            self.db.insert_orders([order])
+        else:
+            self._enqueue(lambda: True, lambda: self._orders.append(order), lambda: self.db.insert_orders([order]))
+        return str(order['_id'])
+
+    def update_order_status(self, order_id, status):
+        order_id = str(order_id)
+        self._enqueue(
+            lambda: order_id not in self._statuses,
+            lambda: self._statuses.__setitem__(order_id, status),
+            lambda: self.db.update_order_status(order_id, status),
+        )
+
+    def record_usage(self, key, increments):
+        """Add token-usage increments to a (day, customer, purpose, model) rollup"""
+        def add():
+            current = self._usage.get(key)
+            if current is None:
+                self._usage[key] = dict(increments)
+            else:
+                for field, amount in increments.items():
+                    current[field] = current.get(field, 0) + amount
+
+        self._enqueue(lambda: key not in self._usage, add, lambda: self.db.bump_token_usage([(key, increments)]))
+
+    def pending_order_statuses(self):
+        """Status changes not yet written, so pages can show them before the flush lands"""
+        with self._cond:
+            return {**(self._retry['statuses'] if self._retry else {}), **self._statuses}
+
+    def _run(self):
+        backoff = 0
+        while True:
+            with self._cond:
+                if self._retry is not None:
+                    batch, self._retry = self._retry, None
+                else:
+                    while not self._depth() and not self._closing:
+                        self._cond.wait()
+                    if not self._depth():
+                        return
+                    # Linger briefly so a burst of writes goes out as one batch
+                    deadline = time.monotonic() + self.flush_interval
+                    while not self._closing and self._depth() < self.max_pending // 2:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    batch = {
+                        'orders': self._orders, 'appends': self._appends, 'summaries': self._summaries,
+                        'statuses': self._statuses, 'usage': self._usage,
+                        'id': uuid.uuid4().hex, 'seq': self._queued_seq,
+                    }
+                    self._appends, self._summaries, self._orders, self._statuses, self._usage = {}, {}, [], {}, {}
+                    # Room has been freed for callers blocked on backpressure
+                    self._cond.notify_all()
+
+            written = self._flush(batch)
+            with self._cond:
+                if written or self._closing:
+                    if not written:
+                        print(f"Dropping unwritten data at shutdown: {len(batch['orders'])} orders, "
+                              f"{len(batch['appends'])} conversations, {len(batch['summaries'])} summaries, "
+                              f"{len(batch['statuses'])} status changes, {len(batch['usage'])} usage rollups")
+                    backoff = 0
+                    self._flushed_seq = batch['seq']
+                    self._cond.notify_all()
+                    continue
+                # Keep the unwritten steps (under the same batch ID) and retry them before newer writes
+                self._retry = batch
+                backoff = min(RETRY_BACKOFF_MAX, backoff * 2 or RETRY_BACKOFF)
+                deadline = time.monotonic() + backoff
+                while not self._closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+    def _write_statuses(self, statuses):
+        while statuses:
+            order_id, status = next(iter(statuses.items()))
+            self.db.update_order_status(order_id, status)
+            del statuses[order_id]
+
+    def _flush(self, batch):
+        """Write a batch step by step, emptying each step once written; True when nothing is left"""
+        started = time.perf_counter()
+        steps = [
+            ('orders', lambda: self.db.insert_orders(batch['orders'])),
+            ('appends', lambda: self.db.append_conversations(batch['appends'], batch_id=batch['id'])),
+            # Summaries and status changes only update conversations and orders that already exist
+            ('summaries', lambda: self.db.save_conversation_summaries(batch['summaries'])),
+            ('statuses', lambda: self._write_statuses(batch['statuses'])),
+            ('usage', lambda: self.db.bump_token_usage(list(batch['usage'].items()), batch_id=batch['id'])),
+        ]
+        waits_for = {'summaries': 'appends', 'statuses': 'orders'}
+        for step, write in steps:
+            if not batch[step] or batch.get(waits_for.get(step)):
+                continue
+            try:
+                write()
+            except Exception as e:
+                self.errors += 1
+                print(f"Write-behind {step} write failed, will retry: {e}")
+                continue
+            batch[step] = type(batch[step])()
+        self.batches += 1
+        self._flush_latencies.append(time.perf_counter() - started)
+        tracer.observe("write_flush", self._flush_latencies[-1])
+        return not any(batch[step] for step, _ in steps)
+
+    def flush(self, timeout=10.0):
+        """Block until everything queued before this call has been written; False on timeout"""
+        if not self.enabled:
+            return True
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            target = self._queued_seq
+            while self._flushed_seq < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=10.0):
+        """Flush what is queued and stop the worker"""
+        if self._worker is None:
+            return
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._worker.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            latencies = sorted(self._flush_latencies)
+            return {
+                "enabled": self.enabled,
+                "depth": self._depth(),
+                "retrying": self._retry is not None,
+                "max_depth": self.max_depth,
+                "enqueued": self.enqueued,
+                "coalesced": self.coalesced,
+                "backpressure_waits": self.backpressure_waits,
+                "batches": self.batches,
+                "errors": self.errors,
+                "flush_p50": round(latencies[len(latencies) // 2], 4) if latencies else None,
+                "flush_p95": round(latencies[int(len(latencies) * 0.95)], 4) if latencies else None,
+            }